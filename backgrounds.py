@@ -0,0 +1,204 @@
+'''
+Window backgrounds drawn from a cache instead of a style sheet, so Qt
+doesn't decode and scale the full image on every repaint.
+
+Images are decoded and scaled on the thread pool, straight to the size
+of the screen when they are bigger (JPEG can skip most of the work that
+way). The GUI thread only turns finished images into pixmaps and keeps
+the last few in an LRU cache keyed by (path, size). While a new size is
+being scaled, e.g. during a resize, the nearest cached pixmap is
+stretched into place, and only the newest size asked for is scaled.
+'''
+import os
+from collections import OrderedDict
+from PyQt6.QtCore import Qt, QObject, QRunnable, QThreadPool, QSize, pyqtSignal
+from PyQt6.QtGui import QGuiApplication, QImage, QImageReader, QPixmap
+import profiling
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "Backgrounds", "silly.png")
+MAX_ENTRIES = 8
+MAX_BYTES = 128 * 1024 * 1024  # of cached pixmaps
+IMAGE_FILTER = "Images (*.png *.jpg *.jpeg *.bmp *.gif *.webp)"
+
+
+class _ScaleSignals(QObject):
+    done = pyqtSignal(str, QSize, QImage, QImage)  # path, size, source, scaled
+    failed = pyqtSignal(str)
+
+
+class _ScaleJob(QRunnable):
+    '''Decode an image if needed and scale it, off the GUI thread'''
+
+    def __init__(self, path, size, source, screen):
+        super().__init__()
+        self.path = path
+        self.size = size  # QSize in device pixels, empty to keep the image size
+        self.source = source  # decoded image from an earlier job, or None
+        self.screen = screen  # images bigger than this are decoded smaller
+        self.signals = _ScaleSignals()
+
+    def run(self):
+        with profiling.timer("background.scale"):
+            source = self.source
+            if source is None:
+                reader = QImageReader(self.path)
+                reader.setAutoTransform(True)
+                full = reader.size()
+                if full.isValid() and (full.width() > self.screen.width()
+                                       or full.height() > self.screen.height()):
+                    reader.setScaledSize(full.scaled(self.screen,
+                                                     Qt.AspectRatioMode.KeepAspectRatioByExpanding))
+                source = reader.read()
+                if source.isNull():
+                    self.signals.failed.emit(self.path)
+                    return
+            scaled = source
+            if not self.size.isEmpty() and source.size() != self.size:
+                scaled = source.scaled(self.size, Qt.AspectRatioMode.IgnoreAspectRatio,
+                                       Qt.TransformationMode.SmoothTransformation)
+            self.signals.done.emit(self.path, self.size, source, scaled)
+
+
+class BackgroundManager(QObject):
+    '''
+    The current background image with its scaled copies. changed is
+    emitted when a newly scaled copy is ready, so the window can repaint.
+    '''
+    changed = pyqtSignal()
+    failed = pyqtSignal(str)  # path of an image which couldn't be read
+
+    def __init__(self, parent=None, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES):
+        '''
+        Keyword arguments:
+        parent -- owning QObject, usually the window
+        max_entries -- most scaled pixmaps kept (int)
+        max_bytes -- most memory used by the kept pixmaps (int)
+        '''
+        super().__init__(parent)
+        self.path = None
+        self.tiled = False
+        self.cache = OrderedDict()  # (path, width, height) -> QPixmap, least recent first
+        self.cache_bytes = 0
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.source = None  # decoded image of the current path
+        self.jobs = 0  # images scaled so far
+        self.running = None  # (path, size) being scaled
+        self.wanted = None  # newest (path, size) asked for while a job runs
+        self.hits = 0
+        self.misses = 0
+
+    def set_image(self, path, tiled=False):
+        '''
+        Function to change the background. The image is read in the
+        background and the window repaints when it is ready.
+
+        Keyword arguments:
+        path -- image file (str)
+        tiled -- repeat the image at its own size instead of stretching it (bool)
+        '''
+        if path == self.path and tiled == self.tiled:
+            return
+        self.path = path
+        self.tiled = tiled
+        self.source = None
+        self.wanted = None
+
+    def _key(self, size):
+        return (self.path, size.width(), size.height())
+
+    def pixmap(self, size):
+        '''
+        Function to get the background at a size in device pixels. Returns
+        (pixmap, exact) where pixmap is the nearest one cached when the
+        exact size isn't ready yet (and is being scaled), or None.
+
+        Keyword arguments:
+        size -- window size in device pixels (QSize)
+        '''
+        if self.path is None:
+            return None, False
+        if self.tiled:
+            size = QSize()
+        key = self._key(size)
+        pixmap = self.cache.get(key)
+        if pixmap is not None:
+            self.cache.move_to_end(key)
+            self.hits += 1
+            return pixmap, True
+        self.misses += 1
+        self._request(size)
+        area = size.width() * size.height()
+        same_image = [cached for (path, _, _), cached in self.cache.items() if path == self.path]
+        nearest = min(same_image, key=lambda cached: abs(cached.width() * cached.height() - area),
+                      default=None)
+        return nearest, False
+
+    def _request(self, size):
+        '''Scale the current image to size, or remember it for after the running job'''
+        wanted = (self.path, QSize(size))
+        if self.running is not None:
+            if self.running != wanted:
+                self.wanted = wanted
+            return
+        self.running = wanted
+        self.jobs += 1
+        screen = QGuiApplication.primaryScreen()
+        screen_size = (screen.size() * screen.devicePixelRatio()) if screen else QSize(3840, 2160)
+        job = _ScaleJob(self.path, QSize(size), self.source, screen_size)
+        job.signals.done.connect(self._done)
+        job.signals.failed.connect(self._failed)
+        QThreadPool.globalInstance().start(job)
+
+    def _done(self, path, size, source, scaled):
+        self.running = None
+        if path == self.path:
+            self.source = source
+            pixmap = QPixmap.fromImage(scaled)
+            key = (path, size.width(), size.height())
+            self.cache[key] = pixmap
+            self.cache_bytes += pixmap.width() * pixmap.height() * 4
+            self._evict()
+        self._next()
+        self.changed.emit()
+
+    def _failed(self, path):
+        self.running = None
+        if path == self.path:
+            self.path = None
+            self.failed.emit(path)
+        self._next()
+
+    def _next(self):
+        wanted, self.wanted = self.wanted, None
+        if wanted is not None and wanted[0] == self.path and self._key(wanted[1]) not in self.cache:
+            self._request(wanted[1])
+
+    def _evict(self):
+        while self.cache and (len(self.cache) > self.max_entries
+                              or self.cache_bytes > self.max_bytes):
+            _, pixmap = self.cache.popitem(last=False)
+            self.cache_bytes -= pixmap.width() * pixmap.height() * 4
+
+    def paint(self, painter, rect, ratio=1.0):
+        '''
+        Function to draw the background, as part of a paintEvent
+
+        Keyword arguments:
+        painter -- painter of the widget (QPainter)
+        rect -- widget area to fill (QRect)
+        ratio -- device pixel ratio of the widget (float)
+        '''
+        with profiling.timer("background.paint"):
+            pixmap, exact = self.pixmap(QSize(round(rect.width() * ratio),
+                                              round(rect.height() * ratio)))
+            if pixmap is None:
+                return
+            if self.tiled:
+                pixmap.setDevicePixelRatio(ratio)
+                painter.drawTiledPixmap(rect, pixmap)
+            elif exact:
+                pixmap.setDevicePixelRatio(ratio)
+                painter.drawPixmap(rect.topLeft(), pixmap)
+            else:
+                painter.drawPixmap(rect, pixmap)  # stretched until the right size is ready
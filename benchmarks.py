@@ -0,0 +1,1128 @@
+#!/usr/bin/env python3
+'''
+Benchmarks for the mad lib hot paths. Run with: python benchmarks.py [name ...]
+
+The suite times each hot path over templates of 10 to 100k prompts, with
+Qt offscreen and a stub OpenAI client, and saves the results as JSON so
+commits can be compared:
+
+    python benchmarks.py --suite --save                 # benchmark_results/<commit>.json
+    python benchmarks.py --suite --compare benchmark_results/abc1234.json
+'''
+import os
+import sys
+import time
+import tempfile
+import subprocess
+import random
+import threading
+import types
+import json
+import argparse
+import platform
+import statistics
+import inputs_file
+import generation
+import core
+import template_file
+from fill_session import FillSession
+from template import Template, PlaceholderIndex
+
+BENCHMARKS = {}
+
+
+def benchmark(func):
+    '''Decorator to register a benchmark function under its name'''
+    BENCHMARKS[func.__name__.replace("bench_", "")] = func
+    return func
+
+
+def synthetic_template(blanks, seed=0):
+    '''
+    Function to build a mad lib with the requested number of placeholders
+
+    Keyword arguments:
+    blanks -- number of placeholders to generate (int)
+    seed -- random seed so runs are comparable (int)
+    '''
+    rng = random.Random(seed)
+    types = [value for value in inputs_file.inputs.values() if value != "Custom"]
+    words = ["the", "a", "went", "to", "with", "and", "very", "quickly", "over"]
+    parts = []
+    for i in range(blanks):
+        parts.append(" ".join(rng.choice(words) for _ in range(rng.randint(2, 8))))
+        parts.append("[" + rng.choice(types) + str(i + 1) + "]")
+    parts.append(".")
+    return " ".join(parts)
+
+
+class SlowClient:
+    '''
+    Stand-in for openai.OpenAI which answers after a delay. Only every
+    valid_every-th reply has the right number of prompts. Like the real
+    model, replies often list the prompts again after the paragraph.
+    Streamed replies spread the delay over the words.
+    '''
+
+    def __init__(self, delay=0.2, blanks=5, valid_every=3):
+        self.delay = delay
+        self.blanks = blanks
+        self.valid_every = valid_every
+        self.calls = 0
+        self.lock = threading.Lock()
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+            valid = self.calls % self.valid_every == 0
+        count = self.blanks if valid else self.blanks + 1
+        text = synthetic_template(count) + "\n\nPlaceholders: " + ", ".join(
+            "[Noun" + str(i + 1) + "]" for i in range(count))
+        if kwargs.get("stream"):
+            return self._stream(text)
+        time.sleep(self.delay)
+        message = types.SimpleNamespace(content=text)
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    def _stream(self, text):
+        words = text.split(" ")
+        for i, word in enumerate(words):
+            time.sleep(self.delay / len(words))
+            delta = types.SimpleNamespace(content=word if i == 0 else " " + word)
+            yield types.SimpleNamespace(choices=[types.SimpleNamespace(delta=delta)])
+
+
+def timeit(func, repeat=5):
+    '''Return the best wall time in seconds of calling func repeat times'''
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+@benchmark
+def bench_render():
+    '''Compile and fill templates of increasing size'''
+    for blanks in (10, 1000, 10000):
+        text = synthetic_template(blanks)
+        template = Template(text)
+        answers = {name: "word" for name in template.names}
+        compile_time = timeit(lambda: Template(text))
+        render_time = timeit(lambda: template.render(answers))
+        print(f"render  blanks={blanks:<6} compile={compile_time * 1e3:8.2f}ms"
+              f"  render={render_time * 1e3:8.2f}ms")
+
+
+# the pattern before tokenizer.py, for comparison
+LEGACY_PATTERN = r'\[\s*([a-zA-Z\s]+[0-9]*)\s*\]'
+
+
+@benchmark
+def bench_tokenizer():
+    '''
+    Tokens per second lexing multi-MB templates, against scanning with the
+    old pattern and splitting the types off the names afterwards
+    '''
+    import re
+    import tokenizer
+    legacy = re.compile(LEGACY_PATTERN)
+
+    def legacy_lex(text):
+        return [(tokenizer.prompt_type(match.group(1)), match.span())
+                for match in legacy.finditer(text)]
+
+    for blanks in (100000, 400000):
+        text = synthetic_template(blanks)
+        megabytes = len(text) / 2 ** 20
+        if len(tokenizer.tokenize(text)) != blanks or len(legacy_lex(text)) != blanks:
+            raise SystemExit("the tokenizer and the old pattern disagree")
+        for name, func in (("old pattern", lambda: legacy_lex(text)),
+                           ("tokenize", lambda: tokenizer.tokenize(text)),
+                           ("count", lambda: tokenizer.count_tokens(text)),
+                           ("Template", lambda: Template(text))):
+            elapsed = timeit(func, repeat=3)
+            print(f"tokenizer {megabytes:5.1f}MB {name:<12} {blanks / elapsed / 1e6:6.2f}M tokens/sec"
+                  f"  {megabytes / elapsed:7.1f}MB/sec")
+
+
+@benchmark
+def bench_index():
+    '''Insert placeholders one at a time like the prompt buttons do'''
+    for blanks in (100, 1000, 5000):
+        def build():
+            text = ""
+            index = PlaceholderIndex()
+            for i in range(blanks):
+                insert = "some more story [Noun" + str(i + 1) + "] "
+                position = len(text)
+                text += insert
+                index.apply_change(lambda start, end: text[start:end], position, 0, len(insert))
+        elapsed = timeit(build, repeat=3)
+        print(f"index   blanks={blanks:<6} total={elapsed * 1e3:8.2f}ms"
+              f"  per insert={elapsed / blanks * 1e6:8.2f}us")
+
+
+@benchmark
+def bench_speculative():
+    '''Retry one at a time against racing three requests at once'''
+    for name, generate in (("sequential", generation.generate_mad_lib),
+                           ("speculative", generation.generate_speculative)):
+        attempts = []
+        start = time.perf_counter()
+        generate(SlowClient(), "Winter", 5, attempts=attempts)
+        elapsed = time.perf_counter() - start
+        print(f"generate {name:<12} wall={elapsed:6.2f}s  "
+              + generation.summarize_attempts(attempts))
+
+
+@benchmark
+def bench_template_file():
+    '''Save and load throughput of .madlib files against .docx files'''
+    count = 200
+    texts = [synthetic_template(50, seed) for seed in range(count)]
+    records = [template_file.TemplateRecord("Theme " + str(i), text)
+               for i, text in enumerate(texts)]
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, "library.madlib")
+
+        def save_native():
+            template_file.save_templates(path, records)
+
+        def load_native():
+            with template_file.TemplateFile(path) as templates:
+                for record in templates:
+                    record.template
+
+        def save_docx():
+            for i, text in enumerate(texts):
+                core.write_docx(os.path.join(directory, str(i) + ".docx"),
+                                "Theme " + str(i), text, text, {})
+
+        def load_docx():
+            for i in range(count):
+                core.read_docx(os.path.join(directory, str(i) + ".docx"))
+
+        for name, func in (("madlib save", save_native), ("madlib load", load_native),
+                           ("docx save", save_docx), ("docx load", load_docx)):
+            elapsed = timeit(func, repeat=3)
+            print(f"{name:<12} templates={count}  {count / elapsed:10.0f} templates/sec")
+
+
+
+@benchmark
+def bench_export():
+    '''
+    Bulk export throughput: a python-docx Document per story against the
+    streamed writer, as a folder of documents and as one booklet, and the
+    peak memory of a booklet as it gets longer
+    '''
+    import tracemalloc
+    import export
+    from template import Template
+    templates = {str(i): ("Theme " + str(i), synthetic_template(50, i)) for i in range(10)}
+    compiled = {tid: Template(text) for tid, (_, text) in templates.items()}
+
+    def answer_sets(count):
+        for i in range(count):
+            tid = str(i % len(templates))
+            yield str(i), tid, {name: "answer" + str(i) for name in compiled[tid].names}
+
+    count = 400
+    with tempfile.TemporaryDirectory() as directory:
+        start = time.perf_counter()
+        for answers_id, tid, answers in answer_sets(count):
+            theme, text = templates[tid]
+            core.write_docx(os.path.join(directory, answers_id + ".docx"), theme,
+                            compiled[tid].render(answers), text, {}, answers)
+        elapsed = time.perf_counter() - start
+        print(f"export python-docx per story        {count / elapsed:8.0f} stories/sec")
+        for workers in sorted({1, os.cpu_count() or 1}):
+            for name, output in (("folder", os.path.join(directory, "folder" + str(workers))),
+                                 ("booklet", os.path.join(directory, f"booklet{workers}.docx"))):
+                start = time.perf_counter()
+                export.export_stories(templates, answer_sets(count * 10), output, workers)
+                elapsed = time.perf_counter() - start
+                print(f"export {name:<8} workers={workers:<3}        "
+                      f"{count * 10 / elapsed:8.0f} stories/sec")
+        for stories in (1000, 10000):
+            tracemalloc.start()
+            export.export_stories(templates, answer_sets(stories),
+                                  os.path.join(directory, "memory.docx"), workers=1)
+            peak = tracemalloc.get_traced_memory()[1]
+            tracemalloc.stop()
+            print(f"export booklet stories={stories:<6} peak={peak / 2 ** 20:6.2f}MB  "
+                  f"file={os.path.getsize(os.path.join(directory, 'memory.docx')) / 2 ** 20:6.2f}MB")
+
+@benchmark
+def bench_library():
+    '''Search a 20k template library by theme, blank count and prompt type'''
+    from library import Library
+    library = Library(":memory:")
+    rng = random.Random(0)
+    themes = ["space adventure", "winter", "spaceship party", "beach", "zoo trip"]
+    start = time.perf_counter()
+    for i in range(20000):
+        library.add(rng.choice(themes) + " " + str(i), synthetic_template(rng.randint(1, 20), i))
+    print(f"library insert 20000 templates {time.perf_counter() - start:6.2f}s")
+    for query in ({"theme": "space", "min_blanks": 8, "max_blanks": 12, "types": ["Celebrity"]},
+                  {"text": "quickly", "types": ["Noun", "Colour"]},
+                  {"min_blanks": 10, "max_blanks": 10}):
+        elapsed = timeit(lambda: library.search(**query))
+        print(f"library search {elapsed * 1e3:7.2f}ms  {query}")
+
+
+@benchmark
+def bench_fill():
+    '''Answer every blank of a story one at a time, as the fill form does'''
+    for blanks in (100, 1000, 10000):
+        text = synthetic_template(blanks)
+
+        def answer_all():
+            session = FillSession(text)
+            for name in session.names:
+                session.set_answer(name, "answer")
+        elapsed = timeit(answer_all, repeat=3)
+        print(f"fill    blanks={blanks:<6} total={elapsed * 1e3:8.2f}ms"
+              f"  per answer={elapsed / blanks * 1e6:8.2f}us")
+
+
+@benchmark
+def bench_streaming():
+    '''Time to first text and total time with and without streaming'''
+    for name, on_text in (("whole reply", None), ("streamed", lambda text: None)):
+        attempts = []
+        start = time.perf_counter()
+        generation.generate_mad_lib(SlowClient(), "Winter", 5, attempts=attempts,
+                                    on_text=on_text)
+        elapsed = time.perf_counter() - start
+        first = attempts[0].first_text if on_text else attempts[0].latency
+        print(f"generate {name:<12} first text={first:6.3f}s  total={elapsed:6.2f}s  "
+              + generation.summarize_attempts(attempts))
+
+
+# slow imports which must not happen until the feature using them is used
+LAZY_MODULES = ("openai", "httpx", "docx", "numpy", "vocabulary", "urllib.request")
+STARTUP_BUDGET = 1.0  # seconds from interpreter start to the window shown
+
+STARTUP_SCRIPT = '''
+import sys
+import mad_libs
+from PyQt6.QtWidgets import QApplication
+app = QApplication(sys.argv)
+window = mad_libs.MainWindow()
+window.show()
+app.processEvents()
+print(",".join(name for name in {lazy!r} if name in sys.modules))
+'''
+
+
+@benchmark
+def bench_sampler():
+    '''Random answers from large word lists, one story and in bulk'''
+    from vocabulary import Vocabulary, _numpy
+    vocabulary = Vocabulary()
+    rng = random.Random(0)
+    for type_name in inputs_file.inputs.values():
+        if type_name != "Custom":
+            words = [type_name.lower().replace(" ", "") + str(i) for i in range(100000)]
+            weights = [rng.random() for _ in words] if type_name == "Colour" else None
+            vocabulary.add(type_name, words, weights)
+    backend = "numpy" if _numpy() else "random"
+    for blanks in (10, 100):
+        text = synthetic_template(blanks)
+        count = 200000 // blanks
+        one = timeit(lambda: vocabulary.sample_answers(text, seed=1), repeat=20)
+        bulk = timeit(lambda: sum(1 for _ in vocabulary.sample_answer_sets(text, count, seed=1)),
+                      repeat=3)
+        print(f"sampler blanks={blanks:<6} one={one * 1e6:8.1f}us  bulk={count / bulk:9.0f} sets/sec"
+              f" ({count * blanks / bulk:10.0f} samples/sec, {backend})")
+
+
+@benchmark
+def bench_history():
+    '''Record, undo and redo edits to a long story and measure memory per step'''
+    import tracemalloc
+    from history import History
+    rng = random.Random(0)
+    for edits in (1000, 10000, 50000):
+        text = synthetic_template(2000)
+        operations = []
+        # typing in words, adding prompts and deleting characters
+        position = len(text) // 2
+        for i in range(edits):
+            choice = rng.random()
+            if choice < 0.8:
+                operations.append((position, "", rng.choice("abcdefgh ")))
+                position += 1
+            elif choice < 0.9:
+                operations.append((position, "", "[Noun" + str(i) + "]"))
+                position += len(operations[-1][2])
+            else:
+                position = rng.randrange(len(text))
+                operations.append((position, text[position], ""))
+                text = text[:position] + text[position + 1:]
+        history = History(max_steps=edits)
+        tracemalloc.start()
+        start = time.perf_counter()
+        for operation in operations:
+            history.record(*operation)
+        record_time = time.perf_counter() - start
+        memory = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        steps = len(history)
+        start = time.perf_counter()
+        for _ in range(steps):
+            history.undo()
+        undo_time = time.perf_counter() - start
+        start = time.perf_counter()
+        while history.can_redo():
+            history.redo()
+        redo_time = time.perf_counter() - start
+        print(f"history edits={edits:<6} steps={steps:<6} record={record_time / edits * 1e6:5.2f}us"
+              f"  undo={undo_time / steps * 1e6:5.2f}us  redo={redo_time / steps * 1e6:5.2f}us"
+              f"  memory={memory / steps:6.0f}B/step (a copy of the text is {len(text)}B)")
+
+
+def stub_endpoint(client):
+    '''
+    Function to serve an OpenAI compatible /chat/completions on localhost,
+    answering from client (e.g. a SlowClient). Returns the server; its URL
+    is http://127.0.0.1:<server.server_port>/v1.
+
+    Keyword arguments:
+    client -- OpenAI style client to take the replies from
+    '''
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class Handler(BaseHTTPRequestHandler):
+        protocol_version = "HTTP/1.1"
+
+        def do_POST(self):
+            request = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+            if not request.get("stream"):
+                reply = client.create(**request)
+                body = json.dumps({"choices": [{"message": {
+                    "role": "assistant", "content": reply.choices[0].message.content}}],
+                    "usage": {"prompt_tokens": 100, "completion_tokens": 50}}).encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+                return
+            self.send_response(200)
+            self.send_header("Content-Type", "text/event-stream")
+            self.send_header("Connection", "close")
+            self.end_headers()
+            try:
+                for chunk in client.create(**request):
+                    delta = {"content": chunk.choices[0].delta.content}
+                    self.wfile.write(b"data: " + json.dumps({"choices": [{"delta": delta}]}).encode()
+                                     + b"\n\n")
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+            except (BrokenPipeError, ConnectionResetError):
+                pass  # the client stopped reading early
+            self.close_connection = True
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+@benchmark
+def bench_providers():
+    '''
+    Offline generator speed, a stub OpenAI compatible server over HTTP and
+    which provider the Router picks for different deadlines
+    '''
+    import providers
+    local = providers.LocalProvider(seed=0)
+    for blanks in (5, 50, 500):
+        elapsed = timeit(lambda: local.generate("Winter", blanks), repeat=50)
+        print(f"local   blanks={blanks:<6} {elapsed * 1e6:9.1f}us per mad lib")
+    server = stub_endpoint(SlowClient(delay=0.05, blanks=5, valid_every=1))
+    try:
+        endpoint = providers.EndpointProvider(f"http://127.0.0.1:{server.server_port}/v1")
+        for stream in (False, True):
+            attempts = []
+            start = time.perf_counter()
+            endpoint.generate("Winter", 5, attempts=attempts,
+                              on_text=(lambda text: None) if stream else None)
+            print(f"endpoint stream={stream!s:<5} wall={time.perf_counter() - start:6.3f}s  "
+                  + generation.summarize_attempts(attempts))
+        chat = providers.ChatProvider(SlowClient(delay=0.2, blanks=5, valid_every=1))
+        chat.cost = 0.5  # cheaper than the server but slower
+        router = providers.Router([chat, endpoint, local])
+        for provider in router.providers:
+            provider.generate("Winter", 5)
+        for deadline in (0.001, 0.1, 1.0):
+            order = " > ".join(provider.name for provider in router.candidates(deadline))
+            print(f"router  deadline={deadline:<6g} {order}")
+        router.providers.remove(local)
+        for deadline in (0.1, 1.0):
+            order = " > ".join(provider.name for provider in router.candidates(deadline))
+            print(f"router  deadline={deadline:<6g} {order} (no local generator)")
+        fallback = providers.LocalProvider(seed=0)
+        fallback.cost = 100.0  # only used when the server fails
+        offline = providers.Router([providers.EndpointProvider("http://127.0.0.1:9/v1",
+                                                               timeout=1), fallback])
+        start = time.perf_counter()
+        offline.generate("Winter", 5, max_retries=1)
+        print(f"router  offline fallback wall={time.perf_counter() - start:6.3f}s  "
+              + " > ".join(f"{stats['name']} ({stats['failures']} failed)"
+                           for stats in offline.stats()))
+    finally:
+        server.shutdown()
+
+
+class CountingClient(SlowClient):
+    '''SlowClient which keeps the most requests it was answering at once'''
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.in_flight = 0
+        self.most_in_flight = 0
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.in_flight += 1
+            self.most_in_flight = max(self.most_in_flight, self.in_flight)
+        try:
+            return super().create(**kwargs)
+        finally:
+            with self.lock:
+                self.in_flight -= 1
+
+
+@benchmark
+def bench_prefetch():
+    '''
+    Generate pressed every 0.2s, mostly on three popular themes, against a
+    stub server: the wait per press straight from the backend and from the
+    prefetch pools. Fails when the pools go over their concurrency limit
+    or rate budget.
+    '''
+    import providers
+    from prefetch import PrefetchPool
+    rng = random.Random(0)
+    presses = [rng.choice(("Winter", "Pirates", "Space")) if rng.random() < 0.8
+               else "Rare theme " + str(i) for i in range(40)]
+    for prefetching in (False, True):
+        client = CountingClient(delay=0.3, blanks=5, valid_every=1)
+        server = stub_endpoint(client)
+        endpoint = providers.EndpointProvider(f"http://127.0.0.1:{server.server_port}/v1")
+        pool = PrefetchPool(depth=2, themes=4, workers=3, rate=5.0, burst=5) if prefetching else None
+        waits, pops = [], []
+        start = time.perf_counter()
+        try:
+            for theme in presses:
+                pressed = time.perf_counter()
+                paragraph = pool.pop(endpoint, theme, 5) if pool is not None else None
+                if paragraph is not None:
+                    pops.append(time.perf_counter() - pressed)
+                else:
+                    endpoint.generate(theme, 5)
+                waits.append(time.perf_counter() - pressed)
+                time.sleep(max(0.0, 0.2 - waits[-1]))
+            elapsed = time.perf_counter() - start
+            print(f"prefetch {'pools' if prefetching else 'off':<6} wait p50={statistics.median(waits) * 1e3:7.2f}ms"
+                  f"  p95={statistics.quantiles(waits, n=20)[-1] * 1e3:7.1f}ms  backend requests={client.calls}"
+                  f" (most at once {client.most_in_flight})")
+            if pool is not None:
+                stats = pool.stats()
+                print(f"prefetch pop p50={statistics.median(pops) * 1e6:5.1f}us  hit rate={stats['hit_rate']:.0%}"
+                      f"  refill p50={stats['refill_p50']:.2f}s p95={stats['refill_p95']:.2f}s"
+                      f"  pool requests={stats['requests']} in {elapsed:.1f}s"
+                      f" (waited {stats['rate_waited']:.1f}s for the rate budget)")
+                print("prefetch depth " + ", ".join(f"{entry['theme']}={entry['depth']}"
+                                                    f" ({entry['hits']} hits {entry['misses']} misses)"
+                                                    for entry in stats["pools"]))
+                if stats["requests"] > pool.bucket.burst + pool.bucket.rate * elapsed + 1:
+                    raise SystemExit("the prefetch pools went over their rate budget")
+                if client.most_in_flight > pool.workers + 1:
+                    raise SystemExit("the prefetch pools went over their concurrency limit")
+        finally:
+            if pool is not None:
+                pool.close()
+            server.shutdown()
+    # a pop on its own, without refills or requests running
+    local = providers.LocalProvider(seed=0)
+    pool = PrefetchPool(depth=2001, rate=1e6, burst=10 ** 6)
+    pool.pop(local, "Winter", 5)
+    pool.wait()
+    pool.close()
+    times = []
+    for _ in range(2000):
+        start = time.perf_counter()
+        pool.pop(local, "Winter", 5)
+        times.append(time.perf_counter() - start)
+    print(f"prefetch pop when idle p50={statistics.median(times) * 1e6:5.2f}us"
+          f"  max={max(times) * 1e6:6.1f}us")
+
+
+class JSONClient:
+    '''
+    Stand-in for a chat model in JSON mode which writes mad libs with the
+    local generator, reports usage and cuts replies off at max_tokens.
+    Keeps the arguments of every request.
+    '''
+
+    def __init__(self, words_per_blank=0):
+        import providers
+        self.local = providers.LocalProvider(seed=0)
+        self.rng = random.Random(0)
+        self.words_per_blank = words_per_blank  # padding, as wordier models write
+        self.requests = []
+        self.chat = types.SimpleNamespace(completions=self)
+
+    def create(self, messages, **kwargs):
+        self.requests.append(dict(kwargs, messages=messages))
+        blanks = int(messages[-1]["content"].rsplit(" ", 1)[1])
+        text = self.local.compose("Winter", blanks, self.rng)
+        text += " and so on" * (self.words_per_blank * blanks // 3)
+        content = json.dumps({generation.JSON_FIELD: text})
+        finish_reason = "stop"
+        if generation.estimate_tokens(content) > kwargs["max_tokens"]:
+            content = content[:kwargs["max_tokens"] * 4]
+            finish_reason = "length"
+        usage = types.SimpleNamespace(
+            prompt_tokens=sum(generation.estimate_tokens(m["content"]) + 4 for m in messages),
+            completion_tokens=generation.estimate_tokens(content))
+        if kwargs.get("stream"):
+            return self._stream(content, finish_reason, usage)
+        message = types.SimpleNamespace(content=content)
+        choice = types.SimpleNamespace(message=message, finish_reason=finish_reason)
+        return types.SimpleNamespace(choices=[choice], usage=usage)
+
+    def _stream(self, content, finish_reason, usage):
+        for i in range(0, len(content), 16):
+            delta = types.SimpleNamespace(content=content[i:i + 16])
+            last = i + 16 >= len(content)
+            choice = types.SimpleNamespace(delta=delta, finish_reason=finish_reason if last else None)
+            yield types.SimpleNamespace(choices=[choice], usage=None)
+        yield types.SimpleNamespace(choices=[], usage=usage)
+
+
+@benchmark
+def bench_prompt():
+    '''
+    Prompt and completion token budgets against a JSON mode stub model, and
+    how often the budget cuts a reply off. Fails when a request asks for
+    a different budget than max_tokens_for or the usage isn't recorded.
+    '''
+    allowed = [value for value in inputs_file.inputs.values() if value != "Custom"]
+    if generation.PROMPT_TYPES != allowed:
+        raise SystemExit("prompt types differ from inputs_file.inputs")
+    for stream in (False, True):
+        for blanks in (5, 20, 100):
+            client = JSONClient()
+            attempts = []
+            for _ in range(20):
+                generation.generate_mad_lib(client, "Winter", blanks, attempts=attempts,
+                                            model="gpt-4o", on_text=(lambda text: None) if stream else None)
+            budget = generation.max_tokens_for(blanks)
+            if any(request["max_tokens"] != budget or "response_format" not in request
+                   for request in client.requests):
+                raise SystemExit(f"blanks={blanks}: requests didn't ask for {budget} tokens in JSON mode")
+            if any(attempt.prompt_tokens is None or attempt.completion_tokens is None
+                   or attempt.tokens_estimated for attempt in attempts):
+                raise SystemExit(f"blanks={blanks}: token usage wasn't recorded")
+            prompt = statistics.mean(attempt.prompt_tokens for attempt in attempts)
+            completion = statistics.mean(attempt.completion_tokens for attempt in attempts)
+            print(f"prompt  stream={stream!s:<5} blanks={blanks:<4} max_tokens={budget:<5} "
+                  f"prompt={prompt:5.0f}  completion={completion:6.0f} tokens per request  "
+                  f"requests per mad lib={len(attempts) / 20:4.2f}")
+    for words_per_blank in (0, 10, 20, 30):
+        client = JSONClient(words_per_blank)
+        attempts = []
+        for blanks in range(1, 101):
+            try:
+                generation.generate_mad_lib(client, "Winter", blanks, attempts=attempts,
+                                            max_retries=1)
+            except generation.GenerationFailed:
+                pass
+        truncated = sum(attempt.truncated for attempt in attempts)
+        print(f"prompt  +{words_per_blank:<2} words per blank  truncated={truncated} of {len(attempts)}"
+              f"  completion={statistics.mean(a.completion_tokens for a in attempts):5.0f} tokens")
+
+@benchmark
+def bench_repair():
+    '''
+    How often near miss replies are repaired locally, and the requests
+    saved against asking again, with a stub model which is up to 2 prompts off
+    '''
+    import providers
+    from repair import repair_mad_lib
+    local = providers.LocalProvider(seed=0)
+    rng = random.Random(0)
+    for blanks in (5, 10, 20):
+        rates = []
+        for off in (-2, -1, 1, 2):
+            texts = [local.compose("Winter", blanks + off, rng) for _ in range(200)]
+            start = time.perf_counter()
+            repaired = sum(repair_mad_lib(text, blanks) is not None for text in texts)
+            elapsed = (time.perf_counter() - start) / len(texts)
+            rates.append(f"{off:+d}: {100 * repaired / len(texts):3.0f}%")
+        print(f"repair  blanks={blanks:<4} " + "  ".join(rates) + f"  ({elapsed * 1e6:.0f}us each)")
+
+    class NearMissClient:
+        '''Replies with a paragraph 0 to 2 prompts off'''
+        def __init__(self, blanks):
+            self.blanks = blanks
+            self.chat = types.SimpleNamespace(completions=self)
+
+        def create(self, **kwargs):
+            text = local.compose("Winter", max(1, self.blanks + rng.randint(-2, 2)), rng)
+            message = types.SimpleNamespace(content=text)
+            return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+    for repair in (False, True):
+        generation.REPAIR = repair
+        attempts = []
+        failed = 0
+        for _ in range(300):
+            try:
+                generation.generate_mad_lib(NearMissClient(10), "Winter", 10, attempts=attempts)
+            except generation.GenerationFailed:
+                failed += 1
+        repaired = sum(attempt.repair is not None for attempt in attempts)
+        print(f"repair  enabled={repair!s:<5} requests per mad lib={len(attempts) / 300:4.2f}"
+              f"  failed={100 * failed / 300:4.1f}%  repaired={repaired}")
+    generation.REPAIR = True
+
+
+
+@benchmark
+def bench_background():
+    '''
+    Repaints of the window with a large photo as the background while it
+    is resized, with the old style sheet border-image against the cache
+    '''
+    from PyQt6.QtGui import QImage, QColor, QPainter
+    from PyQt6.QtCore import QCoreApplication
+    window = _window()
+    window.show()
+    path = os.path.join(tempfile.mkdtemp(), "photo.jpg")
+    photo = QImage(4000, 3000, QImage.Format.Format_RGB32)
+    painter = QPainter(photo)
+    for i in range(0, 4000, 40):
+        painter.fillRect(i, 0, 40, 3000, QColor.fromHsv(i * 360 // 4000, 200, 220))
+    painter.end()
+    photo.save(path, quality=90)
+    sizes = [(800 + 12 * i, 600 + 9 * i) for i in range(40)]
+
+    def repaints(sizes):
+        times = []
+        for width, height in sizes:
+            window.resize(width, height)
+            start = time.perf_counter()
+            window.repaint()
+            times.append(time.perf_counter() - start)
+            QCoreApplication.processEvents()
+        return times
+
+    def settle(seconds=2.0):
+        end = time.perf_counter() + seconds
+        while time.perf_counter() < end and (window.background.running or window.background.wanted):
+            QCoreApplication.processEvents()
+            time.sleep(0.001)
+
+    window.resize(*sizes[0])
+    window.background.set_image(None)
+    start = time.perf_counter()
+    window.setStyleSheet("MainWindow{ border-image:url(" + path + ")}")
+    window.repaint()
+    old_first = time.perf_counter() - start
+    old = repaints(sizes), repaints(sizes[-1:] * 40)
+    window.setStyleSheet("")
+
+    start = time.perf_counter()
+    window.background.set_image(path)
+    window.repaint()
+    settle()
+    first = time.perf_counter() - start
+    new = repaints(sizes), repaints(sizes[-1:] * 40)
+    for name, (resizing, steady), first_paint in (("style sheet", old, old_first),
+                                                   ("cached", new, first)):
+        print(f"background {name:<12} first paint={first_paint * 1e3:6.1f}ms"
+              f"  resizing p50={statistics.median(resizing) * 1e3:6.2f}ms"
+              f" max={max(resizing) * 1e3:6.2f}ms"
+              f"  same size p50={statistics.median(steady) * 1e3:6.2f}ms"
+              f" max={max(steady) * 1e3:6.2f}ms")
+    manager = window.background
+    print(f"background 4000x3000 photo, {manager.jobs} scaled off the GUI thread, "
+          f"cache {len(manager.cache)} pixmaps {manager.cache_bytes / 2 ** 20:.0f}MB, "
+          f"hits {manager.hits} misses {manager.misses}")
+    window.close()
+
+
+@benchmark
+def bench_journal():
+    '''
+    Autosave cost per key press in the window against the size of the
+    story, and the journal size over a long session of typing with a
+    batch written every 100 key presses
+    '''
+    from journal import Journal, read_journal
+    directory = tempfile.mkdtemp()
+    for blanks in (100, 2000):
+        text = synthetic_template(blanks)
+        for autosave in (False, True):
+            window = _window(text)
+            if autosave:
+                window.start_autosave(Journal(os.path.join(directory, f"window{blanks}.journal")))
+            cursor = window.full_text.textCursor()
+            cursor.setPosition(len(text) // 2)
+            times = []
+            for i in range(2000):
+                start = time.perf_counter()
+                cursor.insertText("abcdefgh "[i % 9])
+                times.append(time.perf_counter() - start)
+            journal = window.journal
+            if autosave:
+                start = time.perf_counter()
+                for i in range(2000):
+                    journal.record(i, 0, "a")
+                    window.autosave_check()
+                record = (time.perf_counter() - start) / 2000
+            window.close()
+            print(f"journal window {len(text):>7} chars {'autosave' if autosave else 'no autosave':<12}"
+                  f" key press p50={statistics.median(times) * 1e6:7.1f}us"
+                  + (f"  journal.record={record * 1e6:5.2f}us" if autosave else ""))
+    rng = random.Random(0)
+    path = os.path.join(directory, "session.journal")
+    journal = Journal(path, interval=3600)
+    head, tail = [synthetic_template(200)], ""
+    position = len(head[0])
+    largest = 0
+    start = time.perf_counter()
+    for i in range(1, 200001):
+        choice = rng.random()
+        if choice < 0.85:
+            character = rng.choice("abcdefgh ")
+            head.append(character)
+            journal.record(position, 0, character)
+            position += 1
+        elif choice < 0.97 and len(head[-1]) == 1:
+            head.pop()
+            position -= 1
+            journal.record(position, 1, "")
+        else:
+            text = "".join(head) + tail
+            position = rng.randrange(len(text))
+            head, tail = [text[:position]], text[position:]
+            journal.record(position, 0, "\n")
+            head.append("\n")
+            position += 1
+        if journal.wants_snapshot:
+            journal.snapshot("".join(head) + tail)
+        if i % 100 == 0:
+            journal.flush()
+            largest = max(largest, os.path.getsize(path))
+            if i % 50000 == 0:
+                text = "".join(head) + tail
+                print(f"journal session {i:>6} key presses  text={len(text) / 1024:6.1f}KB"
+                      f"  journal={os.path.getsize(path) / 1024:6.1f}KB (largest {largest / 1024:.1f}KB)"
+                      f"  {journal.compactions} compactions")
+    elapsed = time.perf_counter() - start
+    journal.close()
+    text = "".join(head) + tail
+    start = time.perf_counter()
+    replayed, _ = read_journal(path)
+    replay = time.perf_counter() - start
+    if replayed != text:
+        raise SystemExit("replaying the journal didn't give back the text")
+    print(f"journal {journal.batches} batches fsynced, {journal.records} records in {elapsed:.2f}s,"
+          f" replayed {os.path.getsize(path) / 1024:.1f}KB in {replay * 1e3:.1f}ms")
+
+
+@benchmark
+def bench_startup():
+    '''
+    Time a cold start of the GUI up to the first shown window, list the
+    slowest imports (like python -X importtime) and fail when the start up
+    goes over STARTUP_BUDGET or loads one of LAZY_MODULES
+    '''
+    env = dict(os.environ, QT_QPA_PLATFORM=os.environ.get("QT_QPA_PLATFORM", "offscreen"))
+    script = STARTUP_SCRIPT.format(lazy=LAZY_MODULES)
+    here = os.path.dirname(os.path.abspath(__file__))
+    times = []
+    for _ in range(3):
+        start = time.perf_counter()
+        result = subprocess.run([sys.executable, "-X", "importtime", "-c", script],
+                                cwd=here, env=env, capture_output=True, text=True,
+                                check=True)
+        times.append(time.perf_counter() - start)
+    imports = []
+    for line in result.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumulative, module = line.split("|")
+            if cumulative.strip().isdigit():
+                imports.append((int(cumulative), module.strip()))
+    print(f"startup best={min(times):6.3f}s  budget={STARTUP_BUDGET:.3f}s")
+    for cumulative, module in sorted(imports, reverse=True)[:8]:
+        print(f"  {cumulative / 1e3:8.1f}ms  {module}")
+    loaded = result.stdout.strip()
+    if loaded:
+        raise SystemExit(f"startup imported {loaded}, which should be lazy")
+    if min(times) > STARTUP_BUDGET:
+        raise SystemExit("startup is over budget")
+
+
+###################################################
+# Suite with saved results
+###################################################
+
+SIZES = (10, 100, 1000, 10000, 100000)
+THRESHOLD = 1.25  # slower than the baseline by this factor is a regression
+NOISE_FLOOR = 50e-6  # seconds, differences smaller than this are ignored
+RESULTS_DIR = "benchmark_results"
+
+CASES = {}
+_app = None
+
+
+def case(sizes=SIZES, threshold=THRESHOLD, repeat=5):
+    '''
+    Decorator to register a suite case. The function is called with a
+    number of prompts, does any set up and returns the function to time.
+
+    Keyword arguments:
+    sizes -- numbers of prompts to run the case with (tuple)
+    threshold -- slow down factor counted as a regression for this case (float)
+    repeat -- number of timed calls (int)
+    '''
+    def register(func):
+        CASES[func.__name__.replace("case_", "")] = (func, sizes, threshold, repeat)
+        return func
+    return register
+
+
+def _window(text=""):
+    '''Function to make a main window holding text with the offscreen Qt platform'''
+    global _app
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PyQt6.QtWidgets import QApplication
+    import mad_libs
+    _app = QApplication.instance() or QApplication([])
+    window = mad_libs.MainWindow()
+    window.full_text.setPlainText(text)
+    window.history_clear()
+    return window
+
+
+def _move_cursor(window, position):
+    '''Function to put the text cursor of a window at position'''
+    cursor = window.full_text.textCursor()
+    cursor.setPosition(position)
+    window.full_text.setTextCursor(cursor)
+
+
+@case()
+def case_parse(size):
+    text = synthetic_template(size)
+    return lambda: Template(text)
+
+
+@case()
+def case_render(size):
+    template = Template(synthetic_template(size))
+    answers = {name: "word" for name in template.names}
+    return lambda: template.render(answers)
+
+
+@case(repeat=20)
+def case_insert(size):
+    '''A prompt button pressed in the middle of the text'''
+    window = _window(synthetic_template(size))
+    _move_cursor(window, window.text_mirror.length // 2)
+    return lambda: window.add_a_prompt("Noun")
+
+
+@case(repeat=20)
+def case_undo(size):
+    window = _window(synthetic_template(size))
+    _move_cursor(window, window.text_mirror.length // 2)
+    for _ in range(20):
+        window.add_a_prompt("Noun")
+    return window.undo_edit
+
+
+@case()
+def case_fill(size):
+    '''Putting every answer into the text once the form is done'''
+    text = synthetic_template(size)
+    window = _window(text)
+    session = FillSession(text, {name: "word" for name in Template(text).names})
+
+    def fill():
+        window.fill_text(session)
+        window.undo_edit()
+    return fill
+
+
+@case()
+def case_madlib_save(size):
+    path = os.path.join(tempfile.mkdtemp(), "suite.madlib")
+    text = synthetic_template(size)
+    return lambda: core.write_template(path, "Suite", text, {})
+
+
+@case()
+def case_madlib_load(size):
+    path = os.path.join(tempfile.mkdtemp(), "suite.madlib")
+    core.write_template(path, "Suite", synthetic_template(size), {})
+    return lambda: core.read_mad_lib(path)
+
+
+@case(sizes=(10, 100, 1000, 10000), repeat=3)
+def case_docx_save(size):
+    path = os.path.join(tempfile.mkdtemp(), "suite.docx")
+    text = synthetic_template(size)
+    prompts = dict(enumerate(Template(text).names))
+    return lambda: core.write_docx(path, "Suite", text, text, prompts)
+
+
+@case(sizes=(10, 100, 1000, 10000), repeat=3)
+def case_docx_load(size):
+    path = os.path.join(tempfile.mkdtemp(), "suite.docx")
+    text = synthetic_template(size)
+    core.write_docx(path, "Suite", text, text, {})
+    return lambda: core.read_docx(path)
+
+
+@case(sizes=(10, 100, 1000), threshold=1.5, repeat=3)
+def case_generate(size):
+    '''ai_generate from the menu to the filled in mad lib, with a stub client'''
+    from unittest import mock
+    from PyQt6.QtWidgets import QInputDialog
+    import mad_libs
+    from generation_cache import GenerationCache
+    window = _window()
+    window.client = SlowClient(delay=0.0, blanks=size, valid_every=1)
+    window.cache = GenerationCache(os.path.join(tempfile.mkdtemp(), "suite.sqlite3"))
+    done = []
+    finish = window.ai_generate_done
+
+    def ai_generate_done(*args):
+        finish(*args)
+        done.append(True)
+    window.ai_generate_done = ai_generate_done
+
+    def generate():
+        done.clear()
+        answers = iter([("Suite", True), (str(size), True)])
+        with mock.patch.object(QInputDialog, "getText", lambda *args: next(answers)), \
+                mock.patch.object(mad_libs.FillDialog, "exec", lambda dialog: 1):
+            window.ai_generate()
+            while not done:
+                _app.processEvents()
+                time.sleep(0.001)
+    return generate
+
+
+def run_suite(names=None, sizes=None):
+    '''
+    Function to run suite cases. Returns {"case/size": {"best": s, "median": s}}.
+
+    Keyword arguments:
+    names -- cases to run, all if None (list)
+    sizes -- only run these numbers of prompts (list)
+    '''
+    results = {}
+    for name in names or list(CASES):
+        func, case_sizes, _, repeat = CASES[name]
+        for size in case_sizes:
+            if sizes and size not in sizes:
+                continue
+            call = func(size)
+            times = []
+            for _ in range(repeat):
+                start = time.perf_counter()
+                call()
+                times.append(time.perf_counter() - start)
+            results[f"{name}/{size}"] = {"best": min(times), "median": statistics.median(times)}
+            print(f"suite   {name + '/' + str(size):<22} best={min(times) * 1e3:10.3f}ms"
+                  f"  median={statistics.median(times) * 1e3:10.3f}ms", flush=True)
+    return results
+
+
+def _commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True,
+                              text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def compare(results, baseline, threshold=None):
+    '''
+    Function to print how results compare to a saved baseline. Returns the
+    cases which got slower than their threshold allows.
+
+    Keyword arguments:
+    results -- results from run_suite (dict)
+    baseline -- results loaded from a saved file (dict)
+    threshold -- slow down factor for every case, defaults to each case's own (float)
+    '''
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        old, new = baseline[key]["best"], result["best"]
+        limit = threshold or CASES[key.split("/")[0]][2]
+        ratio = new / old if old else float("inf")
+        regressed = ratio > limit and new - old > NOISE_FLOOR
+        if regressed:
+            regressions.append(key)
+        print(f"compare {key:<22} {old * 1e3:10.3f}ms -> {new * 1e3:10.3f}ms  x{ratio:5.2f}"
+              + ("  REGRESSION" if regressed else ""))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="mad lib benchmarks")
+    parser.add_argument("names", nargs="*", help="benchmarks, or suite cases with --suite")
+    parser.add_argument("--suite", action="store_true", help="run the suite instead")
+    parser.add_argument("--sizes", help="comma separated numbers of prompts, e.g. 10,1000")
+    parser.add_argument("--save", nargs="?", const="", metavar="FILE",
+                        help="save suite results as JSON (default: benchmark_results/<commit>.json)")
+    parser.add_argument("--compare", metavar="FILE", help="saved results to compare with")
+    parser.add_argument("--threshold", type=float,
+                        help=f"slow down factor counted as a regression (default: {THRESHOLD})")
+    args = parser.parse_args(argv)
+    if not args.suite:
+        for name in args.names or list(BENCHMARKS):
+            BENCHMARKS[name]()
+        return
+
+    sizes = [int(size) for size in args.sizes.split(",")] if args.sizes else None
+    results = run_suite(args.names, sizes)
+    commit = _commit()
+    if args.save is not None:
+        path = args.save or os.path.join(RESULTS_DIR, commit + ".json")
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        with open(path, "w", encoding="utf-8") as file:
+            json.dump({"commit": commit, "time": time.time(), "python": platform.python_version(),
+                       "machine": platform.platform(), "results": results}, file, indent=1)
+        print(f"saved {path}")
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as file:
+            baseline = json.load(file)
+        regressions = compare(results, baseline["results"], args.threshold)
+        if regressions:
+            raise SystemExit(f"{len(regressions)} regression(s) against {baseline['commit']}: "
+                             + ", ".join(regressions))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,257 @@
+'''
+Qt-free mad lib logic shared by the GUI and the batch command line:
+prompt numbering, filling in templates, docx import/export and a streaming
+process-pool renderer for template x answer set combinations.
+'''
+import os
+from collections import deque
+from template import Template, compile_template
+import template_file
+import profiling
+
+
+def prompt_name(prompt, existing_count):
+    '''
+    Function to number a new prompt after the ones already in the text
+
+    Keyword arguments:
+    prompt -- prompt type, e.g. Noun (str)
+    existing_count -- number of prompts already in the text (int)
+    '''
+    return prompt + str(existing_count + 1)
+
+
+def fill(text, answers):
+    '''
+    Function to fill in the prompts of a mad lib
+
+    Keyword arguments:
+    text -- mad lib text with [Type N] prompts (str)
+    answers -- map of prompt name to answer (dict)
+    '''
+    return compile_template(text).render(answers)
+
+
+def filled_parts(template, answers):
+    '''
+    Function to split a filled in mad lib into (text, is answer) parts, so
+    the answers can be shown differently from the rest of the text.
+    Placeholders without an answer are left as they are.
+
+    Keyword arguments:
+    template -- compiled mad lib (Template)
+    answers -- map of placeholder name to answer (dict)
+    '''
+    segments = template.filled_segments(answers)
+    parts = [(segments[0], False)]
+    for name, segment in zip(template.names, segments[1:]):
+        answer = answers.get(name)
+        parts.append((name, False) if answer is None else (answer, True))
+        parts.append((segment, False))
+    return parts
+
+
+def write_docx(path, theme, filled_text, template_text, prompts_dict, answers=None):
+    '''
+    Function to save a mad lib as a Word document holding the filled text
+    and the original text so it can be done again. The answers are bold
+    when they are given and the filled text hasn't been edited since.
+
+    Keyword arguments:
+    path -- file to write, .docx is not added (str)
+    theme -- theme of the mad lib (str)
+    filled_text -- text with the answers filled in (str)
+    template_text -- text with the [Type N] prompts (str)
+    prompts_dict -- map of prompt order to prompt name (dict)
+    answers -- map of prompt name to answer (dict)
+    '''
+    from docx import Document  # slow import, only needed when saving
+    with profiling.timer("docx.write"):
+        document = Document()
+        document.add_heading(theme, level=1)
+        parts = filled_parts(compile_template(template_text), answers) if answers else None
+        if parts and "".join(text for text, _ in parts) == filled_text:
+            paragraph = document.add_paragraph()
+            for text, is_answer in parts:
+                if text:
+                    paragraph.add_run(text).bold = is_answer or None
+        else:
+            document.add_paragraph(filled_text)
+        document.add_paragraph()
+        document.add_heading("Do it again!")
+        document.add_paragraph(template_text)
+        document.add_paragraph(str(prompts_dict))
+        document.save(path)
+
+
+def read_docx(path):
+    '''
+    Function to load a mad lib saved by write_docx. Returns the theme and
+    the text with the prompts, which is empty if none was found.
+    Raises FileNotFoundError if the file is missing or not a Word document.
+
+    Keyword arguments:
+    path -- file to read (str)
+    '''
+    from docx import Document, opc  # slow import, only needed when opening
+    try:
+        with profiling.timer("docx.read"):
+            document = Document(path)
+    except opc.exceptions.PackageNotFoundError as e:
+        raise FileNotFoundError(str(e)) from e
+    theme = document.paragraphs[0].text if document.paragraphs else ""
+    template_text = ""
+    text_to_grab = False
+    # loop through paragraphs and find do it over text
+    for paragraph in document.paragraphs:
+        if paragraph.text == "":
+            pass
+        elif paragraph.text.upper() == "DO IT AGAIN!":
+            # next loop contains text to grab
+            text_to_grab = True
+        elif paragraph.text[0] == "{":
+            text_to_grab = False
+        elif text_to_grab:
+            template_text = paragraph.text
+    return theme, template_text
+
+
+def write_template(path, theme, template_text, answers):
+    '''
+    Function to save a mad lib in the native .madlib format
+
+    Keyword arguments:
+    path -- file to write (str)
+    theme -- theme of the mad lib (str)
+    template_text -- text with the [Type N] prompts (str)
+    answers -- map of prompt name to answer, may be empty (dict)
+    '''
+    record = template_file.TemplateRecord(theme, template_text, answers)
+    with profiling.timer("madlib.write"):
+        template_file.save_templates(path, [record])
+
+
+def read_mad_lib(path):
+    '''
+    Function to load a mad lib saved as .madlib or .docx. Returns the theme
+    and the text with the prompts. Raises FileNotFoundError if the file is
+    missing and ValueError if it can't be read.
+
+    Keyword arguments:
+    path -- file to read (str)
+    '''
+    if not path.endswith(template_file.EXTENSION):
+        return read_docx(path)
+    with profiling.timer("madlib.read"), template_file.TemplateFile(path) as templates:
+        if len(templates) == 0:
+            raise ValueError(path + " has no mad libs in it")
+        record = templates[0]
+    return record.theme, record.text
+
+
+###################################################
+# Batch rendering
+###################################################
+
+_batch_templates = {}  # template id -> (theme, text), set in each worker
+_batch_compiled = {}
+_batch_parse = None
+_batch_format = None
+_batch_render = None
+
+
+def _init_batch_worker(templates, parse, format_row, render=None):
+    global _batch_templates, _batch_compiled, _batch_parse, _batch_format, _batch_render
+    _batch_templates = templates
+    _batch_compiled = {}
+    _batch_parse = parse
+    _batch_format = format_row
+    _batch_render = render
+
+
+def _render_chunk(chunk):
+    '''
+    Function to render a chunk of answer sets inside a worker. Answer sets
+    without a template id are rendered against every template. Returns
+    (rows, (answer set id, template id) of the answer sets whose template
+    id is unknown, which are skipped).
+
+    Keyword arguments:
+    chunk -- list of answer set records (list)
+    '''
+    rows, skipped = [], []
+    for record in chunk:
+        answers_id, template_id, answers = _batch_parse(record) if _batch_parse else record
+        if template_id is not None and template_id not in _batch_templates:
+            skipped.append((answers_id, template_id))
+            continue
+        template_ids = [template_id] if template_id is not None else _batch_templates
+        for tid in template_ids:
+            theme, text = _batch_templates[tid]
+            template = _batch_compiled.get(tid)
+            if template is None:
+                template = _batch_compiled[tid] = Template(text)
+            story = _batch_render(template, answers) if _batch_render else template.render(answers)
+            row = {"template": tid, "answers": answers_id, "theme": theme, "story": story}
+            rows.append(_batch_format(row) if _batch_format else row)
+    return rows, skipped
+
+
+def _chunks(answer_sets, chunk_size):
+    chunk = []
+    for answer_set in answer_sets:
+        chunk.append(answer_set)
+        if len(chunk) == chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def render_batch(templates, answer_sets, workers=None, chunk_size=256,
+                 parse=None, format_row=None, render=None, skipped=None):
+    '''
+    Function to render answer sets against templates across a process pool.
+    The answer sets are read lazily and only a few chunks are in flight at
+    once, so memory stays flat however long the input is. Yields one dict
+    per story (or whatever format_row returns), in input order.
+
+    Keyword arguments:
+    templates -- map of template id to (theme, text) (dict)
+    answer_sets -- iterable of (answer set id, template id or None, answers),
+                   or of raw records when parse is given
+    workers -- number of processes, defaults to the number of cores (int)
+    chunk_size -- answer sets sent to a worker at a time (int)
+    parse -- module level function run in the workers to turn a raw record
+             into (answer set id, template id or None, answers)
+    format_row -- module level function run in the workers on each story dict
+    render -- module level function run in the workers to turn a Template and
+              answers into the story, Template.render by default
+    skipped -- list the (answer set id, template id) of answer sets naming
+               a template which isn't in templates are added to. They are
+               left out instead of stopping the batch.
+    '''
+    from concurrent.futures import ProcessPoolExecutor  # not needed by the GUI
+    if skipped is None:
+        skipped = []
+    workers = workers or os.cpu_count() or 1
+    if workers == 1:
+        _init_batch_worker(templates, parse, format_row, render)
+        for chunk in _chunks(answer_sets, chunk_size):
+            rows, chunk_skipped = _render_chunk(chunk)
+            skipped += chunk_skipped
+            yield from rows
+        return
+    with ProcessPoolExecutor(workers, initializer=_init_batch_worker,
+                             initargs=(templates, parse, format_row, render)) as executor:
+        in_flight = deque()
+        for chunk in _chunks(answer_sets, chunk_size):
+            in_flight.append(executor.submit(_render_chunk, chunk))
+            if len(in_flight) >= 2 * workers:
+                rows, chunk_skipped = in_flight.popleft().result()
+                skipped += chunk_skipped
+                yield from rows
+        while in_flight:
+            rows, chunk_skipped = in_flight.popleft().result()
+            skipped += chunk_skipped
+            yield from rows
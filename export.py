@@ -0,0 +1,213 @@
+'''
+Bulk export of filled in mad libs to Word documents, e.g. for printed
+booklets of hundreds of stories.
+
+Stories are rendered across a process pool (core.render_batch) straight
+into WordprocessingML with the answers in bold runs, instead of building a
+python-docx Document for each one. A booklet is a single .docx whose
+word/document.xml is streamed into the zip a chunk of stories at a time,
+with a page break between stories, so memory stays flat however many
+there are. A directory export has every worker write its own .docx files,
+laid out like the ones saved from the app so they can be opened again.
+
+The styles and theme are taken from python-docx's default template, so
+the documents look the same as the ones core.write_docx saves.
+'''
+import os
+import re
+import zipfile
+import importlib.util
+from functools import lru_cache, partial
+from xml.sax.saxutils import escape
+import core
+import profiling
+
+STYLES = (b"Normal", b"DefaultParagraphFont", b"TableNormal", b"NoList",
+          b"Heading1", b"Heading1Char")  # all the documents use
+INVALID_XML = re.compile("[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]")
+UNSAFE_NAME = re.compile(r"[^\w.-]+")
+
+CONTENT_TYPES = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+    b'<Default Extension="xml" ContentType="application/xml"/>'
+    b'<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+    b'<Override PartName="/word/document.xml" ContentType="application/'
+    b'vnd.openxmlformats-officedocument.wordprocessingml.document.main+xml"/>'
+    b'<Override PartName="/word/styles.xml" ContentType="application/'
+    b'vnd.openxmlformats-officedocument.wordprocessingml.styles+xml"/>'
+    b'<Override PartName="/word/theme/theme1.xml" ContentType="application/'
+    b'vnd.openxmlformats-officedocument.theme+xml"/>'
+    b'</Types>')
+PACKAGE_RELS = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    b'<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+    b'relationships/officeDocument" Target="word/document.xml"/>'
+    b'</Relationships>')
+DOCUMENT_RELS = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+    b'<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+    b'relationships/styles" Target="styles.xml"/>'
+    b'<Relationship Id="rId2" Type="http://schemas.openxmlformats.org/officeDocument/2006/'
+    b'relationships/theme" Target="theme/theme1.xml"/>'
+    b'</Relationships>')
+DOCUMENT_START = (
+    b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>\n'
+    b'<w:document xmlns:w="http://schemas.openxmlformats.org/wordprocessingml/2006/main" '
+    b'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships"><w:body>')
+DOCUMENT_END = (
+    b'<w:sectPr><w:pgSz w:w="12240" w:h="15840"/><w:pgMar w:top="1440" w:right="1800" '
+    b'w:bottom="1440" w:left="1800" w:header="720" w:footer="720" w:gutter="0"/>'
+    b'<w:cols w:space="720"/></w:sectPr></w:body></w:document>')
+PAGE_BREAK = b'<w:p><w:r><w:br w:type="page"/></w:r></w:p>'
+
+
+@lru_cache(maxsize=None)
+def _template_parts():
+    '''
+    Function to read the styles and theme of python-docx's default
+    template, keeping only the styles used. Found without importing docx,
+    which is slow to import in every worker.
+    '''
+    spec = importlib.util.find_spec("docx")
+    if spec is None or not spec.submodule_search_locations:
+        raise ImportError("python-docx is needed to export Word documents")
+    path = os.path.join(spec.submodule_search_locations[0], "templates", "default.docx")
+    with zipfile.ZipFile(path) as default:
+        styles = default.read("word/styles.xml")
+        theme = default.read("word/theme/theme1.xml")
+    root = re.search(rb"<w:styles[^>]*>", styles).group()
+    defaults = re.search(rb"<w:docDefaults>.*?</w:docDefaults>", styles, re.S).group()
+    kept = [match.group() for match in re.finditer(rb"<w:style [^>]*>.*?</w:style>", styles, re.S)
+            if re.search(rb'w:styleId="([^"]*)"', match.group()).group(1) in STYLES]
+    styles = styles[:styles.index(root)] + root + defaults + b"".join(kept) + b"</w:styles>"
+    return (("[Content_Types].xml", CONTENT_TYPES), ("_rels/.rels", PACKAGE_RELS),
+            ("word/_rels/document.xml.rels", DOCUMENT_RELS), ("word/styles.xml", styles),
+            ("word/theme/theme1.xml", theme))
+
+
+def run(text, bold=False):
+    '''
+    Function to make a run of text, keeping line breaks and tabs
+
+    Keyword arguments:
+    text -- text of the run (str)
+    bold -- True to make the run bold (bool)
+    '''
+    if not text:
+        return ""
+    text = escape(INVALID_XML.sub("", text))
+    if "\n" in text or "\t" in text:
+        text = (text.replace("\r\n", "\n").replace("\n", '</w:t><w:br/><w:t xml:space="preserve">')
+                .replace("\t", '</w:t><w:tab/><w:t xml:space="preserve">'))
+    return ('<w:r><w:rPr><w:b/></w:rPr>' if bold else '<w:r>') + \
+        '<w:t xml:space="preserve">' + text + '</w:t></w:r>'
+
+
+def paragraph(runs, style=None):
+    '''
+    Function to make a paragraph out of runs
+
+    Keyword arguments:
+    runs -- runs made with run (str)
+    style -- paragraph style id, e.g. Heading1 (str)
+    '''
+    if style:
+        return '<w:p><w:pPr><w:pStyle w:val="' + style + '"/></w:pPr>' + runs + '</w:p>'
+    return '<w:p>' + runs + '</w:p>'
+
+
+def render_story(template, answers):
+    '''Function run in the workers to turn a filled in mad lib into runs, answers in bold'''
+    return "".join(run(text, is_answer) for text, is_answer in core.filled_parts(template, answers))
+
+
+def render_saved_story(template, answers):
+    '''Function run in the workers to render a story along with its template'''
+    return render_story(template, answers), template.text, dict(enumerate(template.names))
+
+
+def format_booklet_story(row):
+    '''Function run in the workers to make the paragraphs of a story in a booklet'''
+    return (paragraph(run(row["theme"]), "Heading1") + paragraph(row["story"])).encode("utf-8")
+
+
+def write_package(package, document):
+    '''
+    Function to add the parts of a Word document to a zip file
+
+    Keyword arguments:
+    package -- zip file open for writing (zipfile.ZipFile)
+    document -- contents of word/document.xml, or None to write it after (bytes)
+    '''
+    for name, data in _template_parts():
+        package.writestr(name, data)
+    if document is not None:
+        package.writestr("word/document.xml", document)
+
+
+def write_story_document(directory, row):
+    '''
+    Function run in the workers to save one story as its own Word document,
+    laid out like core.write_docx. Returns the size of the file.
+
+    Keyword arguments:
+    directory -- folder to write into (str)
+    row -- story dict from core.render_batch, rendered with render_saved_story (dict)
+    '''
+    story, template_text, prompts = row["story"]
+    body = (paragraph(run(row["theme"]), "Heading1") + paragraph(story) + paragraph("")
+            + paragraph(run("Do it again!"), "Heading1") + paragraph(run(template_text))
+            + paragraph(run(str(prompts))))
+    name = UNSAFE_NAME.sub("_", f"{row['template']}-{row['answers']}") + ".docx"
+    path = os.path.join(directory, name)
+    with zipfile.ZipFile(path, "w", zipfile.ZIP_DEFLATED) as package:
+        write_package(package, DOCUMENT_START + body.encode("utf-8") + DOCUMENT_END)
+    return os.path.getsize(path)
+
+
+def export_stories(templates, answer_sets, output, workers=None, chunk_size=64, parse=None,
+                   skipped=None):
+    '''
+    Function to fill in answer sets and write them to Word documents across
+    a process pool. Output ending in .docx is a single booklet with one
+    story per page, anything else is a folder with a document per story.
+    Returns (number of stories, bytes of document XML or of files written).
+
+    Keyword arguments:
+    templates -- map of template id to (theme, text) (dict)
+    answer_sets -- iterable of answer set records, as for core.render_batch
+    output -- .docx file or folder to write (str)
+    workers -- number of processes, defaults to the number of cores (int)
+    chunk_size -- answer sets sent to a worker at a time (int)
+    parse -- module level function turning a raw record into
+             (answer set id, template id or None, answers)
+    skipped -- list answer sets with an unknown template id are added to,
+               as for core.render_batch
+    '''
+    _template_parts()  # fail before starting workers if python-docx is missing
+    count = size = 0
+    with profiling.timer("export.write"):
+        if not output.lower().endswith(".docx"):
+            os.makedirs(output, exist_ok=True)
+            for size_written in core.render_batch(templates, answer_sets, workers, chunk_size, parse,
+                                                  partial(write_story_document, output),
+                                                  render_saved_story, skipped):
+                count += 1
+                size += size_written
+            return count, size
+        with zipfile.ZipFile(output, "w", zipfile.ZIP_DEFLATED) as package:
+            write_package(package, None)
+            with package.open("word/document.xml", "w", force_zip64=True) as document:
+                document.write(DOCUMENT_START)
+                for story in core.render_batch(templates, answer_sets, workers, chunk_size, parse,
+                                               format_booklet_story, render_story, skipped):
+                    if count:
+                        document.write(PAGE_BREAK)
+                    document.write(story)
+                    count += 1
+                    size += len(story)
+                document.write(DOCUMENT_END)
+    return count, size
@@ -0,0 +1,160 @@
+'''
+Qt-free state for filling in a mad lib: one answer per unique prompt name
+and the story text kept in step with the answers. Changing an answer
+returns the small text edits needed to update a displayed copy of the
+story, so views never have to re-render the whole thing.
+'''
+from template import compile_template, with_article
+from tokenizer import prompt_type
+import inputs_file
+
+
+def article(type_name):
+    '''Return "an" for the prompt types in inputs_file.an_list, else "a"'''
+    return "an" if type_name in inputs_file.an_list else "a"
+
+
+def label(name):
+    '''Return the question asked for a prompt name, e.g. "Enter an Adjective:"'''
+    type_name = prompt_type(name)
+    return "Enter " + article(type_name) + " " + type_name + ":"
+
+
+class _LengthTree:
+    '''Fenwick tree over part lengths for O(log n) offset lookups'''
+
+    def __init__(self, lengths):
+        self.size = len(lengths)
+        self.tree = [0] * (self.size + 1)
+        for i, length in enumerate(lengths, 1):
+            self.tree[i] += length
+            parent = i + (i & -i)
+            if parent <= self.size:
+                self.tree[parent] += self.tree[i]
+
+    def add(self, index, delta):
+        index += 1
+        while index <= self.size:
+            self.tree[index] += delta
+            index += index & -index
+
+    def prefix(self, index):
+        '''Total length of the parts before index'''
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+
+class FillSession:
+    '''
+    Answers for the prompts of one mad lib. Prompts which appear more than
+    once share an answer. Unanswered prompts show their name.
+    '''
+
+    def __init__(self, text, answers=None):
+        '''
+        Keyword arguments:
+        text -- mad lib text with [Type N] prompts (str)
+        answers -- answers to start with, by prompt name (dict)
+        '''
+        self.template = compile_template(text)
+        self.names = list(dict.fromkeys(self.template.names))  # one row per name
+        self.answers = {}
+        # parts alternate literal segments and prompt slots: slot i is part 2i+1
+        self.parts = [None] * (2 * len(self.template.segments) - 1)
+        self.parts[::2] = self.template.segments
+        self.parts[1::2] = self.template.names
+        self.articles = {2 * i + 1: start for i, start in self.template.articles}  # slot -> article
+        self.slots = {}
+        for i, name in enumerate(self.template.names):
+            self.slots.setdefault(name, []).append(2 * i + 1)
+        self.lengths = _LengthTree([len(part) for part in self.parts])
+        for name, answer in (answers or {}).items():
+            self.set_answer(name, answer)
+
+    def __len__(self):
+        return len(self.names)
+
+    def label(self, row):
+        '''Return the question asked for a row, e.g. "Enter an Adjective:"'''
+        return label(self.names[row])
+
+    def answer(self, row):
+        return self.answers.get(self.names[row], "")
+
+    def set_answer(self, name, answer):
+        '''
+        Function to change the answer for a prompt. Returns the edits to the
+        story as (offset, old length, new text), to be applied one after the
+        other in the order given. An empty answer shows the prompt again.
+
+        Keyword arguments:
+        name -- prompt name (str)
+        answer -- answer text (str)
+        '''
+        if answer:
+            self.answers[name] = answer
+        else:
+            self.answers.pop(name, None)
+            answer = name
+        edits = []
+        for part in reversed(self.slots.get(name, ())):
+            old_length = len(self.parts[part])
+            if self.parts[part] == answer:
+                continue
+            edits.append((self.lengths.prefix(part), old_length, answer))
+            self.lengths.add(part, len(answer) - old_length)
+            self.parts[part] = answer
+            if part in self.articles:
+                # the "a" or "an" before the slot follows the answer, or goes back as written
+                start = self.articles[part]
+                segment = self.parts[part - 1]
+                if name in self.answers:
+                    segment = with_article(segment, start, answer)
+                else:
+                    segment = segment[:start] + self.template.segments[part // 2][start:]
+                old_length = len(self.parts[part - 1])
+                if segment != self.parts[part - 1]:
+                    offset = self.lengths.prefix(part - 1) + start
+                    edits.append((offset, old_length - start, segment[start:]))
+                    self.lengths.add(part - 1, len(segment) - old_length)
+                    self.parts[part - 1] = segment
+        return edits
+
+    def paste(self, lines, start_row=0):
+        '''
+        Function to fill several rows at once from a list of answers.
+        Returns the story edits, to be applied in order like set_answer.
+
+        Keyword arguments:
+        lines -- answers in row order (list)
+        start_row -- row the first answer goes in (int)
+        '''
+        edits = []
+        for row, answer in enumerate(lines, start_row):
+            if row >= len(self.names):
+                break
+            edits += self.set_answer(self.names[row], answer.strip())
+        return edits
+
+    def update(self, answers):
+        '''
+        Function to change several answers at once, e.g. ones picked from
+        the word lists. Returns the story edits, to be applied in order like
+        set_answer.
+
+        Keyword arguments:
+        answers -- map of prompt name to answer (dict)
+        '''
+        edits = []
+        for name, answer in answers.items():
+            edits += self.set_answer(name, answer)
+        return edits
+
+    def is_complete(self):
+        return len(self.answers) == len(self.names)
+
+    def render(self):
+        return "".join(self.parts)
@@ -0,0 +1,539 @@
+import os
+import re
+import json
+import time
+import random
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from tokenizer import iter_tokens, count_tokens
+from repair import repair_mad_lib, max_changes
+import inputs_file
+import profiling
+
+# ENTER YOUR OPENAI KEY HERE if it is not in the OPENAI_API_KEY environment variable
+API_KEY = ''
+MODEL = "gpt-4"
+TEMPERATURE = 0.2
+# completion tokens asked for: enough JSON and words around each blank, with room to spare
+BASE_TOKENS = 64
+TOKENS_PER_BLANK = 24
+MAX_TOKENS = 4096
+REPAIR = True  # fix replies a few prompts off locally instead of asking again
+# prompt types ChatGPT is allowed to use, the ones the app has buttons for
+PROMPT_TYPES = [value for value in inputs_file.inputs.values() if value != "Custom"]
+JSON_FIELD = "mad_lib"  # replies are {"mad_lib": "<paragraph>"}
+# models which don't take response_format, so only the prompt asks for JSON
+PLAIN_TEXT_MODELS = {"gpt-4", "gpt-4-0314", "gpt-4-0613", "gpt-4-32k", "gpt-3.5-turbo-0613"}
+SYSTEM_PROMPT = (
+    "You write one-paragraph Mad Libs. Reply with JSON: {\"" + JSON_FIELD + "\": \"<paragraph>\"}. "
+    "Mark each fill-in-the-blank in square brackets with its type and a number, counting up "
+    "from 1 in order and never reusing a number, e.g. [Adjective1] [Noun2] [Adjective3]. "
+    "Types: " + ", ".join(PROMPT_TYPES) + ". "
+    "Use exactly the number of blanks asked for.")
+
+
+class GenerationCancelled(Exception):
+    '''Raised when the user cancels a generation in progress'''
+
+
+class GenerationFailed(Exception):
+    '''Raised when no paragraph with the right number of prompts came back'''
+
+    def __init__(self, message, error=None):
+        super().__init__(message)
+        self.error = error  # last exception raised by the client, if any
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    '''
+    Function to create the OpenAI client the first time it is needed.
+    openai (and httpx under it) is only imported here because it is the
+    slowest part of starting the app.
+    '''
+    global _client
+    with _client_lock:
+        if _client is None:
+            import openai
+            _client = openai.OpenAI(api_key=os.environ.get("OPENAI_API_KEY") or API_KEY or None)
+        return _client
+
+
+def build_prompt(theme, number_of_blanks):
+    '''
+    Function to build the chat messages asking for a one-paragraph mad lib.
+    The instructions are the same for every request, only the short user
+    message changes.
+
+    Keyword arguments:
+    theme -- theme of the mad lib (str)
+    number_of_blanks -- number of fill-in-the-blanks to ask for (int)
+    '''
+    return [{"role": "system", "content": SYSTEM_PROMPT},
+            {"role": "user", "content": f"Theme: {theme}\nBlanks: exactly {number_of_blanks}"}]
+
+
+def max_tokens_for(number_of_blanks):
+    '''Completion tokens to allow for a mad lib with number_of_blanks prompts'''
+    return min(MAX_TOKENS, BASE_TOKENS + TOKENS_PER_BLANK * number_of_blanks)
+
+
+def estimate_tokens(text):
+    '''Rough token count of text, for when the server doesn't report usage'''
+    return len(text) // 4 + 1
+
+
+def request_options(model, number_of_blanks, stream=False):
+    '''
+    Function to build the chat.completions.create arguments other than the
+    messages: a completion budget sized to the number of blanks, JSON mode
+    where the model has it, and usage on the last chunk of a stream
+    '''
+    options = {"model": model, "temperature": TEMPERATURE,
+               "max_tokens": max_tokens_for(number_of_blanks)}
+    if model not in PLAIN_TEXT_MODELS:
+        options["response_format"] = {"type": "json_object"}
+    if stream:
+        options["stream"] = True
+        options["stream_options"] = {"include_usage": True}
+    return options
+
+
+def first_paragraph(response_content):
+    '''Strip everything after the first line of a model response'''
+    return re.sub(r'\n.*', '', response_content).strip()
+
+
+def parse_reply(response_content):
+    '''
+    Function to get the mad lib out of a reply: the mad_lib field of a JSON
+    reply, or the first paragraph of a plain text one. Returns "" when the
+    JSON doesn't parse, e.g. when the reply ran out of tokens.
+    '''
+    text = (response_content or "").strip()
+    if text.startswith("```"):  # fenced, ```json ... ```
+        text = text.strip("`").strip()
+        if text.startswith("json"):
+            text = text[4:].lstrip()
+    if not text.startswith("{"):
+        return first_paragraph(text)
+    try:
+        value = json.loads(text).get(JSON_FIELD)
+    except (ValueError, AttributeError):
+        return ""
+    return first_paragraph(value) if isinstance(value, str) else ""
+
+
+class JSONFieldScanner:
+    '''
+    Decodes the mad_lib string of a streamed JSON reply as chunks arrive,
+    so the paragraph can be shown and counted before the reply is done.
+    Replies which aren't JSON are passed through as they are.
+    '''
+    # a run of plain characters or one whole escape, stopping at the closing quote
+    TOKEN = re.compile(r'[^"\\]+|\\u[0-9a-fA-F]{4}|\\[^u]')
+
+    def __init__(self):
+        self.buffer = ""
+        self.state = "start"  # then "value", "plain" or "ended"
+
+    def feed(self, chunk):
+        '''
+        Function to add streamed text. Returns the newly decoded part of the
+        mad lib.
+
+        Keyword arguments:
+        chunk -- newly streamed text (str)
+        '''
+        if self.state == "plain":
+            return chunk
+        if self.state == "ended":
+            return ""
+        self.buffer += chunk
+        if self.state == "start":
+            start = self.buffer.lstrip().lstrip("`")  # may be fenced, ```json
+            if not start:
+                return ""
+            if start[0] != "{" and not "json".startswith(start[:4]):
+                self.state = "plain"
+                text, self.buffer = self.buffer, ""
+                return text
+            field = re.search(r'"' + JSON_FIELD + r'"\s*:\s*"', self.buffer)
+            if field is None:
+                return ""
+            self.buffer = self.buffer[field.end():]
+            self.state = "value"
+        end = 0
+        last = None
+        for match in self.TOKEN.finditer(self.buffer):
+            if match.start() != end:
+                break
+            end = match.end()
+            last = match.group()
+        if end < len(self.buffer) and self.buffer[end] == '"':
+            self.state = "ended"
+        elif last is not None and re.fullmatch(r'\\u[dD][89abAB][0-9a-fA-F]{2}', last):
+            end -= 6  # keep the first half of a surrogate pair for the second
+        text = json.loads('"' + self.buffer[:end] + '"')
+        self.buffer = self.buffer[end:]
+        return text
+
+
+class PlaceholderScanner:
+    '''
+    Counts the placeholders of the first paragraph of a streamed reply as
+    chunks arrive. Only the text after the last unmatched "[" is scanned
+    again, since a placeholder can't contain a bracket.
+    '''
+
+    def __init__(self):
+        self.text = ""  # first paragraph so far
+        self.count = 0
+        self.ended = False  # set once the first paragraph is complete
+        self._scan_from = 0
+
+    def feed(self, chunk):
+        '''
+        Function to add streamed text. Returns the part of chunk which
+        belongs to the first paragraph.
+
+        Keyword arguments:
+        chunk -- newly streamed text (str)
+        '''
+        if self.ended or not chunk:
+            return ""
+        newline = chunk.find("\n")
+        while newline >= 0 and not (self.text + chunk[:newline]).strip():
+            # newlines before any text don't end the paragraph
+            newline = chunk.find("\n", newline + 1)
+        if newline >= 0:
+            chunk = chunk[:newline]
+            self.ended = True
+        self.text += chunk
+        last_end = self._scan_from
+        for token in iter_tokens(self.text, self._scan_from):
+            self.count += 1
+            last_end = token.span[1]
+        bracket = self.text.rfind("[", last_end)
+        self._scan_from = bracket if bracket >= 0 else len(self.text)
+        return chunk
+
+
+class Attempt:
+    '''Outcome and latency of a single request to the model'''
+
+    def __init__(self, number):
+        self.number = number
+        self.latency = 0.0  # seconds
+        self.paragraph = ""
+        self.valid = False
+        self.error = None
+        self.aborted = False  # streamed reply stopped early
+        self.first_text = None  # seconds until the first streamed text
+        self.prompt_tokens = None  # from the reply's usage, estimated when the server doesn't send it
+        self.completion_tokens = None
+        self.tokens_estimated = False
+        self.max_tokens = None  # completion budget asked for
+        self.truncated = False  # the reply ran out of tokens
+        self.provider = None  # name of the provider which made the request
+        self.repair = None  # repair.Repair when the reply was fixed up locally
+
+    def __repr__(self):
+        return (f"Attempt({self.number}, latency={self.latency:.3f}, "
+                f"valid={self.valid}, error={self.error!r})")
+
+
+def request_mad_lib(client, prompt, number_of_blanks, number=1, model=MODEL):
+    '''
+    Function to make one request and check the prompt count of the reply.
+    Client errors are recorded on the returned Attempt instead of raised.
+
+    Keyword arguments:
+    client -- OpenAI style client with chat.completions.create
+    prompt -- messages from build_prompt (list)
+    number_of_blanks -- number of fill-in-the-blanks asked for (int)
+    number -- attempt number for reporting (int)
+    model -- model name (str)
+    '''
+    attempt = Attempt(number)
+    options = request_options(model, number_of_blanks)
+    attempt.max_tokens = options["max_tokens"]
+    content = ""
+    start = time.perf_counter()
+    try:
+        chat_completion = client.chat.completions.create(messages=prompt, **options)
+        choice = chat_completion.choices[0]
+        content = choice.message.content or ""
+        attempt.truncated = getattr(choice, "finish_reason", None) == "length"
+        attempt.paragraph = parse_reply(content)
+        check_prompt_count(attempt, number_of_blanks)
+        record_usage(attempt, getattr(chat_completion, "usage", None))
+    except Exception as e:
+        attempt.error = e
+    attempt.latency = time.perf_counter() - start
+    estimate_usage(attempt, prompt, content)
+    record_attempt(attempt)
+    return attempt
+
+
+def stream_mad_lib_request(client, prompt, number_of_blanks, number=1, on_text=None,
+                           cancel_event=None, model=MODEL):
+    '''
+    Function to make one streamed request, passing the first paragraph to
+    on_text as it arrives (decoded from the JSON reply). The stream is
+    closed as soon as a plain text paragraph ends or has more prompts than
+    can be repaired, so no tokens are paid for the rest. Client errors are
+    recorded on the returned Attempt.
+
+    Keyword arguments:
+    client -- OpenAI style client with chat.completions.create
+    prompt -- messages from build_prompt (list)
+    number_of_blanks -- number of fill-in-the-blanks asked for (int)
+    number -- attempt number for reporting (int)
+    on_text -- called with each new piece of the paragraph (str)
+    cancel_event -- set to stop reading the stream (threading.Event)
+    model -- model name (str)
+    '''
+    attempt = Attempt(number)
+    options = request_options(model, number_of_blanks, stream=True)
+    attempt.max_tokens = options["max_tokens"]
+    reply = JSONFieldScanner()
+    scanner = PlaceholderScanner()
+    received = []
+    start = time.perf_counter()
+    stream = None
+    most = number_of_blanks + (max_changes(number_of_blanks) if REPAIR else 0)
+    try:
+        stream = client.chat.completions.create(messages=prompt, **options)
+        for chunk in stream:
+            record_usage(attempt, getattr(chunk, "usage", None))
+            if not chunk.choices:
+                continue
+            choice = chunk.choices[0]
+            if getattr(choice, "finish_reason", None) == "length":
+                attempt.truncated = True
+            content = choice.delta.content or ""
+            received.append(content)
+            text = scanner.feed(reply.feed(content))
+            if reply.state == "ended" and not scanner.ended:
+                scanner.ended = True  # the JSON string is the whole paragraph
+            if text:
+                if attempt.first_text is None:
+                    attempt.first_text = time.perf_counter() - start
+                if on_text is not None:
+                    on_text(text)
+            # once the JSON string is done only its end and the usage are left to read
+            if (scanner.ended and reply.state != "ended") or scanner.count > most or (
+                    cancel_event is not None and cancel_event.is_set()):
+                attempt.aborted = not scanner.ended
+                break
+        attempt.paragraph = scanner.text.strip()
+        if scanner.ended or not attempt.aborted:
+            check_prompt_count(attempt, number_of_blanks)
+    except Exception as e:
+        attempt.error = e
+    finally:
+        if stream is not None and hasattr(stream, "close"):
+            stream.close()
+    attempt.latency = time.perf_counter() - start
+    estimate_usage(attempt, prompt, "".join(received))
+    record_attempt(attempt)
+    return attempt
+
+
+def check_prompt_count(attempt, number_of_blanks):
+    '''
+    Function to check an attempt's paragraph has the right number of
+    prompts, repairing it when it is close enough (see repair.py)
+    '''
+    count = count_tokens(attempt.paragraph)
+    attempt.valid = count == number_of_blanks
+    if not REPAIR:
+        return
+    repaired = repair_mad_lib(attempt.paragraph, number_of_blanks)
+    if repaired is not None:
+        attempt.paragraph = repaired.text
+        if not attempt.valid:
+            attempt.repair = repaired
+            attempt.valid = True
+
+
+def record_usage(attempt, usage):
+    '''Copy token counts from a reply's usage onto the attempt, if there are any'''
+    if usage is not None:
+        attempt.prompt_tokens = getattr(usage, "prompt_tokens", None)
+        attempt.completion_tokens = getattr(usage, "completion_tokens", None)
+
+
+def estimate_usage(attempt, prompt, content):
+    '''
+    Function to estimate the tokens of a request the server didn't report
+    usage for, so the spend is still counted
+
+    Keyword arguments:
+    attempt -- finished request (Attempt)
+    prompt -- messages sent (list)
+    content -- reply text received, all of it or up to where the stream stopped (str)
+    '''
+    if attempt.prompt_tokens is None:
+        attempt.prompt_tokens = sum(estimate_tokens(message["content"]) + 4 for message in prompt)
+        attempt.tokens_estimated = True
+    if attempt.completion_tokens is None and content:
+        attempt.completion_tokens = estimate_tokens(content)
+        attempt.tokens_estimated = True
+
+
+def record_attempt(attempt):
+    '''Add an attempt's latency, outcome and token usage to the profile'''
+    if not profiling.enabled:
+        return
+    profiling.observe("openai.request", attempt.latency)
+    if attempt.first_text is not None:
+        profiling.observe("openai.first_text", attempt.first_text)
+    profiling.count("openai_requests")
+    if attempt.error is not None:
+        profiling.count("openai_errors")
+    elif not attempt.valid:
+        profiling.count("openai_wrong_prompt_count")
+    elif attempt.repair is not None:
+        profiling.count("openai_repaired")
+    if attempt.aborted:
+        profiling.count("openai_aborted_streams")
+    if attempt.truncated:
+        profiling.count("openai_truncated")
+    if attempt.prompt_tokens:
+        profiling.count("openai_prompt_tokens", attempt.prompt_tokens)
+    if attempt.completion_tokens:
+        profiling.count("openai_completion_tokens", attempt.completion_tokens)
+
+
+def summarize_attempts(attempts):
+    '''Return a one-line latency and success rate report for attempts'''
+    if not attempts:
+        return "No requests made"
+    valid = sum(attempt.valid for attempt in attempts)
+    repaired = sum(attempt.repair is not None for attempt in attempts)
+    latencies = ", ".join(f"{attempt.latency:.1f}s" for attempt in attempts)
+    providers = ", ".join(dict.fromkeys(attempt.provider for attempt in attempts
+                                        if attempt.provider))
+    prompt_tokens = sum(attempt.prompt_tokens or 0 for attempt in attempts)
+    completion_tokens = sum(attempt.completion_tokens or 0 for attempt in attempts)
+    estimated = any(attempt.tokens_estimated for attempt in attempts)
+    return (f"{len(attempts)} request(s), {valid} valid "
+            f"({100 * valid / len(attempts):.0f}%)"
+            + (f", {repaired} repaired locally" if repaired else "")
+            + f", latency {latencies}"
+            + (f", tokens {'~' if estimated else ''}{prompt_tokens}+{completion_tokens}"
+               if prompt_tokens or completion_tokens else "")
+            + (" via " + providers if providers else ""))
+
+
+def generate_mad_lib(client, theme, number_of_blanks, max_retries=3,
+                     backoff=1.0, cancel_event=None, progress=None,
+                     attempts=None, on_text=None, model=MODEL):
+    '''
+    Function to ask the model for a mad lib until it returns a paragraph with
+    exactly the requested number of prompts. Client errors are retried with
+    exponential backoff, wrong prompt counts are repaired when close enough
+    and otherwise retried straight away. Returns the validated paragraph.
+
+    Keyword arguments:
+    client -- OpenAI style client with chat.completions.create
+    theme -- theme of the mad lib (str)
+    number_of_blanks -- number of fill-in-the-blanks to ask for (int)
+    max_retries -- number of requests to make before giving up (int)
+    backoff -- seconds to wait after the first client error (float)
+    cancel_event -- set to stop between attempts (threading.Event)
+    progress -- called with (attempt, max_retries) before each request
+    attempts -- list to record every Attempt in (list)
+    on_text -- stream the reply, calling this with each new piece of text
+    model -- model name (str)
+    '''
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    if attempts is None:
+        attempts = []
+    prompt = build_prompt(theme, number_of_blanks)
+    error = None
+    for number in range(1, max_retries + 1):
+        if cancel_event.is_set():
+            raise GenerationCancelled()
+        if progress is not None:
+            progress(number, max_retries)
+        if number > 1:
+            profiling.count("openai_retries")
+        if on_text is None:
+            attempt = request_mad_lib(client, prompt, number_of_blanks, number, model)
+        else:
+            attempt = stream_mad_lib_request(client, prompt, number_of_blanks, number,
+                                             on_text, cancel_event, model)
+        attempts.append(attempt)
+        if cancel_event.is_set():
+            raise GenerationCancelled()
+        if attempt.valid:
+            if attempt.repair is not None:
+                profiling.count("openai_round_trips_saved")
+            return attempt.paragraph
+        if attempt.error is not None:
+            error = attempt.error
+            if number < max_retries:
+                # full jitter so retries from several windows don't line up
+                delay = random.uniform(0, backoff * 2 ** (number - 1))
+                if cancel_event.wait(delay):
+                    raise GenerationCancelled()
+    raise GenerationFailed("Failed to generate a mad lib correctly. Try again.",
+                           error)
+
+
+def generate_speculative(client, theme, number_of_blanks, parallel=3,
+                         cancel_event=None, progress=None, attempts=None, model=MODEL):
+    '''
+    Function to send several requests at once and keep the first paragraph
+    with the right number of prompts. Requests still waiting to start are
+    cancelled; ones already in flight finish in the background and are
+    ignored. Returns the validated paragraph.
+
+    Keyword arguments:
+    client -- OpenAI style client with chat.completions.create
+    theme -- theme of the mad lib (str)
+    number_of_blanks -- number of fill-in-the-blanks to ask for (int)
+    parallel -- number of requests to race (int)
+    cancel_event -- set to stop waiting for the requests (threading.Event)
+    progress -- called with (finished requests, parallel) as replies arrive
+    attempts -- list to record every finished Attempt in (list)
+    model -- model name (str)
+    '''
+    if cancel_event is None:
+        cancel_event = threading.Event()
+    if attempts is None:
+        attempts = []
+    prompt = build_prompt(theme, number_of_blanks)
+    executor = ThreadPoolExecutor(max_workers=parallel)
+    pending = {executor.submit(request_mad_lib, client, prompt, number_of_blanks, number, model)
+               for number in range(1, parallel + 1)}
+    error = None
+    try:
+        if progress is not None:
+            progress(0, parallel)
+        while pending:
+            done, pending = wait(pending, timeout=0.1, return_when=FIRST_COMPLETED)
+            if cancel_event.is_set():
+                raise GenerationCancelled()
+            for future in done:
+                attempt = future.result()
+                attempts.append(attempt)
+                if progress is not None:
+                    progress(len(attempts), parallel)
+                if attempt.valid:
+                    if attempt.repair is not None:
+                        profiling.count("openai_round_trips_saved")
+                    return attempt.paragraph
+                if attempt.error is not None:
+                    error = attempt.error
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+    raise GenerationFailed("Failed to generate a mad lib correctly. Try again.",
+                           error)
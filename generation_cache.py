@@ -0,0 +1,123 @@
+import os
+import json
+import time
+import random
+import sqlite3
+import hashlib
+import threading
+import generation
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "madlibs",
+                            "generations.sqlite3")
+
+
+def cache_key(theme, number_of_blanks, model=generation.MODEL,
+              temperature=generation.TEMPERATURE,
+              prompt_types=generation.PROMPT_TYPES):
+    '''
+    Function to build the content address of a generation request. Themes
+    are compared without case or surrounding spaces.
+
+    Keyword arguments:
+    theme -- theme of the mad lib (str)
+    number_of_blanks -- number of fill-in-the-blanks (int)
+    model -- model name (str)
+    temperature -- sampling temperature (float)
+    prompt_types -- prompt types the model may use (list)
+    '''
+    request = json.dumps([theme.strip().lower(), int(number_of_blanks), model,
+                          float(temperature), list(prompt_types)])
+    return hashlib.sha256(request.encode("utf-8")).hexdigest()
+
+
+class GenerationCache:
+    '''
+    SQLite cache of validated mad libs. Each key can hold several variants;
+    variants expire after ttl seconds and the least recently used ones are
+    evicted past max_entries. Safe to use from the worker threads.
+    '''
+
+    def __init__(self, path=None, max_entries=1000, ttl=30 * 24 * 3600):
+        '''
+        Keyword arguments:
+        path -- database file, defaults to $MADLIBS_CACHE or ~/.cache/madlibs (str)
+        max_entries -- number of variants kept across all keys (int)
+        ttl -- seconds a variant stays valid (float)
+        '''
+        if path is None:
+            path = os.environ.get("MADLIBS_CACHE", DEFAULT_PATH)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS variants (
+                    digest TEXT PRIMARY KEY,
+                    key TEXT NOT NULL,
+                    paragraph TEXT NOT NULL,
+                    created REAL NOT NULL,
+                    last_used REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS variants_key ON variants (key);
+                CREATE INDEX IF NOT EXISTS variants_last_used ON variants (last_used);
+                CREATE TABLE IF NOT EXISTS counters (
+                    name TEXT PRIMARY KEY,
+                    value INTEGER NOT NULL);
+                INSERT OR IGNORE INTO counters VALUES ('hits', 0), ('misses', 0);
+            ''')
+
+    def get(self, key):
+        '''
+        Function to return a random unexpired variant for a key, or None
+
+        Keyword arguments:
+        key -- key from cache_key (str)
+        '''
+        now = time.time()
+        with self.lock, self.connection:
+            rows = self.connection.execute(
+                "SELECT digest, paragraph FROM variants WHERE key = ? AND created > ?",
+                (key, now - self.ttl)).fetchall()
+            counter = "hits" if rows else "misses"
+            self.connection.execute(
+                "UPDATE counters SET value = value + 1 WHERE name = ?", (counter,))
+            if not rows:
+                return None
+            digest, paragraph = random.choice(rows)
+            self.connection.execute(
+                "UPDATE variants SET last_used = ? WHERE digest = ?", (now, digest))
+        return paragraph
+
+    def put(self, key, paragraph):
+        '''
+        Function to store a validated variant and evict old ones
+
+        Keyword arguments:
+        key -- key from cache_key (str)
+        paragraph -- validated mad lib text (str)
+        '''
+        now = time.time()
+        digest = hashlib.sha256((key + paragraph).encode("utf-8")).hexdigest()
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO variants VALUES (?, ?, ?, ?, ?)",
+                (digest, key, paragraph, now, now))
+            self.connection.execute(
+                "DELETE FROM variants WHERE created <= ?", (now - self.ttl,))
+            self.connection.execute(
+                "DELETE FROM variants WHERE digest IN (SELECT digest FROM variants"
+                " ORDER BY last_used DESC LIMIT -1 OFFSET ?)", (self.max_entries,))
+
+    def stats(self):
+        '''Return hit/miss counters and the number of stored variants (dict)'''
+        with self.lock:
+            stats = dict(self.connection.execute("SELECT name, value FROM counters"))
+            stats["entries"] = self.connection.execute(
+                "SELECT COUNT(*) FROM variants").fetchone()[0]
+        return stats
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
@@ -0,0 +1,244 @@
+'''
+Undo/redo history for the mad lib text kept as a log of small position
+based edits rather than copies of the text. Each edit stores where it
+happened and only the text it removed and added, so a step costs the same
+whatever the length of the story. Typing is merged into one step per word
+and several edits (e.g. filling in every prompt) can be grouped into one.
+'''
+from collections import deque
+from contextlib import contextmanager
+
+MAX_STEPS = 1000
+MAX_TYPING = 64  # characters of typing merged into one step at most
+
+
+def _common_length(matches, limit):
+    '''Largest n <= limit for which matches(n) holds, found by bisection'''
+    low, high = 0, limit
+    while low < high:
+        middle = (low + high + 1) // 2
+        if matches(middle):
+            low = middle
+        else:
+            high = middle - 1
+    return low
+
+
+class Edit:
+    '''Text removed and added at one position'''
+    __slots__ = ("position", "removed", "added")
+
+    def __init__(self, position, removed, added):
+        self.position = position
+        self.removed = removed
+        self.added = added
+
+    def __repr__(self):
+        return f"Edit({self.position}, {self.removed!r}, {self.added!r})"
+
+
+class History:
+    '''
+    Undo and redo stacks of steps, where a step is one Edit or a list of
+    Edits made together. Recording, undo and redo are O(1) amortized and
+    only the newest max_steps steps are kept.
+    '''
+
+    def __init__(self, max_steps=MAX_STEPS):
+        '''
+        Keyword arguments:
+        max_steps -- number of steps which can be undone (int)
+        '''
+        self.undo_steps = deque(maxlen=max_steps)
+        self.redo_steps = []
+        self.grouped = None  # list collecting the edits of an open group
+        self.typing = None  # "insert" or "delete" while typing can be merged
+
+    def __len__(self):
+        return len(self.undo_steps)
+
+    def can_undo(self):
+        return bool(self.undo_steps)
+
+    def can_redo(self):
+        return bool(self.redo_steps)
+
+    def clear(self):
+        self.undo_steps.clear()
+        self.redo_steps.clear()
+        self.typing = None
+
+    def record(self, position, removed, added):
+        '''
+        Function to add an edit to the history, dropping anything that could
+        be redone. The text the two sides have in common is trimmed off, so
+        edits which change nothing aren't recorded.
+
+        Keyword arguments:
+        position -- position of the edit in the text before it (int)
+        removed -- text removed (str)
+        added -- text added in its place (str)
+        '''
+        if removed and added:
+            limit = min(len(removed), len(added))
+            start = _common_length(lambda n: removed.startswith(added[:n]), limit)
+            end = _common_length(lambda n: removed.endswith(added[len(added) - n:]),
+                                 limit - start)
+            if start or end:
+                position += start
+                removed = removed[start:len(removed) - end]
+                added = added[start:len(added) - end]
+        if not removed and not added:
+            return
+        self.redo_steps.clear()
+        if self.grouped is not None:
+            self.grouped.append(Edit(position, removed, added))
+            return
+        if self._merge_typing(position, removed, added):
+            return
+        self.undo_steps.append(Edit(position, removed, added))
+
+    def _merge_typing(self, position, removed, added):
+        '''Merge a typed or deleted character into the last step if it follows on'''
+        last = self.undo_steps[-1] if self.undo_steps else None
+        if len(added) == 1 and not removed and added != "\n":
+            if (self.typing == "insert" and not last.removed
+                    and position == last.position + len(last.added)
+                    and len(last.added) < MAX_TYPING
+                    and not (added.isspace() and not last.added[-1].isspace())):
+                last.added += added
+                return True
+            self.typing = "insert"
+            return False
+        if len(removed) == 1 and not added and removed != "\n":
+            if (self.typing == "delete" and not last.added
+                    and len(last.removed) < MAX_TYPING):
+                if position == last.position - 1:  # backspace
+                    last.position = position
+                    last.removed = removed + last.removed
+                    return True
+                if position == last.position:  # delete key
+                    last.removed += removed
+                    return True
+            self.typing = "delete"
+            return False
+        self.typing = None
+        return False
+
+    @contextmanager
+    def group(self):
+        '''Context manager which records every edit made inside it as one step'''
+        if self.grouped is not None:
+            yield  # already inside a group
+            return
+        self.grouped = []
+        try:
+            yield
+        finally:
+            edits, self.grouped = self.grouped, None
+            if edits:
+                self.undo_steps.append(edits[0] if len(edits) == 1 else edits)
+            self.typing = None
+
+    def undo(self):
+        '''
+        Function to undo the last step. Returns the edits which undo it as
+        (position, length to remove, text to insert), to be applied one
+        after the other in the order given.
+        '''
+        if not self.undo_steps:
+            return []
+        step = self.undo_steps.pop()
+        self.redo_steps.append(step)
+        self.typing = None
+        edits = step if isinstance(step, list) else [step]
+        return [(edit.position, len(edit.added), edit.removed) for edit in reversed(edits)]
+
+    def redo(self):
+        '''
+        Function to redo the last step undone. Returns the edits in the same
+        form as undo.
+        '''
+        if not self.redo_steps:
+            return []
+        step = self.redo_steps.pop()
+        self.undo_steps.append(step)
+        self.typing = None
+        edits = step if isinstance(step, list) else [step]
+        return [(edit.position, len(edit.removed), edit.added) for edit in edits]
+
+
+# what QTextDocument.toPlainText turns Qt's paragraph, line and frame
+# separators and non-breaking spaces into
+PLAIN_TEXT = str.maketrans({"\u2029": "\n", "\u2028": "\n", "\ufdd0": "\n", "\ufdd1": "\n",
+                            "\xa0": " "})
+
+
+class TextMirror:
+    '''
+    Copy of a text box's text kept as one string per paragraph, in Qt's
+    form (QTextCursor.selectedText), so what an edit removed can still be
+    looked up once the text box has changed. An edit only touches the
+    paragraphs it changed.
+    '''
+    __slots__ = ("paragraphs", "length")
+
+    def __init__(self, text=""):
+        self.reset(text)
+
+    def reset(self, text):
+        '''
+        Function to start again from a whole text
+
+        Keyword arguments:
+        text -- text with paragraphs separated by "\u2029" (str)
+        '''
+        self.paragraphs = text.split("\u2029")
+        self.length = len(text)
+
+    def text(self):
+        '''Return the whole text the way QTextDocument.toPlainText gives it'''
+        return "\n".join(self.paragraphs).translate(PLAIN_TEXT)
+
+    def replace(self, paragraph, column, removed, added):
+        '''
+        Function to make an edit. Returns the text removed, in Qt's form.
+
+        Keyword arguments:
+        paragraph -- number of the paragraph the edit starts in (int)
+        column -- position of the edit in that paragraph (int)
+        removed -- number of characters removed (int)
+        added -- text added, paragraphs separated by "\u2029" (str)
+        '''
+        pieces = []
+        last, end, left = paragraph, column, removed
+        while True:
+            line = self.paragraphs[last]
+            take = min(left, len(line) - end)
+            pieces.append(line[end:end + take])
+            left -= take
+            end += take
+            if not left:
+                break
+            pieces.append("\u2029")  # the paragraph break counts as one character
+            left -= 1
+            last += 1
+            end = 0
+        joined = self.paragraphs[paragraph][:column] + added + self.paragraphs[last][end:]
+        self.paragraphs[paragraph:last + 1] = joined.split("\u2029")
+        self.length += len(added) - removed
+        return "".join(pieces)
+
+
+def apply_edits(text, edits):
+    '''
+    Function to apply (position, length to remove, text to insert) edits to
+    a string, e.g. when the text can't be edited in place
+
+    Keyword arguments:
+    text -- text to edit (str)
+    edits -- edits from History.undo or History.redo (list)
+    '''
+    for position, length, insert in edits:
+        text = text[:position] + insert + text[position + length:]
+    return text
@@ -0,0 +1,266 @@
+'''
+Autosave of the mad lib being written, as an append-only journal, so
+work survives a crash or a closed window and comes back on the next start.
+
+The window hands every edit of the text box (position, characters
+removed, text added) and every change to the prompt state (theme,
+template and answers) to the journal, which only puts them on a queue.
+A worker thread writes what has queued up every interval seconds as JSON
+lines, merging runs of typing into one edit, and fsyncs once per batch.
+When the journal has grown past a few times the size of the text, the
+window is asked for a snapshot and the worker compacts the journal into
+that snapshot, so it stays bounded however long the session is.
+
+Reading it back replays the last snapshot and the edits after it; a
+line cut off by a crash is ignored.
+'''
+import os
+import json
+import threading
+from collections import deque
+import profiling
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".cache", "madlibs", "autosave.journal")
+INTERVAL = 0.5  # seconds between batches
+COMPACT_BYTES = 256 * 1024  # journal size past which it is compacted, or twice the snapshot
+
+# records, one per line
+SNAPSHOT = "t"  # ["t", text, state]
+EDIT = "e"  # ["e", position, characters removed, text added]
+STATE = "s"  # ["s", {changed state}]
+
+
+def merge_edit(first, second):
+    '''
+    Function to merge two edits made one after the other into one, e.g.
+    two characters typed or deleted in a row. Returns None when they
+    can't be merged.
+
+    Keyword arguments:
+    first -- (position, characters removed, text added) (tuple)
+    second -- the next edit (tuple)
+    '''
+    position, removed, added = first
+    if second[1] == 0 and second[0] == position + len(added):
+        return position, removed, added + second[2]
+    if not added and not second[2] and second[0] + second[1] == position:
+        return second[0], removed + second[1], ""
+    return None
+
+
+def apply_edit(text, edit):
+    '''Function to make a (position, characters removed, text added) edit to text'''
+    position, removed, added = edit
+    return text[:position] + added + text[position + removed:]
+
+
+def read_journal(path):
+    '''
+    Function to replay a journal. Returns (text, state), ("", {}) when
+    there is no journal.
+
+    Keyword arguments:
+    path -- journal file (str)
+    '''
+    text, state, pending = "", {}, None
+    try:
+        journal = open(path, encoding="utf-8")
+    except FileNotFoundError:
+        return text, state
+    with journal:
+        for line in journal:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                break  # cut off by a crash, nothing after it was written
+            if record[0] == EDIT:
+                edit = tuple(record[1:])
+                merged = pending and merge_edit(pending, edit)
+                if merged:
+                    pending = merged
+                    continue
+                if pending:
+                    text = apply_edit(text, pending)
+                pending = edit
+                continue
+            if pending:
+                text, pending = apply_edit(text, pending), None
+            if record[0] == SNAPSHOT:
+                text, state = record[1], dict(record[2])
+            elif record[0] == STATE:
+                state.update(record[1])
+    if pending:
+        text = apply_edit(text, pending)
+    return text, state
+
+
+def _lock(file):
+    '''Function to take an exclusive lock on an open file, raises OSError when it is taken'''
+    try:
+        import fcntl
+    except ImportError:  # Windows
+        import msvcrt
+        msvcrt.locking(file.fileno(), msvcrt.LK_NBLCK, 1)
+    else:
+        fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+class Journal:
+    '''
+    The autosave journal of one window. record, set_state and snapshot
+    only queue and can be called for every key press; the worker thread
+    does the writing. Only one window can use a journal file at a time.
+    '''
+
+    def __init__(self, path=None, interval=INTERVAL, compact_bytes=COMPACT_BYTES):
+        '''
+        Reads back the last session into text and state, then starts
+        the worker. Raises OSError when another window has the journal.
+
+        Keyword arguments:
+        path -- journal file, defaults to $MADLIBS_JOURNAL or ~/.cache/madlibs (str)
+        interval -- seconds between batches written (float)
+        compact_bytes -- journal size in bytes past which it is compacted (int)
+        '''
+        if path is None:
+            path = os.environ.get("MADLIBS_JOURNAL", DEFAULT_PATH)
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.path = path
+        self.interval = interval
+        self.compact_bytes = compact_bytes
+        self.lock_file = open(path + ".lock", "a")
+        try:
+            _lock(self.lock_file)
+        except OSError:
+            self.lock_file.close()
+            raise
+        self.text, self.state = read_journal(path)  # the last session
+        self.queue = deque()  # records waiting for the worker
+        self.wants_snapshot = False  # set by the worker when the journal should be compacted
+        self.error = None  # last OSError of the worker
+        self.file = None
+        self.size = 0  # bytes in the journal
+        self.compact_size = 0  # bytes of the last snapshot
+        self.stale = False  # a batch was lost, edits wait for the next snapshot
+        self.batches = 0
+        self.records = 0
+        self.compactions = 0
+        self.closing = False
+        self.wake = threading.Event()
+        self.queue.append((SNAPSHOT, self.text, dict(self.state)))  # start from a compact journal
+        self.worker = threading.Thread(target=self._run, name="journal", daemon=True)
+        self.worker.start()
+
+    def record(self, position, removed, added):
+        '''
+        Function to journal an edit to the text
+
+        Keyword arguments:
+        position -- position of the edit (int)
+        removed -- number of characters removed (int)
+        added -- text inserted (str)
+        '''
+        self.queue.append((EDIT, position, removed, added))
+
+    def set_state(self, **changes):
+        '''Function to journal changes to the prompt state, e.g. theme="Pirates"'''
+        changes = {key: value for key, value in changes.items() if self.state.get(key) != value}
+        if changes:
+            self.state.update(changes)
+            self.queue.append((STATE, changes))
+
+    def snapshot(self, text):
+        '''
+        Function to have the journal compacted into the current text and
+        state, when wants_snapshot asks for it
+
+        Keyword arguments:
+        text -- whole text of the mad lib (str)
+        '''
+        self.wants_snapshot = False
+        self.queue.append((SNAPSHOT, text, dict(self.state)))
+
+    def flush(self):
+        '''Function to wait until everything queued so far is written'''
+        if self.closing:
+            return
+        done = threading.Event()
+        self.queue.append(done)
+        self.wake.set()
+        done.wait()
+
+    def close(self):
+        '''Function to write what is left and stop the worker'''
+        if self.closing:
+            return
+        self.closing = True
+        self.wake.set()
+        self.worker.join()
+        self.lock_file.close()
+
+    def _run(self):
+        while not self.closing:
+            self.wake.wait(self.interval)
+            self.wake.clear()
+            self._write_batch()
+        self._write_batch()
+        if self.file is not None:
+            self.file.close()
+
+    def _write_batch(self):
+        '''Write the queued records as one batch, compacting at the last snapshot'''
+        records, waiting = [], []
+        while self.queue:
+            record = self.queue.popleft()
+            if isinstance(record, threading.Event):
+                waiting.append(record)
+            elif record[0] == SNAPSHOT:
+                records = [record]
+            elif (record[0] == EDIT and records and records[-1][0] == EDIT
+                  and (merged := merge_edit(records[-1][1:], record[1:]))):
+                records[-1] = (EDIT,) + merged
+            else:
+                records.append(record)
+        if records:
+            with profiling.timer("journal.write"):
+                try:
+                    self._write(records)
+                except OSError as e:
+                    self.error = e
+                    self.file = None
+                    self.stale = True
+                    self.wants_snapshot = True
+        for done in waiting:
+            done.set()
+
+    def _write(self, records):
+        if self.stale and records[0][0] != SNAPSHOT:
+            return  # the edits wouldn't apply to what is in the journal
+        data = "".join(json.dumps(record, separators=(",", ":")) + "\n"
+                       for record in records).encode("utf-8")
+        if records[0][0] == SNAPSHOT:
+            if self.file is not None:
+                self.file.close()
+                self.file = None
+            temporary = self.path + ".tmp"
+            with open(temporary, "wb") as file:
+                file.write(data)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(temporary, self.path)
+            self.size = self.compact_size = len(data)
+            self.stale = False
+            self.compactions += 1
+        else:
+            if self.file is None:
+                self.file = open(self.path, "ab")
+            self.file.write(data)
+            self.file.flush()
+            os.fsync(self.file.fileno())
+            self.size += len(data)
+        if self.file is None:
+            self.file = open(self.path, "ab")
+        self.batches += 1
+        self.records += len(records)
+        if self.size > max(self.compact_bytes, 2 * self.compact_size):
+            self.wants_snapshot = True
@@ -0,0 +1,219 @@
+import os
+import time
+import sqlite3
+import threading
+from collections import Counter
+import core
+import template_file
+from tokenizer import tokenize
+
+DEFAULT_PATH = os.path.join(os.path.expanduser("~"), ".local", "share", "madlibs",
+                            "library.sqlite3")
+EXTENSIONS = (".docx", template_file.EXTENSION)
+
+
+class LibraryEntry:
+    '''A template found in the library'''
+
+    def __init__(self, id, theme, text, blank_count, source):
+        self.id = id
+        self.theme = theme
+        self.text = text
+        self.blank_count = blank_count
+        self.source = source
+
+    def __repr__(self):
+        return f"LibraryEntry({self.id}, {self.theme!r}, blanks={self.blank_count})"
+
+
+def _fts_terms(column, query):
+    '''Turn free text into prefix terms on one FTS5 column'''
+    terms = []
+    for word in query.split():
+        terms.append(column + ':"' + word.replace('"', '""') + '"*')
+    return terms
+
+
+def _read_file(path):
+    '''
+    Function run in the import workers to read the templates in one file.
+    Returns a list of (source, theme, text); unreadable files give [].
+
+    Keyword arguments:
+    path -- .docx or .madlib file (str)
+    '''
+    try:
+        if path.endswith(template_file.EXTENSION):
+            with template_file.TemplateFile(path) as templates:
+                return [(path + "#" + str(i), record.theme, record.text)
+                        for i, record in enumerate(templates)]
+        theme, text = core.read_docx(path)
+        return [(path, theme, text)] if text else []
+    except (OSError, ValueError, KeyError):
+        return []
+
+
+class Library:
+    '''
+    SQLite template library with an FTS5 index over theme and text and a
+    table of prompt type counts per template, so searches by theme words,
+    number of blanks and prompt types only touch matching rows.
+    '''
+
+    def __init__(self, path=None):
+        '''
+        Keyword arguments:
+        path -- database file, defaults to $MADLIBS_LIBRARY or ~/.local/share/madlibs (str)
+        '''
+        if path is None:
+            path = os.environ.get("MADLIBS_LIBRARY", DEFAULT_PATH)
+        if path != ":memory:":
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.lock = threading.Lock()
+        self.connection = sqlite3.connect(path, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.executescript('''
+                CREATE TABLE IF NOT EXISTS templates (
+                    id INTEGER PRIMARY KEY,
+                    theme TEXT NOT NULL,
+                    text TEXT NOT NULL,
+                    blank_count INTEGER NOT NULL,
+                    source TEXT UNIQUE,
+                    added REAL NOT NULL);
+                CREATE INDEX IF NOT EXISTS templates_blank_count ON templates (blank_count);
+                CREATE TABLE IF NOT EXISTS template_types (
+                    type TEXT NOT NULL COLLATE NOCASE,
+                    template_id INTEGER NOT NULL,
+                    count INTEGER NOT NULL,
+                    PRIMARY KEY (type, template_id)) WITHOUT ROWID;
+                CREATE INDEX IF NOT EXISTS template_types_template ON template_types (template_id);
+                CREATE VIRTUAL TABLE IF NOT EXISTS templates_fts USING fts5(
+                    theme, text, content='templates', content_rowid='id');
+                CREATE TRIGGER IF NOT EXISTS templates_insert AFTER INSERT ON templates BEGIN
+                    INSERT INTO templates_fts (rowid, theme, text)
+                    VALUES (new.id, new.theme, new.text);
+                END;
+                CREATE TRIGGER IF NOT EXISTS templates_delete AFTER DELETE ON templates BEGIN
+                    INSERT INTO templates_fts (templates_fts, rowid, theme, text)
+                    VALUES ('delete', old.id, old.theme, old.text);
+                    DELETE FROM template_types WHERE template_id = old.id;
+                END;
+            ''')
+
+    def _insert(self, source, theme, text):
+        tokens = tokenize(text)
+        if source is not None:
+            self.connection.execute("DELETE FROM templates WHERE source = ?", (source,))
+        cursor = self.connection.execute(
+            "INSERT INTO templates (theme, text, blank_count, source, added)"
+            " VALUES (?, ?, ?, ?, ?)", (theme, text, len(tokens), source, time.time()))
+        types = Counter(token.type.lower() for token in tokens)
+        self.connection.executemany(
+            "INSERT INTO template_types VALUES (?, ?, ?)",
+            [(type, cursor.lastrowid, count) for type, count in types.items()])
+        return cursor.lastrowid
+
+    def add(self, theme, text, source=None):
+        '''
+        Function to add a template, replacing any earlier one from the same
+        source. Returns the template id.
+
+        Keyword arguments:
+        theme -- theme of the mad lib (str)
+        text -- text with the [Type N] prompts (str)
+        source -- file the template came from (str)
+        '''
+        with self.lock, self.connection:
+            return self._insert(source, theme, text)
+
+    def import_files(self, paths, workers=None, progress=None):
+        '''
+        Function to read .docx and .madlib files in parallel and add their
+        templates in one transaction. Returns the number of templates added.
+
+        Keyword arguments:
+        paths -- files to import (list)
+        workers -- number of processes, defaults to the number of cores (int)
+        progress -- called with (files read, files) after each file (function)
+        '''
+        import multiprocessing
+        from concurrent.futures import ProcessPoolExecutor
+        paths = [os.path.abspath(path) for path in paths]
+        added = 0
+        # spawn rather than fork, the window imports from a thread pool thread
+        # and forking a process with Qt's threads running can deadlock the workers
+        context = multiprocessing.get_context("spawn")
+        with ProcessPoolExecutor(workers, mp_context=context) as executor:
+            results = executor.map(_read_file, paths, chunksize=16)
+            with self.lock, self.connection:
+                for done, templates in enumerate(results, 1):
+                    for source, theme, text in templates:
+                        self._insert(source, theme, text)
+                        added += 1
+                    if progress is not None:
+                        progress(done, len(paths))
+        return added
+
+    def import_directory(self, directory, workers=None, progress=None):
+        '''
+        Function to import every .docx and .madlib file under a directory
+
+        Keyword arguments:
+        directory -- folder to search (str)
+        workers -- number of processes, defaults to the number of cores (int)
+        progress -- called with (files read, files) after each file (function)
+        '''
+        paths = []
+        for root, _, files in os.walk(directory):
+            for file in files:
+                if file.endswith(EXTENSIONS) and not file.startswith("~$"):
+                    paths.append(os.path.join(root, file))
+        return self.import_files(paths, workers, progress)
+
+    def search(self, theme="", text="", min_blanks=None, max_blanks=None,
+               types=(), limit=200):
+        '''
+        Function to find templates, best matches first. All arguments are
+        optional and combined, e.g. search(theme="space", min_blanks=8,
+        max_blanks=12, types=["Celebrity"]).
+
+        Keyword arguments:
+        theme -- words the theme must contain, matched as prefixes (str)
+        text -- words the text must contain, matched as prefixes (str)
+        min_blanks -- smallest number of prompts (int)
+        max_blanks -- largest number of prompts (int)
+        types -- prompt types the template must use (list)
+        limit -- most results to return (int)
+        '''
+        terms = _fts_terms("theme", theme) + _fts_terms("text", text)
+        sql = "SELECT t.id, t.theme, t.text, t.blank_count, t.source FROM templates t"
+        conditions = []
+        parameters = []
+        if terms:
+            sql += " JOIN templates_fts ON templates_fts.rowid = t.id"
+            conditions.append("templates_fts MATCH ?")
+            parameters.append(" AND ".join(terms))
+        if min_blanks is not None:
+            conditions.append("t.blank_count >= ?")
+            parameters.append(min_blanks)
+        if max_blanks is not None:
+            conditions.append("t.blank_count <= ?")
+            parameters.append(max_blanks)
+        for type in types:
+            conditions.append("t.id IN (SELECT template_id FROM template_types WHERE type = ?)")
+            parameters.append(type.strip().lower())
+        if conditions:
+            sql += " WHERE " + " AND ".join(conditions)
+        sql += " ORDER BY " + ("templates_fts.rank" if terms else "t.id DESC") + " LIMIT ?"
+        parameters.append(limit)
+        with self.lock:
+            rows = self.connection.execute(sql, parameters).fetchall()
+        return [LibraryEntry(*row) for row in rows]
+
+    def __len__(self):
+        with self.lock:
+            return self.connection.execute("SELECT COUNT(*) FROM templates").fetchone()[0]
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
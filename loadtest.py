@@ -0,0 +1,225 @@
+'''
+Load test for the game server. Plays many games at once against
+localhost: every game gets players asking for blanks and answering them
+over shared kept-alive connections, plus a watcher holding its own
+connection open waiting for the story, as the room's screen would.
+
+    python madlibs.py loadtest --games 2000 --players 4 --blanks 12
+
+Without --url a server is started in another process on a free port.
+'''
+import os
+import sys
+import json
+import time
+import asyncio
+import subprocess
+from urllib.parse import urlsplit
+import server
+
+
+class Connection:
+    '''A kept-alive HTTP/1.1 connection which reconnects when dropped'''
+
+    def __init__(self, host, port):
+        self.host = host
+        self.port = port
+        self.reader = None
+        self.writer = None
+
+    async def request(self, method, path, body=None):
+        '''Function to send one request. Returns (status, decoded JSON body).'''
+        for retry in (False, True):
+            if self.writer is None:
+                self.reader, self.writer = await asyncio.open_connection(
+                    self.host, self.port, limit=server.MAX_BODY)
+            data = b"" if body is None else json.dumps(body).encode("utf-8")
+            self.writer.write(f"{method} {path} HTTP/1.1\r\nHost: {self.host}\r\n"
+                              f"Content-Type: application/json\r\nContent-Length: {len(data)}\r\n\r\n"
+                              .encode("latin-1") + data)
+            try:
+                await self.writer.drain()
+                status_line = await self.reader.readline()
+                if not status_line:
+                    raise ConnectionResetError("the server closed the connection")
+                headers = {}
+                while True:
+                    line = await self.reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode("latin-1").partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                payload = await self.reader.readexactly(int(headers.get("content-length", 0)))
+            except (ConnectionError, asyncio.IncompleteReadError):
+                self.close()
+                if retry:
+                    raise
+                continue
+            if headers.get("connection", "").lower() == "close":
+                self.close()
+            return int(status_line.split()[1]), json.loads(payload)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        self.reader = self.writer = None
+
+
+class LoadTest:
+    '''Counts and latencies of the requests made by one run'''
+
+    def __init__(self, host, port, connections):
+        self.host = host
+        self.port = port
+        self.pool = asyncio.Queue()
+        for _ in range(connections):
+            self.pool.put_nowait(Connection(host, port))
+        self.latencies = {}  # request kind -> seconds
+        self.errors = {}
+        self.games_done = 0
+        self.bad_stories = 0
+
+    async def request(self, kind, method, path, body=None, connection=None):
+        '''Function to time a request, on a pooled connection unless one is given'''
+        pooled = connection is None
+        if pooled:
+            connection = await self.pool.get()
+        start = time.perf_counter()
+        try:
+            status, data = await connection.request(method, path, body)
+        except (OSError, asyncio.IncompleteReadError) as e:
+            key = kind + " " + type(e).__name__
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return None
+        finally:
+            if pooled:
+                self.pool.put_nowait(connection)
+        self.latencies.setdefault(kind, []).append(time.perf_counter() - start)
+        if status >= 400:
+            key = f"{kind} {status} {data.get('error')}"
+            self.errors[key] = self.errors.get(key, 0) + 1
+            return None
+        return data
+
+    async def play(self, game_id, number):
+        player = await self.request("join", "POST", f"/games/{game_id}/players",
+                                    {"name": "Player " + str(number)})
+        if player is None:
+            return
+        player_id = player["player"]
+        while True:
+            blank = await self.request("blank", "POST",
+                                       f"/games/{game_id}/players/{player_id}/blank")
+            if blank is None or blank["name"] is None:
+                return
+            await self.request("answer", "POST", f"/games/{game_id}/answers",
+                               {"player": player_id, "name": blank["name"],
+                                "answer": "word" + str(number)})
+
+    async def game(self, players, blanks, limit):
+        async with limit:
+            game = await self.request("create", "POST", "/games",
+                                      {"theme": "Load test", "blanks": blanks})
+            if game is None:
+                return
+            watcher = Connection(self.host, self.port)
+            try:
+                story = asyncio.create_task(self.request(
+                    "story", "GET", f"/games/{game['game']}/story?wait={server.MAX_WAIT}",
+                    connection=watcher))
+                await asyncio.gather(*(self.play(game["game"], number)
+                                       for number in range(1, players + 1)))
+                story = await story
+            finally:
+                watcher.close()
+            if story is None or not story["complete"] or "word" not in story.get("story", ""):
+                self.bad_stories += 1
+            else:
+                self.games_done += 1
+            await self.request("delete", "DELETE", f"/games/{game['game']}")
+
+
+def percentile(values, fraction):
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+
+async def run_load(host, port, games, players, blanks, connections, concurrency):
+    '''
+    Function to play games against a server and print what happened.
+    Returns the LoadTest.
+
+    Keyword arguments:
+    host -- server address (str)
+    port -- server port (int)
+    games -- number of games to play (int)
+    players -- players in each game (int)
+    blanks -- blanks in each game (int)
+    connections -- kept-alive connections shared by the players (int)
+    concurrency -- most games in progress at once (int)
+    '''
+    test = LoadTest(host, port, connections)
+    limit = asyncio.Semaphore(concurrency)
+    start = time.perf_counter()
+    await asyncio.gather(*(test.game(players, blanks, limit) for _ in range(games)))
+    elapsed = time.perf_counter() - start
+    requests = sum(len(latencies) for latencies in test.latencies.values())
+    print(f"{test.games_done} of {games} games finished in {elapsed:.2f}s "
+          f"({test.games_done / elapsed:.0f} games/sec, {requests / elapsed:.0f} requests/sec, "
+          f"{players} players and {blanks} blanks each, {min(games, concurrency)} at once)")
+    for kind, latencies in test.latencies.items():
+        print(f"  {kind:<7} {len(latencies):>8} requests  p50={percentile(latencies, 0.5) * 1e3:8.2f}ms"
+              f"  p95={percentile(latencies, 0.95) * 1e3:8.2f}ms"
+              f"  p99={percentile(latencies, 0.99) * 1e3:8.2f}ms  max={max(latencies) * 1e3:8.2f}ms")
+    for error, count in sorted(test.errors.items()):
+        print(f"  error   {count:>8} x {error}")
+    if test.bad_stories:
+        print(f"  {test.bad_stories} games ended without a complete story")
+    stats = await Connection(host, port).request("GET", "/stats")
+    print("  server  " + ", ".join(f"{key}={value:.0f}" if isinstance(value, float) else f"{key}={value}"
+                                   for key, value in stats[1].items()))
+    while not test.pool.empty():
+        test.pool.get_nowait().close()
+    return test
+
+
+def start_server():
+    '''Function to start a server process on a free port. Returns (process, port).'''
+    here = os.path.dirname(os.path.abspath(__file__))
+    process = subprocess.Popen([sys.executable, os.path.join(here, "madlibs.py"), "serve",
+                                "--port", "0"], stdout=subprocess.PIPE, text=True)
+    line = process.stdout.readline()  # "serving on http://127.0.0.1:<port>"
+    if not line:
+        raise SystemExit("the server did not start")
+    return process, urlsplit(line.split()[-1]).port
+
+
+def main(url=None, games=1000, players=4, blanks=12, connections=256, concurrency=None):
+    '''
+    Function to run a load test, starting a local server unless a URL is given
+
+    Keyword arguments:
+    url -- running server, e.g. http://127.0.0.1:8765 (str)
+    games -- number of games to play (int)
+    players -- players in each game (int)
+    blanks -- blanks in each game (int)
+    connections -- kept-alive connections shared by the players (int)
+    concurrency -- most games in progress at once, all of them if None (int)
+    '''
+    server.raise_file_limit()
+    process = None
+    if url:
+        parts = urlsplit(url)
+        host, port = parts.hostname, parts.port or 80
+    else:
+        process, port = start_server()
+        host = "127.0.0.1"
+    try:
+        test = asyncio.run(run_load(host, port, games, players, blanks, connections,
+                                    concurrency or games))
+    finally:
+        if process is not None:
+            process.terminate()
+            process.wait()
+    if test.errors or test.bad_stories:
+        raise SystemExit(1)
@@ -1,18 +1,34 @@
 #!/usr/bin/env python3
 import sys
 import os
-import re
-from docx import Document, opc
-from PyQt6.QtCore import Qt, pyqtSignal
+from PyQt6.QtCore import (Qt, pyqtSignal, QObject, QRunnable, QThreadPool,
+                          QAbstractTableModel, QModelIndex, QEvent, QTimer)
 from PyQt6.QtWidgets import (QFileDialog, QApplication, QMainWindow,
                              QPushButton, QLabel, QLineEdit, QGridLayout,
-                             QWidget, QTextEdit, QButtonGroup,QInputDialog, QDialog)
-from PyQt6.QtGui import (QFont, QTextCursor, QAction,
-                         QTextCharFormat, QKeySequence)
+                             QWidget, QTextEdit, QButtonGroup,QInputDialog, QDialog,
+                             QProgressDialog, QListWidget, QListWidgetItem, QSpinBox,
+                             QTableView, QHeaderView, QAbstractItemView)
+from PyQt6.QtGui import (QFont, QTextCursor, QAction, QActionGroup,
+                         QTextCharFormat, QKeySequence, QPainter)
 from functools import partial
 import inputs_file
-import openai
+import core
+from template import compile_template, PlaceholderIndex
+from tokenizer import clean_type
+import generation
+from generation_cache import GenerationCache, cache_key
+import providers
+from library import Library
+from fill_session import FillSession
+from history import History, TextMirror, PLAIN_TEXT, apply_edits
+from backgrounds import BackgroundManager, DEFAULT_PATH, IMAGE_FILTER
+from journal import Journal
+from prefetch import PrefetchPool
+import profiling
 import random
+import threading
+
+STREAM_INTERVAL = 50  # milliseconds between updates of streamed text
 
 
 # custom window subclass for custom prompts
@@ -66,6 +82,407 @@ class CustomWindow(QMainWindow):
             pass
 
 
+# signals have to live on a QObject, QRunnable is not one
+class GenerationSignals(QObject):
+    progress = pyqtSignal(int, int)
+    text = pyqtSignal(str)
+    finished = pyqtSignal(str)
+    failed = pyqtSignal(str)
+    cache_failed = pyqtSignal(str)
+
+
+# worker to run the generation requests off the GUI thread
+class GenerationWorker(QRunnable):
+
+    def __init__(self, provider, theme, number_of_blanks, max_retries, parallel=1,
+                 cache=None, stream=False):
+        super().__init__()
+        self.provider = provider  # providers.Provider to generate with
+        self.cache = cache  # validated paragraphs are stored here when given
+        self.theme = theme
+        self.number_of_blanks = number_of_blanks
+        self.max_retries = max_retries
+        self.parallel = parallel  # race this many requests when above 1
+        self.stream = stream and parallel == 1  # send text as it is generated
+        self.attempts = []
+        self.cancel_event = threading.Event()
+        self.signals = GenerationSignals()
+
+    def run(self):
+        '''
+        Function to generate the mad lib and send the result back through
+        the signals. Nothing is sent after a cancel. The mad lib is sent
+        before it is cached, so a cache error only loses the cached copy.
+        '''
+        try:
+            paragraph = self.provider.generate(
+                self.theme, self.number_of_blanks, max_retries=self.max_retries,
+                parallel=self.parallel, cancel_event=self.cancel_event,
+                progress=self.signals.progress.emit, attempts=self.attempts,
+                on_text=self.signals.text.emit if self.stream else None)
+        except generation.GenerationCancelled:
+            pass
+        except generation.GenerationFailed as e:
+            if not self.cancel_event.is_set():
+                self.signals.failed.emit(str(e.error) if e.error else "")
+        else:
+            if not self.cancel_event.is_set():
+                self.signals.finished.emit(paragraph)
+            if self.cache is not None:
+                try:
+                    self.cache.put(cache_key(self.theme, self.number_of_blanks,
+                                             self.provider.model), paragraph)
+                except Exception as e:  # e.g. the database is locked by another window
+                    self.signals.cache_failed.emit(str(e) or type(e).__name__)
+
+    def cancel(self):
+        '''Function to stop the worker. Activated by the Cancel button'''
+        self.cancel_event.set()
+
+
+# signals have to live on a QObject, QRunnable is not one
+class ImportSignals(QObject):
+    progress = pyqtSignal(int, int)
+    finished = pyqtSignal(int)
+    failed = pyqtSignal(str)
+
+
+# worker to import saved mad libs into the library off the GUI thread
+class ImportWorker(QRunnable):
+
+    def __init__(self, importer, source):
+        super().__init__()
+        self.importer = importer  # Library.import_files or Library.import_directory
+        self.source = source  # paths or folder handed to the importer
+        self.signals = ImportSignals()
+
+    def run(self):
+        '''Function to run the import and send the result back through the signals'''
+        try:
+            added = self.importer(self.source, progress=self.signals.progress.emit)
+        except Exception as e:  # sent to the dialog rather than leaving it waiting
+            self.signals.failed.emit(str(e) or type(e).__name__)
+        else:
+            self.signals.finished.emit(added)
+
+
+# dialog to search the template library and pick a mad lib to open
+class LibraryDialog(QDialog):
+
+    def __init__(self, library, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Open a mad lib")
+        self.library = library
+        self.entry = None  # chosen LibraryEntry
+        self.import_worker = None  # ImportWorker of the import running
+        self.import_progress = None
+
+        self.theme_search = QLineEdit()
+        self.theme_search.setPlaceholderText("Theme")
+        self.text_search = QLineEdit()
+        self.text_search.setPlaceholderText("Words in the mad lib")
+        self.types_search = QLineEdit()
+        self.types_search.setPlaceholderText("Fill-in-the-blank types, e.g. Celebrity, Noun")
+        self.min_blanks = QSpinBox()
+        self.min_blanks.setRange(0, 100000)
+        self.max_blanks = QSpinBox()
+        self.max_blanks.setRange(0, 100000)
+        self.max_blanks.setValue(100000)
+        self.results = QListWidget()
+        self.preview = QTextEdit()
+        self.preview.setReadOnly(True)
+        self.count_label = QLabel()
+        import_files_button = QPushButton("Import Files...")
+        import_files_button.clicked.connect(self.import_files)
+        import_folder_button = QPushButton("Import Folder...")
+        import_folder_button.clicked.connect(self.import_folder)
+        self.open_button = QPushButton("Open")
+        self.open_button.setEnabled(False)
+        self.open_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+
+        for search in (self.theme_search, self.text_search, self.types_search):
+            search.textChanged.connect(self.search)
+        self.min_blanks.valueChanged.connect(self.search)
+        self.max_blanks.valueChanged.connect(self.search)
+        self.results.currentItemChanged.connect(self.select)
+        self.results.itemDoubleClicked.connect(self.accept)
+
+        layout = QGridLayout()
+        layout.addWidget(self.theme_search, 0, 0, 1, 2)
+        layout.addWidget(self.text_search, 0, 2, 1, 2)
+        layout.addWidget(self.types_search, 1, 0, 1, 2)
+        layout.addWidget(QLabel("Blanks from"), 1, 2)
+        layout.addWidget(self.min_blanks, 1, 3)
+        layout.addWidget(QLabel("to"), 1, 4)
+        layout.addWidget(self.max_blanks, 1, 5)
+        layout.addWidget(self.results, 2, 0, 1, 3)
+        layout.addWidget(self.preview, 2, 3, 1, 3)
+        layout.addWidget(self.count_label, 3, 0, 1, 2)
+        layout.addWidget(import_files_button, 4, 0)
+        layout.addWidget(import_folder_button, 4, 1)
+        layout.addWidget(self.open_button, 4, 4)
+        layout.addWidget(cancel_button, 4, 5)
+        self.setLayout(layout)
+        self.search()
+
+    def search(self):
+        '''Function to list the templates matching the search boxes'''
+        types = [type for type in self.types_search.text().split(",") if type.strip()]
+        entries = self.library.search(self.theme_search.text(), self.text_search.text(),
+                                      self.min_blanks.value(), self.max_blanks.value(),
+                                      types)
+        self.results.clear()
+        for entry in entries:
+            item = QListWidgetItem(entry.theme + " (" + str(entry.blank_count) + " blanks)")
+            item.setData(Qt.ItemDataRole.UserRole, entry)
+            self.results.addItem(item)
+        self.count_label.setText(str(len(entries)) + " of " + str(len(self.library)) + " mad libs")
+        self.open_button.setEnabled(False)
+        self.preview.clear()
+
+    def select(self, item):
+        '''
+        Function to preview the highlighted template
+
+        Keyword Arguments
+        item -- highlighted list item (QListWidgetItem)
+        '''
+        self.entry = item.data(Qt.ItemDataRole.UserRole) if item else None
+        self.open_button.setEnabled(self.entry is not None)
+        self.preview.setText(self.entry.text if self.entry else "")
+
+    def import_files(self):
+        '''Function to add saved .madlib and .docx files to the library'''
+        paths, _ = QFileDialog.getOpenFileNames(self, 'Import Files',
+                                                filter="Mad libs (*.madlib *.docx)")
+        if paths:
+            self.run_import(self.library.import_files, paths)
+
+    def import_folder(self):
+        '''Function to add every saved mad lib in a folder to the library'''
+        directory = QFileDialog.getExistingDirectory(self, 'Import Folder')
+        if directory:
+            self.run_import(self.library.import_directory, directory)
+
+    def run_import(self, importer, source):
+        '''
+        Function to import on the thread pool with a progress dialog, so the
+        window keeps responding while the files are read
+
+        Keyword Arguments
+        importer -- Library.import_files or Library.import_directory
+        source -- paths or folder to import
+        '''
+        self.import_worker = ImportWorker(importer, source)
+        self.import_progress = QProgressDialog("Importing mad libs...", None, 0, 0, self)
+        self.import_progress.setWindowModality(Qt.WindowModality.WindowModal)
+        self.import_progress.setMinimumDuration(0)
+        signals = self.import_worker.signals
+        signals.progress.connect(self.import_progress_update)
+        signals.finished.connect(self.import_done)
+        signals.failed.connect(self.import_failed)
+        QThreadPool.globalInstance().start(self.import_worker)
+
+    def import_progress_update(self, done, total):
+        '''
+        Function to show how many files have been read
+
+        Keyword Arguments
+        done -- files read so far (int)
+        total -- files being imported (int)
+        '''
+        self.import_progress.setMaximum(total)
+        self.import_progress.setValue(done)
+
+    def import_done(self, added):
+        '''
+        Function to list the library again once the import is finished
+
+        Keyword Arguments
+        added -- number of mad libs added (int)
+        '''
+        self.import_progress.reset()
+        self.search()
+        self.count_label.setText(self.count_label.text() + " (" + str(added) + " imported)")
+
+    def import_failed(self, error):
+        '''
+        Function to report an import which stopped part way
+
+        Keyword Arguments
+        error -- what went wrong (str)
+        '''
+        self.import_progress.reset()
+        self.search()
+        self.count_label.setText(self.count_label.text() + " (import failed: " + error + ")")
+
+
+# table model over a FillSession: one row per prompt, answers are editable
+class AnswerModel(QAbstractTableModel):
+    storyEdited = pyqtSignal(list)
+
+    def __init__(self, session, parent=None):
+        super().__init__(parent)
+        self.session = session
+
+    def rowCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else len(self.session)
+
+    def columnCount(self, parent=QModelIndex()):
+        return 0 if parent.isValid() else 2
+
+    def headerData(self, section, orientation, role=Qt.ItemDataRole.DisplayRole):
+        if role == Qt.ItemDataRole.DisplayRole and orientation == Qt.Orientation.Horizontal:
+            return ("Fill-in-the-blank", "Answer")[section]
+        return None
+
+    def data(self, index, role=Qt.ItemDataRole.DisplayRole):
+        if role in (Qt.ItemDataRole.DisplayRole, Qt.ItemDataRole.EditRole):
+            if index.column() == 0:
+                return self.session.label(index.row())
+            return self.session.answer(index.row())
+        return None
+
+    def flags(self, index):
+        flags = Qt.ItemFlag.ItemIsEnabled | Qt.ItemFlag.ItemIsSelectable
+        if index.column() == 1:
+            flags |= Qt.ItemFlag.ItemIsEditable
+        return flags
+
+    def setData(self, index, value, role=Qt.ItemDataRole.EditRole):
+        '''
+        Function to store an answer typed in the table and send the story edits
+
+        Keyword Arguments
+        index -- cell edited (QModelIndex)
+        value -- answer (str)
+        '''
+        if role != Qt.ItemDataRole.EditRole or index.column() != 1:
+            return False
+        edits = self.session.set_answer(self.session.names[index.row()], value.strip())
+        self.dataChanged.emit(index, index)
+        self.storyEdited.emit(edits)
+        return True
+
+    def paste(self, lines, start_row=0):
+        '''
+        Function to fill answers from a list, one per row from start_row
+
+        Keyword Arguments
+        lines -- answers (list)
+        start_row -- row of the first answer (int)
+        '''
+        edits = self.session.paste(lines, start_row)
+        last_row = min(start_row + len(lines), len(self.session)) - 1
+        if last_row >= start_row:
+            self.dataChanged.emit(self.index(start_row, 1), self.index(last_row, 1))
+        self.storyEdited.emit(edits)
+
+    def update(self, answers):
+        '''
+        Function to change several answers at once
+
+        Keyword Arguments
+        answers -- map of prompt name to answer (dict)
+        '''
+        edits = self.session.update(answers)
+        if len(self.session):
+            self.dataChanged.emit(self.index(0, 1), self.index(len(self.session) - 1, 1))
+        self.storyEdited.emit(edits)
+
+
+# form showing every fill-in-the-blank at once with a live preview of the story
+class FillDialog(QDialog):
+    vocabulary = None  # word lists, loaded the first time they are needed
+
+    def __init__(self, session, parent=None):
+        super().__init__(parent)
+        self.setWindowTitle("Fill-in-the-blanks!")
+        self.session = session
+        self.model = AnswerModel(session, self)
+        self.model.storyEdited.connect(self.apply_edits)
+
+        # a view only creates an editor for the cell being edited, so
+        # thousands of blanks don't mean thousands of widgets
+        self.table = QTableView()
+        self.table.setModel(self.model)
+        self.table.setEditTriggers(QAbstractItemView.EditTrigger.AllEditTriggers)
+        self.table.horizontalHeader().setSectionResizeMode(0, QHeaderView.ResizeMode.ResizeToContents)
+        self.table.horizontalHeader().setStretchLastSection(True)
+        self.table.verticalHeader().setSectionResizeMode(QHeaderView.ResizeMode.Fixed)
+        self.preview = QTextEdit()
+        self.preview.setReadOnly(True)
+        self.preview.setPlainText(session.render())
+        self.qt_offsets = _same_offsets(session.template.text)
+        paste_button = QPushButton("Paste Answers")
+        paste_button.setStatusTip("Fill the answers from the clipboard, one per line")
+        paste_button.clicked.connect(self.paste_answers)
+        self.random_button = QPushButton("Random Answers")
+        self.random_button.setStatusTip("Fill the empty answers with words from the word lists")
+        self.random_button.clicked.connect(self.random_answers)
+        done_button = QPushButton("Done")
+        done_button.clicked.connect(self.accept)
+        cancel_button = QPushButton("Cancel")
+        cancel_button.clicked.connect(self.reject)
+
+        layout = QGridLayout()
+        layout.addWidget(self.table, 0, 0, 1, 3)
+        layout.addWidget(self.preview, 0, 3, 1, 3)
+        layout.addWidget(paste_button, 1, 0)
+        layout.addWidget(self.random_button, 1, 1)
+        layout.addWidget(done_button, 1, 4)
+        layout.addWidget(cancel_button, 1, 5)
+        self.setLayout(layout)
+        self.resize(900, 500)
+
+    def apply_edits(self, edits):
+        '''
+        Function to update the story preview with only the changed answers
+
+        Keyword Arguments
+        edits -- (offset, old length, new text) from the session (list)
+        '''
+        with profiling.timer("slot.fill_preview"):
+            self.qt_offsets = self.qt_offsets and all(_same_offsets(text) for _, _, text in edits)
+            if not self.qt_offsets:
+                self.preview.setPlainText(self.session.render())
+                return
+            cursor = QTextCursor(self.preview.document())
+            cursor.beginEditBlock()
+            for offset, old_length, text in edits:
+                cursor.setPosition(offset)
+                cursor.setPosition(offset + old_length, QTextCursor.MoveMode.KeepAnchor)
+                cursor.insertText(text)
+            cursor.endEditBlock()
+
+    def paste_answers(self):
+        '''Function to fill answers from the clipboard starting at the selected row'''
+        lines = QApplication.clipboard().text().replace("\t", "\n").splitlines()
+        start_row = max(self.table.currentIndex().row(), 0)
+        self.model.paste(lines, start_row)
+
+    def random_answers(self):
+        '''Function to fill every empty answer with a random word of its type'''
+        if FillDialog.vocabulary is None:
+            from vocabulary import Vocabulary  # only needed when asked for
+            try:
+                FillDialog.vocabulary = Vocabulary.load()
+            except OSError:
+                self.random_button.setEnabled(False)
+                self.random_button.setToolTip("No word lists found")
+                return
+        answers = self.vocabulary.sample_answers(self.session.template.text)
+        self.model.update({name: answer for name, answer in answers.items()
+                           if name not in self.session.answers})
+
+
+def _same_offsets(text):
+    '''True when Qt's UTF-16 positions in text match Python's'''
+    return len(text.encode("utf-16-le")) == 2 * len(text)
+
+
 # Subclass QMainWindow to customize your application's main window
 class MainWindow(QMainWindow):
     cursorMoved = pyqtSignal()
@@ -74,23 +491,37 @@ class MainWindow(QMainWindow):
         super().__init__()
 
         self.prompt_counter = 0
-        self.added_prompts = []  # holds dict of prompts for cycling later
+        self.placeholders = PlaceholderIndex()  # prompts in document order
+        self.history = History()  # undo/redo log of edits to the text
+        self.text_mirror = TextMirror()  # text as of the last edit, to see what an edit removed
+        self.replaying = False  # True while undo/redo edits the text
         self.added_prompts_dict = {}
         self.fill_in_blanks_mode = False
         self.final_pre_text = ""
+        self.filled = False  # True while the text box holds the story filled in from final_pre_text
         self.current_text = ""
         self.setWindowTitle("Make your own mad libs")
         self.buttons = []
         self.buttons_shortcut_label = []
         self.prompt_answers = {}
-
-        # ENTER YOUR OPENAI KEY HERE
-        openai.api_key = ''
-
-        self.client = openai.OpenAI(
-            # This is the default and can be omitted
-            api_key=os.environ.get("OPENAI_API_KEY"),
-        )
+        # created on first use to keep start up fast
+        self.cache = None
+        self.library = None
+        self.client = None  # uses generation.get_client() unless replaced
+        self.providers = None  # providers.default_providers(), set up on first use
+        self.journal = None  # autosave, see start_autosave
+        self.prefetch = None  # PrefetchPool, set up on first use
+        # streamed text is put in the window a few times a second rather than per piece
+        self.stream_buffer = []
+        self.stream_timer = QTimer(self)
+        self.stream_timer.setSingleShot(True)
+        self.stream_timer.setInterval(STREAM_INTERVAL)
+        self.stream_timer.timeout.connect(self.ai_generate_flush)
+        # background image, decoded and scaled off the GUI thread
+        self.background = BackgroundManager(self)
+        self.background.changed.connect(self.update)
+        self.background.failed.connect(self.background_failed)
+        self.background.set_image(DEFAULT_PATH, tiled=True)
 
         # file menu options
         mainMenu = self.menuBar()
@@ -113,12 +544,50 @@ class MainWindow(QMainWindow):
         chatgpt_action = QAction("Generate a mad lib", self)
         chatgpt_action.setStatusTip("Use ChatGPT")
         chatgpt_action.triggered.connect(self.ai_generate)
+        # race several ChatGPT requests and keep the first good one
+        self.race_action = QAction("Race 3 generations", self)
+        self.race_action.setStatusTip("Send 3 requests at once and use the first correct mad lib")
+        self.race_action.setCheckable(True)
+        # serve a cached mad lib straight away and refresh it in the background
+        self.cached_action = QAction("Use cached mad libs", self)
+        self.cached_action.setStatusTip("Reuse a mad lib generated before for the same theme")
+        self.cached_action.setCheckable(True)
+        # generate mad libs for the last themes ahead of time
+        self.prefetch_action = QAction("Keep mad libs ready", self)
+        self.prefetch_action.setStatusTip("Generate the next mad libs for recent themes in the background")
+        self.prefetch_action.setCheckable(True)
+        # show the mad lib as ChatGPT writes it
+        self.stream_action = QAction("Show mad lib while generating", self)
+        self.stream_action.setStatusTip("Stream the text into the window as it is generated")
+        self.stream_action.setCheckable(True)
+        self.stream_action.setChecked(True)
+        # what generates the mad libs
+        self.provider_group = QActionGroup(self)
+        for name, label, tip in (
+                ("openai", "ChatGPT", "Generate with ChatGPT"),
+                ("endpoint", "Local server", "Generate with the OpenAI compatible server in MADLIBS_ENDPOINT"),
+                ("local", "Offline generator", "Build mad libs from stored templates without a network"),
+                ("auto", "Cheapest within " + str(int(providers.DEADLINE)) + " seconds",
+                 "Use the cheapest generator expected to finish in time, falling back to the others")):
+            action = QAction(label, self)
+            action.setStatusTip(tip)
+            action.setData(name)
+            action.setCheckable(True)
+            action.setChecked(name == "openai")
+            action.setEnabled(name != "endpoint" or bool(os.environ.get("MADLIBS_ENDPOINT")))
+            self.provider_group.addAction(action)
         # add menu options
         fileMenu = mainMenu.addMenu('&File')
         fileMenu.addAction(save_file_action)
         fileMenu.addAction(open_file_action)
         fileMenu.addAction(change_image_action)
         fileMenu.addAction(chatgpt_action)
+        fileMenu.addAction(self.race_action)
+        fileMenu.addAction(self.cached_action)
+        fileMenu.addAction(self.prefetch_action)
+        fileMenu.addAction(self.stream_action)
+        generatorMenu = fileMenu.addMenu("Generate with")
+        generatorMenu.addActions(self.provider_group.actions())
 
         # add all the buttons dynamically based on the dictionary list
         self.button_list = inputs_file.inputs
@@ -139,6 +608,7 @@ class MainWindow(QMainWindow):
 
         # Theme text and labels
         self.theme_text = QLineEdit()
+        self.theme_text.textChanged.connect(self.autosave_state)
         self.theme_label = QLabel("Theme:")
         self.theme_label.setAlignment(Qt.AlignmentFlag.AlignCenter)
         self.theme_label.setStyleSheet("color:white;background-color:black")
@@ -147,8 +617,9 @@ class MainWindow(QMainWindow):
 
         # main text box and formatting for prompts
         self.full_text = QTextEdit()
-        self.cursor = self.full_text.textCursor()
-        self.full_text.cursorPositionChanged.connect(self.cursor_change)
+        self.full_text.document().contentsChange.connect(self.text_change)
+        self.full_text.setUndoRedoEnabled(False)  # self.history keeps the edits instead
+        self.full_text.installEventFilter(self)
         self.bold_fmt = QTextCharFormat()
         self.bold_fmt.setFontWeight(700)
 
@@ -165,11 +636,15 @@ class MainWindow(QMainWindow):
         self.clear_button = QPushButton("Clear")
         self.clear_button.setEnabled(True)
         self.clear_button.clicked.connect(self.clear_all)
-        # undo button for undoing prompts
+        # undo and redo buttons for edits to the text
         self.undo_button = QPushButton("Undo")
         self.undo_button.setEnabled(False)
         self.undo_button.setShortcut(QKeySequence('Ctrl+Z'))
-        self.undo_button.clicked.connect(self.undo_prompt)
+        self.undo_button.clicked.connect(self.undo_edit)
+        self.redo_button = QPushButton("Redo")
+        self.redo_button.setEnabled(False)
+        self.redo_button.setShortcut(QKeySequence(QKeySequence.StandardKey.Redo))
+        self.redo_button.clicked.connect(self.redo_edit)
 
         # prompt editor buttons
         self.error_text = QLineEdit()
@@ -196,6 +671,7 @@ class MainWindow(QMainWindow):
                 layout.addWidget(self.buttons_shortcut_label[i], i - 9,
                                  28, alignment=Qt.AlignmentFlag.AlignCenter)
         layout.addWidget(self.undo_button, 11, 23, 1, 1)
+        layout.addWidget(self.redo_button, 11, 24, 1, 1)
         layout.addWidget(self.clear_button,12 ,23, 1, 1)
         layout.addWidget(self.done_button, 12, 0, 1, 1)
         layout.addWidget(self.error_text, 14, 0, 1, 5)
@@ -210,191 +686,462 @@ class MainWindow(QMainWindow):
     # Function definitions
     ###################################################
 
-    def cursor_change(self):
-        '''Function to track the cursor in case of undo events'''
-        self.cursor.setPosition(self.full_text.textCursor().position())
-        self.full_text.setTextCursor(self.cursor)
+    @property
+    def added_prompts(self):
+        '''Prompts currently in the text, in document order'''
+        return self.placeholders.names
+
+    def eventFilter(self, watched, event):
+        '''
+        Function to send undo and redo key presses in the text box to the
+        history, as the text box would otherwise take them for itself
+
+        Keyword Arguments:
+        watched -- widget the event is for (QObject)
+        event -- the event (QEvent)
+        '''
+        if watched is self.full_text and event.type() == QEvent.Type.KeyPress:
+            if event.matches(QKeySequence.StandardKey.Undo):
+                self.undo_edit()
+                return True
+            if event.matches(QKeySequence.StandardKey.Redo):
+                self.redo_edit()
+                return True
+        return super().eventFilter(watched, event)
+
+    def document_text(self, start, end):
+        '''
+        Function to read part of the text box without copying the rest.
+        Returns it in Qt's form, see history.TextMirror.
+
+        Keyword arguments:
+        start -- position to read from (int)
+        end -- position to read to (int)
+        '''
+        cursor = QTextCursor(self.full_text.document())
+        cursor.setPosition(start)
+        cursor.setPosition(end, QTextCursor.MoveMode.KeepAnchor)
+        return cursor.selectedText()
+
+    def text_change(self, position, removed, added):
+        '''
+        Function to keep the prompt index in step with edits to the text
+
+        Keyword arguments:
+        position -- position of the edit (int)
+        removed -- number of characters removed (int)
+        added -- number of characters added (int)
+        '''
+        with profiling.timer("slot.text_change"):
+            document = self.full_text.document()
+            length = document.characterCount() - 1
+            # Qt counts the paragraph break at the end of the document too
+            removed = min(removed, self.text_mirror.length - position)
+            added = min(added, length - position)
+            added_text = self.document_text(position, position + added)
+            if (len(added_text) == added
+                    and self.text_mirror.length - removed + added == length):
+                block = document.findBlock(position)
+                removed_text = self.text_mirror.replace(block.blockNumber(),
+                                                        position - block.position(),
+                                                        removed, added_text)
+                self.placeholders.apply_change(
+                    lambda start, end: self.document_text(start, end).translate(PLAIN_TEXT),
+                    position, removed, added)
+            else:
+                # positions are UTF-16 based, rebuild when they don't line up
+                removed_text = self.text_mirror.text()
+                added_text = self.document_text(0, length)
+                self.text_mirror.reset(added_text)
+                self.placeholders.reset(added_text.translate(PLAIN_TEXT))
+                position = 0
+            removed_text = removed_text.translate(PLAIN_TEXT)
+            added_text = added_text.translate(PLAIN_TEXT)
+            if not self.replaying:
+                self.history.record(position, removed_text, added_text)
+            if self.filled:
+                # an edit to the story makes it a template being written again
+                self.filled = False
+                self.autosave_state()
+            if self.journal is not None:
+                self.journal.record(position, len(removed_text), added_text)
+                self.autosave_check()
+            self.history_buttons_update()
+            self.prompt_counter_label_update()
 
     def file_save(self):
         '''
-        Function to save file. Currently saves as docx file with no formatting
-        '''
-        document = Document()
-        document.add_heading(self.theme_text.text(), level=1)
-        document.add_paragraph(self.full_text.toPlainText())
-        document.add_paragraph()
-        document.add_heading("Do it again!")
-        document.add_paragraph(self.final_pre_text)
-        document.add_paragraph(str(self.added_prompts_dict))
-        name = QFileDialog.getSaveFileName(self, 'Save File')
-        if name[0]:
-            document.save(name[0] + '.docx')
-        else:
-            self.close()
+        Function to save file. Saves as a .madlib template file, or exports
+        a docx file with the answers in bold when Word document is picked
+        '''
+        with profiling.timer("slot.file_save") as timer:
+            with timer.paused():
+                name = QFileDialog.getSaveFileName(self, 'Save File',
+                                                   filter="Mad lib (*.madlib);;Word document (*.docx)")
+            if name[0]:
+                filled = self.showing_story()
+                template_text = self.final_pre_text if filled else self.full_text.toPlainText()
+                if name[1].startswith("Word") or name[0].endswith(".docx"):
+                    path = name[0] if name[0].endswith(".docx") else name[0] + '.docx'
+                    if filled:
+                        # the answers are bold and the template goes under Do it again!
+                        core.write_docx(path, self.theme_text.text(), self.full_text.toPlainText(),
+                                        self.final_pre_text, self.added_prompts_dict,
+                                        self.prompt_answers)
+                    else:
+                        core.write_docx(path, self.theme_text.text(), template_text, template_text,
+                                        dict(enumerate(self.added_prompts)))
+                    source = path
+                else:
+                    path = name[0] if name[0].endswith(".madlib") else name[0] + '.madlib'
+                    core.write_template(path, self.theme_text.text(), template_text,
+                                        self.prompt_answers)
+                    source = path + "#0"
+                if template_text:
+                    self.open_library().add(self.theme_text.text(), template_text,
+                                            os.path.abspath(source))
+
+    def showing_story(self):
+        '''
+        Function to tell whether the text box holds a story filled in from
+        final_pre_text, rather than a template being written. Answers keep
+        their brackets, so this can't be told from the text.
+        '''
+        return self.filled
+
+    def open_library(self):
+        '''Function to open the template library the first time it is used'''
+        if self.library is None:
+            self.library = Library()
+        return self.library
+
+    def start_autosave(self, journal=None):
+        '''
+        Function to bring back the last session from the autosave journal
+        and journal every edit from now on. Autosave is left off when
+        another window has the journal.
+
+        Keyword arguments:
+        journal -- journal to use, Journal() when None (Journal)
+        '''
+        with profiling.timer("slot.start_autosave"):
+            if journal is None:
+                try:
+                    journal = Journal()
+                except OSError as e:
+                    self.statusBar().showMessage("Autosave is off: " + str(e))
+                    return
+            state = journal.state
+            if journal.text or state.get("theme"):
+                self.theme_text.setText(state.get("theme", ""))
+                self.full_text.setPlainText(journal.text)
+                self.history_clear()
+                self.final_pre_text = state.get("template", "")
+                self.prompt_answers = dict(state.get("answers", {}))
+                self.filled = bool(state.get("filled"))
+                prompts = compile_template(self.final_pre_text).names if self.filled else self.added_prompts
+                self.added_prompts_dict = dict(enumerate(prompts))
+                self.prompt_counter_label_update()
+                self.statusBar().showMessage("Brought back your last mad lib")
+            self.journal = journal
+            self.autosave_state()
+
+    def autosave_state(self):
+        '''Function to journal the theme, template and answers after they change'''
+        if self.journal is not None:
+            self.journal.set_state(theme=self.theme_text.text(), template=self.final_pre_text,
+                                   answers=dict(self.prompt_answers), filled=self.filled)
+            self.autosave_check()
+
+    def autosave_check(self):
+        '''Function to give the journal a snapshot when it asks, and show its errors'''
+        if self.journal.wants_snapshot:
+            self.journal.snapshot(self.text_mirror.text())
+        if self.journal.error is not None:
+            self.statusBar().showMessage("Autosave failed: " + str(self.journal.error))
+            self.journal.error = None
+
+    def closeEvent(self, event):
+        '''Function to write the rest of the journal and stop prefetching before the window closes'''
+        if self.journal is not None:
+            self.journal.close()
+            self.journal = None
+        if self.prefetch is not None:
+            self.prefetch.close(wait=False)
+        super().closeEvent(event)
+
+    def generation_provider(self):
+        '''Function to return the provider picked in the Generate with menu'''
+        if self.providers is None:
+            self.providers = providers.default_providers(self.client, self.open_library())
+        name = self.provider_group.checkedAction().data()
+        return self.providers.get(name) or self.providers["openai"]
 
     def file_open(self):
         '''
-        Function to open a file. Used to re-do saved Mad Libs.
+        Function to pick a mad lib from the template library. Used to re-do saved Mad Libs.
+        Saved files can be imported into the library from the dialog.
         '''
-        name = QFileDialog.getOpenFileName(self, 'Open File',filter="Text files (*.docx)")
-        try:
-            document = Document(name[0])
-            text_to_grab = False
-            self.theme_text.setText(document.paragraphs[0].text) #  set theme
-            # loop through paragraphs and find do it over text
-            for paragraph in document.paragraphs:
-                if paragraph.text == "":
-                    pass
-                elif paragraph.text.upper() == "DO IT AGAIN!":
-                    # next loop contains text to grab
-                    text_to_grab = True
-                elif paragraph.text[0] == "{":
-                    text_to_grab = False
-                    pass
-                elif text_to_grab == True:
-                    self.current_text = paragraph.text
-        except opc.exceptions.PackageNotFoundError:
-            pass
-        # convert text to sorted dictionary
-        try:
-            self.added_prompts = re.findall(r'\[\s*([a-zA-Z\s]+[0-9]*)\s*\]', self.current_text)
-            for i, prompt in enumerate(self.added_prompts):
-                self.added_prompts_dict[i] = prompt
-            self.full_text.setText(self.current_text)
-            self.theme_text.setReadOnly(False)
-            self.full_text.setReadOnly(False)
-            self.done_button.setEnabled(True)
-            self.undo_button.setEnabled(True)
-            self.prompt_counter_label_update()
+        with profiling.timer("slot.file_open") as timer:
+            dialog = LibraryDialog(self.open_library(), self)
+            with timer.paused():
+                chosen = dialog.exec()
+            if not chosen or dialog.entry is None:
+                return
+            self.theme_text.setText(dialog.entry.theme) #  set theme
+            self.current_text = dialog.entry.text
+            # convert text to sorted dictionary
+            try:
+                self.full_text.setText(self.current_text)
+                self.history_clear()
+                self.final_pre_text = ""
+                self.filled = False
+                self.prompt_answers = {}
+                self.added_prompts_dict = {}
+                self.autosave_state()
+                for i, prompt in enumerate(self.added_prompts):
+                    self.added_prompts_dict[i] = prompt
+                self.theme_text.setReadOnly(False)
+                self.full_text.setReadOnly(False)
+                self.done_button.setEnabled(True)
+                self.prompt_counter_label_update()
 
-            for button in self.prompt_group.buttons():
-                button.setEnabled(True)
-        # error if application is already open
-        except:
-            self.full_text.setText("INVALID CONFIG. MAKE A NEW MAD LIB YA GOOF")
+                for button in self.prompt_group.buttons():
+                    button.setEnabled(True)
+            # error if application is already open
+            except:
+                self.full_text.setText("INVALID CONFIG. MAKE A NEW MAD LIB YA GOOF")
 
     def change_image(self):
         '''
         Function to allow user to change the background image based on
         selecting a file
         '''
-        image_path, _ = QFileDialog.getOpenFileName()
+        image_path, _ = QFileDialog.getOpenFileName(self, "Change Background",
+                                                    os.path.dirname(DEFAULT_PATH), IMAGE_FILTER)
         if image_path:
-            image_name = os.path.basename(image_path)
-            self.setStyleSheet("MainWindow{ border-image:url("
-                               + "backgrounds/" + image_name +
-                               "); background-repeat: no-repeat;"
-                               "background-position: center}")
-            
+            self.background.set_image(image_path)
+            self.update()
+
+    def background_failed(self, path):
+        '''
+        Function to report a background image which couldn't be read
+
+        Keyword Arguments
+        path -- image file (str)
+        '''
+        self.error_text.setText("Couldn't open " + os.path.basename(path) + " as an image")
+        self.error_text.show()
+
+    def paintEvent(self, event):
+        '''Function to draw the background from the cache behind the widgets'''
+        painter = QPainter(self)
+        self.background.paint(painter, self.rect(), self.devicePixelRatioF())
+        painter.end()
+        super().paintEvent(event)
+
     def ai_generate(self):
         '''
         Function to use ChatGPT to generate a mad lib based on the theme and number of prompts input by the user. Attempts to generate a one-paragraph mad lib based on the 
-        chosen theme. Checks for the correct number of prompts and quits if it is unable to generate it with the correct number of prompts.
-        Currently uses the GPT4.0 model.
-        '''
-        isCanceled = False
-        retries = 1
-        max_retries = 3
-        # no current checking for good input. Uses defaults for blank answers.
-        theme_madlib, done1 = QInputDialog.getText(self, 'Theme Selection', 'Enter the theme to generate:')
-        if done1:
-            if not theme_madlib:
-                # picking a default of winter for now
-                theme_madlib = "Winter"
-            number_of_blanks, done2 = QInputDialog.getText(self, 'Prompt Number', 'Enter how many prompts should be generated:')
-            if done2:
-                if not number_of_blanks:
-                    # choose a random number of prompts between 1 and 10 if none given
-                    number_of_blanks = str(random.randint(1, 10))
-
-                prompt = f"""Generate a one-paragraph Mad Lib based on the theme of {theme_madlib} using **exactly** {number_of_blanks} placeholders. 
-                        The total number of placeholders in the paragraph **must be exactly {number_of_blanks}**. Do not generate any more or any fewer placeholders.
-                        Here are the allowed prompt types: Verb Past Tense, Plural Noun, Silly word, Adjective, Body Part, Animal, Verb, Verb ending in ing, Adverb, Adjective, Number, Colour, Type of Liquid, Type of Food, Place, Celebrity, Exclamation, Person in Room, Part of the Body, Part of the Body Plural.
-                        **Instructions**:
-                        1. Include exactly {number_of_blanks} placeholders in the paragraph.
-                        2. Mark each fill-in-the-blank spot in square brackets with ascending numbers (e.g., [adjective1], [verb1], [noun1]).
-                        3. If duplicates are needed, give each a unique number (e.g., [verb1], [verb2]).
-                        4. Count the number of placeholders in your response to ensure the total is *exactly* {number_of_blanks}. If the count is incorrect, regenerate the paragraph.
-
-                        Do not list the placeholders separately; only integrate them into the paragraph. Double-check the output before responding to ensure the correct number of placeholders."""
-                
-                # try to generate the mad lib. If the incorrect number of prompts is used, try again up to a max of 3 tries before just giving up. Sometimes the model is dumb.
-                while retries <= max_retries:
-                    try:
-                        chat_completion = self.client.chat.completions.create(
-                        messages=[{"role": "user","content": prompt}],
-                        temperature=0.2,
-                        max_tokens=500,
-                        model="gpt-4",
-                        )
-                        # Extract the response content
-                        response_content = chat_completion.choices[0].message.content
-
-                        # regex to remove prompts and paragraph
-                        mad_lib_paragraph = re.sub(r'\n.*', '', response_content).strip()
-                        self.final_pre_text = mad_lib_paragraph
-                        prompt_matches = re.findall(r'\[\s*([a-zA-Z\s]+[0-9]*)\s*\]', response_content)
-    
-                        if len(prompt_matches) == int(number_of_blanks):
-                            isCanceled = False
-                            break
-                        else:
-                            retries += 1
-                    except Exception as e:
-                        self.error_text.setText(f"An error occurred: {e}")
+        chosen theme. The request runs on a worker thread so the window stays responsive, and can be cancelled from the progress dialog.
+        Uses the generator picked in the Generate with menu, GPT4.0 by default.
+        '''
+        with profiling.timer("slot.ai_generate") as timer:
+            max_retries = 3
+            # no current checking for good input. Uses defaults for blank answers.
+            with timer.paused():
+                theme_madlib, done1 = QInputDialog.getText(self, 'Theme Selection', 'Enter the theme to generate:')
+            if done1:
+                if not theme_madlib:
+                    # picking a default of winter for now
+                    theme_madlib = "Winter"
+                with timer.paused():
+                    number_of_blanks, done2 = QInputDialog.getText(self, 'Prompt Number', 'Enter how many prompts should be generated:')
+                if done2:
+                    if not number_of_blanks:
+                        # choose a random number of prompts between 1 and 10 if none given
+                        number_of_blanks = str(random.randint(1, 10))
+                    if not number_of_blanks.strip().isdigit():
+                        self.error_text.setText("The number of prompts must be a number")
                         self.error_text.show()
-                        break
+                        return
+                    self.error_text.hide()
+                    self.generation_theme = theme_madlib
+                    if self.cache is None:
+                        self.cache = GenerationCache()
+                    parallel = 3 if self.race_action.isChecked() else 1
+                    provider = self.generation_provider()
 
-                if retries > max_retries:
-                    self.full_text.setReadOnly(False)
-                    self.full_text.setText("Failed to generate a mad lib correctly. Try again.")
-            else:
-                # clicked cancel on the second prompt.
-                isCanceled = True
-            
-            if isCanceled:
-                self.close()
-            # fill dictionary with prompts
-            else:
-                prompt_dict = {}
-                for i, prompt in enumerate(prompt_matches):
-                    prompt_dict[i] = prompt
+                    if self.prefetch_action.isChecked():
+                        if self.prefetch is None:
+                            self.prefetch = PrefetchPool(cache=self.cache)
+                        ready_paragraph = self.prefetch.pop(provider, theme_madlib, int(number_of_blanks))
+                        if ready_paragraph is not None:
+                            stats = self.prefetch.stats()
+                            self.statusBar().showMessage("Ready straight away ("
+                                                         + format(stats["hit_rate"], ".0%")
+                                                         + " of mad libs were ready)")
+                            self.ai_generate_done(ready_paragraph, from_cache=True)
+                            return
 
-                mad_lib_filled = mad_lib_paragraph.format(**prompt_dict)
-                self.theme_text.setText(theme_madlib)
-                self.theme_text.setReadOnly(True)
-                self.full_text.setText(mad_lib_filled)
-                self.full_text.setReadOnly(True)
-                self.done_button.setEnabled(False)
-                self.undo_button.setEnabled(False)
-                self.prompt_counter_label.setText("Number of Prompts: " + number_of_blanks)
+                    if self.cached_action.isChecked():
+                        cached_paragraph = self.cache.get(cache_key(theme_madlib, int(number_of_blanks),
+                                                                    provider.model))
+                        if cached_paragraph is not None:
+                            # generate a fresh variant for next time without touching the window
+                            self.refresh_worker = GenerationWorker(provider, theme_madlib,
+                                                                   int(number_of_blanks), max_retries,
+                                                                   parallel, self.cache)
+                            QThreadPool.globalInstance().start(self.refresh_worker)
+                            stats = self.cache.stats()
+                            self.statusBar().showMessage("Served from cache ("
+                                                         + str(stats["hits"]) + " hits, "
+                                                         + str(stats["misses"]) + " misses)")
+                            self.ai_generate_done(cached_paragraph, from_cache=True)
+                            return
 
-                for button in self.prompt_group.buttons():
-                    button.setEnabled(False)
-                # loop through prompts and get responses
-                prompt_responses = {}
-                for key, value in prompt_dict.items():
-                    if isCanceled:
-                        pass
-                    else:
-                        prompt_answer, done3 = QInputDialog.getText(self, 'Fill-in-the-blanks!', 'Enter a(n) ' + str(value[:-1]) + ':')
-                        if done3:
-                            prompt_responses[value] = prompt_answer
-                            isCanceled = False
-                        else:
-                            isCanceled = True
+                    # try to generate the mad lib. If the incorrect number of prompts is used, try again up to a max of 3 tries before just giving up. Sometimes the model is dumb.
+                    self.generation_worker = GenerationWorker(provider, theme_madlib,
+                                                              int(number_of_blanks), max_retries,
+                                                              parallel, self.cache,
+                                                              self.stream_action.isChecked())
+                    self.generation_progress = QProgressDialog("Generating a mad lib...", "Cancel",
+                                                               0, max(max_retries, parallel), self)
+                    self.generation_progress.setWindowModality(Qt.WindowModality.WindowModal)
+                    self.generation_progress.setMinimumDuration(0)
+                    self.generation_progress.canceled.connect(self.generation_worker.cancel)
+                    signals = self.generation_worker.signals
+                    signals.progress.connect(self.ai_generate_progress)
+                    signals.text.connect(self.ai_generate_text)
+                    signals.finished.connect(self.ai_generate_done)
+                    signals.failed.connect(self.ai_generate_failed)
+                    signals.cache_failed.connect(self.cache_failed)
+                    QThreadPool.globalInstance().start(self.generation_worker)
+                else:
+                    # clicked cancel on the second prompt.
+                    self.close()
+            else:
+                # clicked cancel on first dialog
+                print("hi")
+                pass
+                #self.close()
 
-                # replace prompts with answers
-                for key in prompt_responses:
-                    mad_lib_paragraph = mad_lib_paragraph.replace(key, prompt_responses[key])
-                
-                self.theme_text.setReadOnly(False)
-                self.full_text.setText(mad_lib_paragraph)
+    def ai_generate_progress(self, attempt, max_retries):
+        '''
+        Function to show which attempt the generation worker is on
+
+        Keyword Arguments
+        attempt -- current request number (int)
+        max_retries -- maximum number of requests (int)
+        '''
+        if self.generation_worker.parallel > 1:
+            self.generation_progress.setLabelText("Generating a mad lib... ("
+                                                  + str(attempt) + " of " + str(max_retries) + " replies)")
+            self.generation_progress.setValue(attempt)
         else:
-            # clicked cancel on first dialog
-            print("hi")
-            pass
-            #self.close()
+            self.generation_progress.setLabelText("Generating a mad lib... (attempt "
+                                                  + str(attempt) + " of " + str(max_retries) + ")")
+            self.generation_progress.setValue(attempt - 1)
+        if self.generation_worker.stream:
+            # start again for each attempt
+            self.theme_text.setText(self.generation_theme)
+            self.stream_discard()
+            self.full_text.setReadOnly(True)
+            self.full_text.setText("")
+
+    def ai_generate_text(self, text):
+        '''
+        Function to add streamed text to the end of the mad lib. The prompt
+        counter follows along through the prompt index.
+
+        Keyword Arguments
+        text -- next piece of the generated paragraph (str)
+        '''
+        self.stream_buffer.append(text)
+        if not self.stream_timer.isActive():
+            self.stream_timer.start()
+
+    def ai_generate_flush(self):
+        '''Function to put the streamed text received since the last flush in the window'''
+        with profiling.timer("slot.ai_generate_text"):
+            if self.stream_buffer:
+                cursor = QTextCursor(self.full_text.document())
+                cursor.movePosition(QTextCursor.MoveOperation.End)
+                cursor.insertText("".join(self.stream_buffer))
+                self.stream_buffer.clear()
+
+    def stream_discard(self):
+        '''Function to drop streamed text not yet shown, e.g. when the attempt is over'''
+        self.stream_timer.stop()
+        self.stream_buffer.clear()
+
+    def ai_generate_failed(self, error):
+        '''
+        Function to report a generation that never produced a valid mad lib
+
+        Keyword Arguments
+        error -- last error from the client, empty if there was none (str)
+        '''
+        self.stream_discard()
+        self.generation_progress.reset()
+        self.statusBar().showMessage(generation.summarize_attempts(self.generation_worker.attempts))
+        if error:
+            self.error_text.setText(f"An error occurred: {error}")
+            self.error_text.show()
+        self.full_text.setReadOnly(False)
+        self.full_text.setText("Failed to generate a mad lib correctly. Try again.")
+        self.history_clear()
+
+    def cache_failed(self, error):
+        '''
+        Function to report a generated mad lib which couldn't be cached
+
+        Keyword Arguments
+        error -- what went wrong (str)
+        '''
+        self.statusBar().showMessage("Couldn't cache the mad lib: " + error)
+
+    def ai_generate_done(self, mad_lib_paragraph, from_cache=False):
+        '''
+        Function to fill in a generated mad lib once the worker returns it
+
+        Keyword Arguments
+        mad_lib_paragraph -- validated mad lib text (str)
+        from_cache -- True when served from the cache without a worker (bool)
+        '''
+        with profiling.timer("slot.ai_generate_done") as timer:
+            self.stream_discard()
+            if not from_cache:
+                self.generation_progress.reset()
+                self.statusBar().showMessage(generation.summarize_attempts(self.generation_worker.attempts))
+            theme_madlib = self.generation_theme
+            self.final_pre_text = mad_lib_paragraph
+            template = compile_template(mad_lib_paragraph)
+
+            self.theme_text.setText(theme_madlib)
+            self.theme_text.setReadOnly(True)
+            self.full_text.setText(mad_lib_paragraph)
+            self.history_clear()
+            self.full_text.setReadOnly(True)
+            self.done_button.setEnabled(False)
+            self.prompt_counter_label.setText("Number of Prompts: " + str(len(template)))
+
+            for button in self.prompt_group.buttons():
+                button.setEnabled(False)
+            # get all the responses in one form
+            session = FillSession(mad_lib_paragraph)
+            dialog = FillDialog(session, self)
+            with timer.paused():
+                accepted = dialog.exec() == QDialog.DialogCode.Accepted
+            if not accepted:
+                self.edit_template()
+                return
+
+            # replace prompts with answers
+            self.prompt_answers = dict(session.answers)
+            self.autosave_state()
+            self.theme_text.setReadOnly(False)
+            self.fill_text(session)
 
     def custom_prompt_window(self):
         '''
@@ -407,36 +1154,124 @@ class MainWindow(QMainWindow):
 
     def on_sub_window_confirm(self, prompt):
         '''
-        Function to fill in custom prompt received from custom_prompt_window
+        Function to fill in custom prompt received from custom_prompt_window.
+        Digits and brackets are taken out so the prompt reads back as typed.
 
         Keyword Arguments
         prompt -- custom prompt (str)
         '''
-        self.add_a_prompt(prompt)
+        type_name = clean_type(prompt)
+        if not type_name:
+            self.error_text.show()
+            self.error_text.setText("Custom prompts need some letters in them!")
+            return
+        self.error_text.hide()
+        self.add_a_prompt(type_name)
 
     ###################################################
     # Helper Function definitions
     ###################################################
 
     def prompt_counter_label_update(self):
-        '''Update prompt label with new count'''
+        '''Update prompt label with new count, a filled in story has none left'''
         self.prompt_counter_label.setText("Number of Prompts: "
-                                          + str(len(self.added_prompts)))
+                                          + str(0 if self.filled else len(self.added_prompts)))
         
-    def clear_all(self):
-        self.full_text.setText("")
-        self.full_text.setReadOnly(False)
-        self.theme_text.setText("")
-        self.theme_text.setReadOnly(False)
-        self.done_button.setEnabled(True)
-        self.undo_button.setEnabled(True)
+    def history_buttons_update(self):
+        '''Enable undo and redo when there is something to undo or redo'''
+        self.undo_button.setEnabled(self.history.can_undo())
+        self.redo_button.setEnabled(self.history.can_redo())
+
+    def history_clear(self):
+        '''Forget the edits so far, e.g. after loading a new mad lib'''
+        self.history.clear()
+        self.history_buttons_update()
 
+    def edit_text(self, edits):
+        '''
+        Function to make (position, length to remove, text to insert) edits to
+        the text one after the other in one edit block
+
+        Keyword arguments:
+        edits -- edits from the history or a fill session (list)
+        '''
+        if not edits:
+            return
+        if not (self.text_mirror.length == self.full_text.document().characterCount() - 1
+                and all(_same_offsets(text) for _, _, text in edits)):
+            # Qt counts positions in UTF-16, so edit a copy and swap it in
+            self.full_text.setPlainText(apply_edits(self.text_mirror.text(), edits))
+            return
+        cursor = QTextCursor(self.full_text.document())
+        cursor.beginEditBlock()
+        for position, length, text in edits:
+            cursor.setPosition(position)
+            cursor.setPosition(position + length, QTextCursor.MoveMode.KeepAnchor)
+            cursor.insertText(text)
+        cursor.endEditBlock()
+        self.full_text.setTextCursor(cursor)
+
+    def replay(self, edits):
+        '''
+        Function to apply undo or redo edits without recording them and go
+        back to writing the mad lib
+
+        Keyword arguments:
+        edits -- edits from the history (list)
+        '''
+        if not edits:
+            return
+        self.replaying = True
+        try:
+            self.edit_text(edits)
+        finally:
+            self.replaying = False
+        self.edit_template()
+
+    def edit_template(self):
+        '''Function to go back to writing the mad lib, e.g. when filling in is cancelled'''
+        self.theme_text.setReadOnly(False)
+        self.full_text.setReadOnly(False)
+        self.done_button.setEnabled(len(self.added_prompts) > 0)
         for button in self.prompt_group.buttons():
             button.setEnabled(True)
+        self.history_buttons_update()
+        self.full_text.setFocus()
+
+    def fill_text(self, session):
+        '''
+        Function to put the answers into the text as one step which can be
+        undone, editing only the prompts
+
+        Keyword arguments:
+        session -- filled in answers (FillSession)
+        '''
+        with profiling.timer("slot.fill_text"):
+            self.added_prompts_dict = dict(enumerate(session.template.names))
+            with self.history.group():
+                self.edit_text(FillSession(self.text_mirror.text()).update(session.answers))
+            self.filled = True
+            self.autosave_state()
+            self.history_buttons_update()
+            self.prompt_counter_label_update()
+
+    def clear_all(self):
+        with profiling.timer("slot.clear_all"):
+            self.full_text.setText("")
+            self.full_text.setReadOnly(False)
+            self.theme_text.setText("")
+            self.theme_text.setReadOnly(False)
+            self.done_button.setEnabled(True)
+
+            for button in self.prompt_group.buttons():
+                button.setEnabled(True)
         
-        self.added_prompts = []
-        self.added_prompts_dict = {}
-        self.prompt_counter_label_update()
+            self.added_prompts_dict = {}
+            self.prompt_answers = {}
+            self.final_pre_text = ""
+            self.filled = False
+            self.autosave_state()
+            self.prompt_counter_label_update()
 
 
     ###################################################
@@ -451,68 +1286,39 @@ class MainWindow(QMainWindow):
         Keyword arguments:
         prompt -- text of button which was pressed (str)
         '''
-        if not prompt:
-            # skip if no text in the prompt. Usually from custom prompts
-            pass
-        elif prompt.upper() == "CUSTOM":
-            self.custom_prompt_window()
-        else:
-            # first one added then check if any were deleted
-            if len(self.added_prompts) == 0:
-                self.added_prompts.append(prompt + str(len(self.added_prompts) + 1))
-                self.cursor.insertText("[" + prompt + str(len(self.added_prompts)) + "]")
-                prompt_matches = re.findall(r'\[\s*([a-zA-Z\s]+[0-9]*)\s*\]', self.full_text.toPlainText())
-                self.added_prompts = prompt_matches
+        with profiling.timer("slot.add_a_prompt"):
+            if not prompt:
+                # skip if no text in the prompt. Usually from custom prompts
+                pass
+            elif prompt.upper() == "CUSTOM":
+                self.custom_prompt_window()
             else:
-                # if one prompt already was put in, check that any weren't deleted then add new one
-                prompt_matches = re.findall(r'\[\s*([a-zA-Z\s]+[0-9]*)\s*\]', self.full_text.toPlainText())
-                self.added_prompts = prompt_matches
-                self.added_prompts.append(prompt + str(len(self.added_prompts) + 1))
-                self.cursor.insertText("[" + prompt + str(len(self.added_prompts)) + "]")
+                # number the new prompt after the ones still in the text,
+                # the index picks up the inserted prompt from the edit
+                cursor = self.full_text.textCursor()
+                cursor.insertText("[" + core.prompt_name(prompt, len(self.added_prompts)) + "]")
+                self.full_text.setTextCursor(cursor)
 
-            self.prompt_counter_label_update()
-            self.full_text.setFocus()
-            # show undo button after first prompt is entered
-            if self.undo_button.isEnabled() is False:
-                self.undo_button.setEnabled(True)
-            if self.done_button.isEnabled() is False:
-                self.done_button.setEnabled(True)
+                self.full_text.setFocus()
+                if self.done_button.isEnabled() is False:
+                    self.done_button.setEnabled(True)
 
-    def undo_prompt(self):
+    def undo_edit(self):
         '''
-        Function to remove the last prompt entered in
-        Separate from undoing the last fill-in-the-blank
+        Function to undo the last edit to the text: a prompt added, text
+        typed or deleted, or the answers filled in
         Activated by the Undo button
         '''
-        if self.fill_in_blanks_mode:
-            pass
-        else:
-            self.current_text = self.full_text.toPlainText()
-            prompt_to_remove = self.added_prompts[-1]
-            prompt_loc = self.current_text.find(prompt_to_remove)
-            if prompt_loc >= 0:
-            # move cursor to prompt location, then select and remove the text
-                self.cursor.setPosition(prompt_loc - 1,
-                                        QTextCursor.MoveMode.MoveAnchor)
-                self.cursor.movePosition(QTextCursor.MoveOperation.Right,
-                                        QTextCursor.MoveMode.KeepAnchor,
-                                        len(prompt_to_remove) + 2)
-                self.cursor.removeSelectedText()
-
-                # put cursor back to where the prompt was removed
-                self.full_text.setTextCursor(self.cursor)
-                self.full_text.setFocus()
+        with profiling.timer("slot.undo_edit"):
+            self.replay(self.history.undo())
 
-                prompt_matches = re.findall(r'\[\s*([a-zA-Z\s]+[0-9]*)\s*\]', self.full_text.toPlainText())
-                self.added_prompts = prompt_matches
-
-                # clean up behind the scenes
-                self.prompt_counter_label_update()
-                if len(self.added_prompts) == 0:
-                    self.undo_button.setEnabled(False)
-                    self.done_button.setEnabled(False)
-            else:
-                pass
+    def redo_edit(self):
+        '''
+        Function to redo the last edit undone
+        Activated by the Redo button
+        '''
+        with profiling.timer("slot.redo_edit"):
+            self.replay(self.history.redo())
 
     def start_fill_in_the_blank(self):
         '''
@@ -520,59 +1326,52 @@ class MainWindow(QMainWindow):
         text after clicking next.
         Activated by the Done button
         '''
-        self.prompt_counter_label_update()
-        isCanceled = False
-        if len(self.added_prompts) == 0:
-            # error label
-            self.error_text.show()
-            self.error_text.setText("You didn't write any fill-in-the-blanks!")
-            pass
-        else:
-            self.error_text.hide()
-            self.final_pre_text = self.full_text.toPlainText()
-            self.current_text = self.full_text.toPlainText()
-            self.theme_text.setReadOnly(True)
-            self.full_text.setReadOnly(True)
-            self.done_button.setEnabled(False)
-            self.undo_button.setEnabled(False)
+        with profiling.timer("slot.start_fill_in_the_blank") as timer:
+            self.prompt_counter_label_update()
+            if len(self.added_prompts) == 0:
+                # error label
+                self.error_text.show()
+                self.error_text.setText("You didn't write any fill-in-the-blanks!")
+                pass
+            else:
+                self.error_text.hide()
+                self.final_pre_text = self.full_text.toPlainText()
+                self.current_text = self.full_text.toPlainText()
+                self.theme_text.setReadOnly(True)
+                self.full_text.setReadOnly(True)
+                self.done_button.setEnabled(False)
+                self.undo_button.setEnabled(False)
 
-            for button in self.prompt_group.buttons():
-                button.setEnabled(False)
-            # loop through prompts and get responses
+                for button in self.prompt_group.buttons():
+                    button.setEnabled(False)
 
-            for i, prompt in enumerate(self.added_prompts):
-                self.added_prompts_dict[i] = prompt
+                # get all the responses in one form
+                session = FillSession(self.final_pre_text)
+                dialog = FillDialog(session, self)
+                with timer.paused():
+                    accepted = dialog.exec() == QDialog.DialogCode.Accepted
+                if not accepted:
+                    self.edit_template()
+                    return
 
-            prompt_responses = {}
-            for key, value in self.added_prompts_dict.items():
-                if isCanceled:
-                    print("hi")
-                    self.close()
-                else:
-                    prompt_answer, done3 = QInputDialog.getText(self, 'Fill-in-the-blanks!', 'Enter a(n) ' + str(value[:-1]) + ':')
-                    if done3:
-                        prompt_responses[value] = prompt_answer
-                        isCanceled = False
-                    else:
-                        isCanceled = True
+                # replace prompts with answers
+                self.prompt_answers = dict(session.answers)
+                self.current_text = session.render()
+                self.autosave_state()
 
-            # replace prompts with answers
-            for key in prompt_responses:
-                self.current_text = self.current_text.replace(key, prompt_responses[key])
-            
-            self.theme_text.setReadOnly(False)
-            self.full_text.setReadOnly(False)
-            self.full_text.setText(self.current_text)
+                self.theme_text.setReadOnly(False)
+                self.full_text.setReadOnly(False)
+                self.fill_text(session)
+
+def main():
+    profiling.configure(sys.argv)  # --profile / MADLIBS_PROFILE
+    app = QApplication(sys.argv)
+    window = MainWindow()
+    window.start_autosave()
+    window.show()
 
-stylesheet_main = """
-        MainWindow {
-        background-image: url("backgrounds/silly.png") repeat;
-    }
-"""
+    app.exec()
 
-app = QApplication(sys.argv)
-app.setStyleSheet(stylesheet_main)  # background image
-window = MainWindow()
-window.show()
 
-app.exec()
+if __name__ == "__main__":
+    main()
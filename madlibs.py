@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+'''
+Command line for running mad libs without the GUI.
+
+    python -m madlibs batch --templates templates.jsonl --answers answers.csv
+    python -m madlibs export --templates templates.jsonl --answers answers.csv --output booklet.docx
+    python -m madlibs import saved_mad_libs/
+    python -m madlibs search --theme space --blanks 8-12 --type Celebrity
+    python -m madlibs sample --templates templates.jsonl --count 100000 --seed 1
+    python -m madlibs generate --theme space --blanks 8 --provider local
+    python -m madlibs serve --port 8765
+    python -m madlibs loadtest --games 2000 --players 4
+
+Add --profile[=FILE] to any command to record timings (see profiling.py).
+
+Templates are JSON lines with id, theme and text fields, or a CSV with the
+same columns. Answer sets are JSON lines with id, template (optional) and
+answers fields, or a CSV with id and template columns plus one column per
+prompt name. Answer sets without a template are filled into every template.
+'''
+import os
+import sys
+import csv
+import json
+import time
+import argparse
+import core
+import profiling
+
+
+def read_templates(path):
+    '''
+    Function to load all templates from a JSON lines or CSV file
+
+    Keyword arguments:
+    path -- templates file (str)
+    '''
+    templates = {}
+    with open(path, newline="", encoding="utf-8") as file:
+        if path.endswith(".csv"):
+            records = csv.DictReader(file)
+        else:
+            records = (json.loads(line) for line in file if line.strip())
+        for record in records:
+            templates[str(record["id"])] = (record.get("theme", ""), record["text"])
+    return templates
+
+
+def parse_csv_answer_set(record):
+    '''Turn a CSV row into (answer set id, template id or None, answers)'''
+    answers_id = record.pop("id")
+    template_id = record.pop("template", "") or None
+    answers = {key: value for key, value in record.items() if value}
+    return answers_id, template_id, answers
+
+
+def parse_json_answer_set(line):
+    '''Turn a JSON line into (answer set id, template id or None, answers)'''
+    record = json.loads(line)
+    template_id = record.get("template")
+    return (str(record["id"]), None if template_id is None else str(template_id),
+            record["answers"])
+
+
+def format_json_story(row):
+    return json.dumps(row) + "\n"
+
+
+def read_answer_sets(path):
+    '''
+    Function to stream raw answer set records from a JSON lines or CSV
+    file. Returns the records and the function which parses one, so the
+    parsing can happen in the worker processes.
+
+    Keyword arguments:
+    path -- answer sets file (str)
+    '''
+    def records():
+        with open(path, newline="", encoding="utf-8") as file:
+            if path.endswith(".csv"):
+                yield from csv.DictReader(file)
+            else:
+                yield from (line for line in file if line.strip())
+    if path.endswith(".csv"):
+        return records(), parse_csv_answer_set
+    return records(), parse_json_answer_set
+
+
+def report_skipped(skipped):
+    '''Function to list the answer sets left out because their template id is unknown'''
+    if skipped:
+        print(f"{len(skipped)} answer sets skipped, their template isn't in the templates file: "
+              + ", ".join(f"{answers_id} (template {template_id})"
+                          for answers_id, template_id in skipped[:10])
+              + (", ..." if len(skipped) > 10 else ""), file=sys.stderr)
+
+
+def batch(args):
+    '''Function to render every answer set and write the stories out'''
+    templates = read_templates(args.templates)
+    answer_sets, parse = read_answer_sets(args.answers)
+    output = open(args.output, "w", newline="", encoding="utf-8") if args.output else sys.stdout
+    count = 0
+    skipped = []
+    start = time.perf_counter()
+    try:
+        if args.output and args.output.endswith(".csv"):
+            writer = csv.DictWriter(output, ["template", "answers", "theme", "story"])
+            writer.writeheader()
+            write, format_row = writer.writerow, None
+        else:
+            write, format_row = output.write, format_json_story
+        for row in core.render_batch(templates, answer_sets, args.workers,
+                                     args.chunk_size, parse, format_row, skipped=skipped):
+            write(row)
+            count += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(f"{count} stories in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} stories/sec)",
+          file=sys.stderr)
+    report_skipped(skipped)
+
+
+def export(args):
+    '''Function to write filled in mad libs to a Word booklet or a folder of documents'''
+    import export as exporter
+    templates = read_templates(args.templates)
+    answer_sets, parse = read_answer_sets(args.answers)
+    start = time.perf_counter()
+    skipped = []
+    count, size = exporter.export_stories(templates, answer_sets, args.output, args.workers,
+                                          args.chunk_size, parse, skipped)
+    elapsed = max(time.perf_counter() - start, 1e-9)
+    if os.path.isfile(args.output):
+        size = os.path.getsize(args.output)
+    print(f"{count} stories exported to {args.output} in {elapsed:.2f}s "
+          f"({count / elapsed:.0f} stories/sec, {size / elapsed / 2 ** 20:.1f}MB/sec written)",
+          file=sys.stderr)
+    report_skipped(skipped)
+
+
+def import_templates(args):
+    '''Function to add saved files and folders to the template library'''
+    from library import Library
+    library = Library(args.library)
+    start = time.perf_counter()
+    added = 0
+    files = [path for path in args.paths if not os.path.isdir(path)]
+    if files:
+        added += library.import_files(files, args.workers)
+    for path in args.paths:
+        if os.path.isdir(path):
+            added += library.import_directory(path, args.workers)
+    print(f"imported {added} mad libs in {time.perf_counter() - start:.2f}s "
+          f"({len(library)} in the library)", file=sys.stderr)
+
+
+def search(args):
+    '''Function to print the library templates matching a search'''
+    from library import Library
+    min_blanks = max_blanks = None
+    if args.blanks:
+        low, dash, high = args.blanks.partition("-")
+        min_blanks = int(low) if low else None
+        max_blanks = int(high) if high else (None if dash else min_blanks)
+    entries = Library(args.library).search(args.theme, args.text, min_blanks,
+                                           max_blanks, args.type, args.limit)
+    for entry in entries:
+        print(f"{entry.id}\t{entry.blank_count}\t{entry.theme}\t{entry.source or ''}")
+
+
+def sample(args):
+    '''Function to write random answer sets for every template from the word lists'''
+    from vocabulary import Vocabulary
+    vocabulary = Vocabulary.load(args.vocabulary)
+    templates = read_templates(args.templates)
+    output = open(args.output, "w", encoding="utf-8") if args.output else sys.stdout
+    count = 0
+    start = time.perf_counter()
+    try:
+        for i, (template_id, (_, text)) in enumerate(templates.items()):
+            seed = None if args.seed is None else args.seed + i
+            answer_sets = vocabulary.sample_answer_sets(text, args.count, seed,
+                                                        unique=not args.repeats)
+            for number, answers in enumerate(answer_sets, 1):
+                output.write(json.dumps({"id": template_id + "-" + str(number),
+                                         "template": template_id, "answers": answers}) + "\n")
+                count += 1
+    finally:
+        if output is not sys.stdout:
+            output.close()
+    elapsed = time.perf_counter() - start
+    print(f"{count} answer sets in {elapsed:.2f}s ({count / max(elapsed, 1e-9):.0f} sets/sec)",
+          file=sys.stderr)
+
+
+def generate(args):
+    '''Function to print generated mad libs and how long each provider took'''
+    import providers
+    from generation import GenerationFailed, summarize_attempts
+    library = None
+    if args.library:
+        from library import Library
+        library = Library(args.library)
+    texts = [text for _, text in read_templates(args.templates).values()] if args.templates else []
+    choices = {"openai": providers.ChatProvider(),
+               "local": providers.LocalProvider(texts, library, args.seed)}
+    endpoint = (providers.EndpointProvider(args.endpoint, args.model or "default")
+                if args.endpoint else providers.EndpointProvider.from_environment())
+    if endpoint is not None:
+        choices["endpoint"] = endpoint
+    choices["auto"] = providers.Router(list(choices.values()), args.deadline)
+    if args.provider not in choices:
+        raise SystemExit("set MADLIBS_ENDPOINT or --endpoint to use the endpoint provider")
+    provider = choices[args.provider]
+    failed = 0
+    attempts = []
+    for _ in range(args.count):
+        try:
+            print(provider.generate(args.theme, args.blanks, attempts=attempts))
+        except GenerationFailed as e:
+            failed += 1
+            print("failed: " + str(e.error or e), file=sys.stderr)
+    print(summarize_attempts(attempts), file=sys.stderr)
+    for stats in (provider.stats() if args.provider == "auto" else [provider.stats()]):
+        print(f"{stats['name']:<9} cost={stats['cost']:<5g} runs={stats['count']:<5} "
+              f"failures={stats['failures']:<3} mean={stats['mean'] * 1e3:9.2f}ms "
+              f"estimate={stats['estimate'] * 1e3:9.2f}ms", file=sys.stderr)
+    if failed:
+        raise SystemExit(f"{failed} of {args.count} mad libs failed")
+
+
+def serve(args):
+    '''Function to run the group game server (see server.py)'''
+    import server
+
+    def ready(port):
+        print(f"serving on http://{args.host}:{port}", flush=True)
+    server.run(args.host, args.port, args.max_games, args.ttl, ready)
+
+
+def loadtest(args):
+    '''Function to play many games at once against a game server'''
+    import loadtest as harness
+    harness.main(args.url, args.games, args.players, args.blanks, args.connections,
+                 args.concurrency)
+
+
+def main(argv=None):
+    profiling.configure(argv)  # --profile / MADLIBS_PROFILE, see profiling.py
+    parser = argparse.ArgumentParser(prog="madlibs", description=__doc__.split("\n")[1])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    batch_parser = commands.add_parser("batch", help="fill templates with answer sets")
+    batch_parser.add_argument("--templates", required=True, help="templates .jsonl or .csv")
+    batch_parser.add_argument("--answers", required=True, help="answer sets .jsonl or .csv")
+    batch_parser.add_argument("--output", help="stories .jsonl or .csv (default: stdout)")
+    batch_parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                              help="number of processes (default: number of cores)")
+    batch_parser.add_argument("--chunk-size", type=int, default=256,
+                              help="answer sets per worker task")
+    batch_parser.set_defaults(func=batch)
+
+    export_parser = commands.add_parser("export", help="fill templates into Word documents")
+    export_parser.add_argument("--templates", required=True, help="templates .jsonl or .csv")
+    export_parser.add_argument("--answers", required=True, help="answer sets .jsonl or .csv")
+    export_parser.add_argument("--output", required=True,
+                               help="booklet .docx with a story per page, or a folder for a "
+                                    "document per story")
+    export_parser.add_argument("--workers", type=int, default=os.cpu_count(),
+                               help="number of processes (default: number of cores)")
+    export_parser.add_argument("--chunk-size", type=int, default=64,
+                               help="answer sets per worker task")
+    export_parser.set_defaults(func=export)
+
+    import_parser = commands.add_parser("import", help="add saved mad libs to the library")
+    import_parser.add_argument("paths", nargs="+", help=".madlib/.docx files or folders")
+    import_parser.add_argument("--library", help="library database (default: $MADLIBS_LIBRARY)")
+    import_parser.add_argument("--workers", type=int, help="number of processes")
+    import_parser.set_defaults(func=import_templates)
+
+    search_parser = commands.add_parser("search", help="search the template library")
+    search_parser.add_argument("--theme", default="", help="words in the theme")
+    search_parser.add_argument("--text", default="", help="words in the mad lib")
+    search_parser.add_argument("--blanks", help="number of blanks, e.g. 10 or 8-12")
+    search_parser.add_argument("--type", action="append", default=[],
+                               help="fill-in-the-blank type the mad lib must use")
+    search_parser.add_argument("--limit", type=int, default=50)
+    search_parser.add_argument("--library", help="library database (default: $MADLIBS_LIBRARY)")
+    search_parser.set_defaults(func=search)
+
+    sample_parser = commands.add_parser("sample", help="make random answer sets from word lists")
+    sample_parser.add_argument("--templates", required=True, help="templates .jsonl or .csv")
+    sample_parser.add_argument("--count", type=int, default=1, help="answer sets per template")
+    sample_parser.add_argument("--seed", type=int, help="random seed for repeatable answers")
+    sample_parser.add_argument("--repeats", action="store_true",
+                               help="allow the same word twice in one story")
+    sample_parser.add_argument("--vocabulary",
+                               help="folder of <Type>.txt word lists (default: $MADLIBS_VOCABULARY)")
+    sample_parser.add_argument("--output", help="answer sets .jsonl (default: stdout)")
+    sample_parser.set_defaults(func=sample)
+
+    generate_parser = commands.add_parser("generate", help="generate mad libs")
+    generate_parser.add_argument("--theme", default="Winter")
+    generate_parser.add_argument("--blanks", type=int, default=5, help="number of blanks")
+    generate_parser.add_argument("--count", type=int, default=1, help="number of mad libs")
+    generate_parser.add_argument("--provider", default="auto",
+                                 choices=["auto", "openai", "endpoint", "local"],
+                                 help="what to generate with (default: cheapest within the deadline)")
+    generate_parser.add_argument("--deadline", type=float, default=10.0,
+                                 help="seconds a mad lib should take for --provider auto")
+    generate_parser.add_argument("--endpoint", help="OpenAI compatible server, e.g. "
+                                 "http://localhost:8080/v1 (default: $MADLIBS_ENDPOINT)")
+    generate_parser.add_argument("--model", help="model name for --endpoint")
+    generate_parser.add_argument("--templates", help="extra templates .jsonl or .csv for the local generator")
+    generate_parser.add_argument("--library", help="library database the local generator "
+                                 "takes sentences on the theme from")
+    generate_parser.add_argument("--seed", type=int, help="random seed for the local generator")
+    generate_parser.set_defaults(func=generate)
+
+    serve_parser = commands.add_parser("serve", help="host group mad lib games over HTTP")
+    serve_parser.add_argument("--host", default="127.0.0.1",
+                              help="address to listen on, 0.0.0.0 for the whole network")
+    serve_parser.add_argument("--port", type=int, default=8765, help="0 for any free port")
+    serve_parser.add_argument("--max-games", type=int, default=10000, help="most games at once")
+    serve_parser.add_argument("--ttl", type=float, default=3600,
+                              help="seconds a game is kept after it was last used")
+    serve_parser.set_defaults(func=serve)
+
+    loadtest_parser = commands.add_parser("loadtest", help="load test the game server")
+    loadtest_parser.add_argument("--url", help="running server (default: start one on localhost)")
+    loadtest_parser.add_argument("--games", type=int, default=1000, help="games to play")
+    loadtest_parser.add_argument("--players", type=int, default=4, help="players per game")
+    loadtest_parser.add_argument("--blanks", type=int, default=12, help="blanks per game")
+    loadtest_parser.add_argument("--connections", type=int, default=256,
+                                 help="kept-alive connections shared by the players")
+    loadtest_parser.add_argument("--concurrency", type=int,
+                                 help="most games in progress at once (default: all)")
+    loadtest_parser.set_defaults(func=loadtest)
+
+    args = parser.parse_args(argv)
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
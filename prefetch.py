@@ -0,0 +1,268 @@
+'''
+Mad libs generated ahead of time for the themes used most recently, so
+pressing Generate again on a popular theme doesn't wait on the model.
+
+A pool is kept for each recent (provider, theme, number of blanks) asked
+for at least twice, so one-off themes don't push the popular ones out or
+use up the budget, with up to depth validated mad libs ready. Taking one is a deque pop under a
+lock; the pool is then topped up in the background. Refills run on a
+thread pool of a few workers, which caps the requests to the backend at
+once, and every request takes a token from a shared bucket first, which
+caps the requests per second over time. A pool which failed to refill
+waits FAILURE_DELAY before trying again, so a backend that is down
+doesn't use the whole budget.
+'''
+import time
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from generation import GenerationCancelled, GenerationFailed
+from generation_cache import cache_key
+import profiling
+
+DEPTH = 2  # ready mad libs kept for each theme and number of blanks
+THEMES = 4  # pools kept, the least recently used is dropped first
+ADMIT = 2  # times a theme is asked for before it gets a pool
+REMEMBERED = 64  # themes counted towards ADMIT
+WORKERS = 2  # most requests to the backend at once
+RATE = 0.2  # requests a second the pools may make on average
+BURST = 4  # requests which can be made at once after a quiet spell
+MAX_RETRIES = 3
+FAILURE_DELAY = 30.0  # seconds a pool waits after a refill failed
+
+
+class TokenBucket:
+    '''
+    A budget of rate requests a second with up to burst saved up. Safe to
+    use from several threads.
+    '''
+
+    def __init__(self, rate, burst, clock=time.monotonic):
+        '''
+        Keyword arguments:
+        rate -- tokens added a second (float)
+        burst -- most tokens saved up (int)
+        clock -- function returning seconds, for tests
+        '''
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.tokens = float(burst)
+        self.updated = clock()
+        self.waited = 0.0  # seconds spent waiting for tokens
+        self.lock = threading.Lock()
+
+    def take(self):
+        '''Function to take a token if there is one. Returns 0, or the seconds until there is one.'''
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return 0.0
+            return (1 - self.tokens) / self.rate
+
+    def acquire(self, cancel_event):
+        '''
+        Function to wait for a token. Returns False when cancel_event is set first.
+
+        Keyword arguments:
+        cancel_event -- stops the wait when set (threading.Event)
+        '''
+        while True:
+            delay = self.take()
+            if not delay:
+                return True
+            with self.lock:
+                self.waited += delay
+            if cancel_event.wait(delay):
+                return False
+
+
+class _Pool:
+    '''Ready mad libs for one (provider, theme, number of blanks)'''
+    __slots__ = ("provider", "theme", "number_of_blanks", "ready", "pending",
+                 "hits", "misses", "failed_at")
+
+    def __init__(self, provider, theme, number_of_blanks):
+        self.provider = provider
+        self.theme = theme
+        self.number_of_blanks = number_of_blanks
+        self.ready = deque()  # validated paragraphs, oldest first
+        self.pending = 0  # refills queued or running
+        self.hits = 0
+        self.misses = 0
+        self.failed_at = None  # time.monotonic() of the last failed refill
+
+
+class PrefetchPool:
+    '''
+    Pools of ready mad libs for the most recently used themes. pop never
+    waits on the backend; everything else happens on the workers.
+    '''
+
+    def __init__(self, depth=DEPTH, themes=THEMES, workers=WORKERS, rate=RATE, burst=BURST,
+                 cache=None, max_retries=MAX_RETRIES, admit=ADMIT):
+        '''
+        Keyword arguments:
+        depth -- ready mad libs kept for each theme and number of blanks (int)
+        themes -- most (theme, number of blanks) pools kept (int)
+        workers -- most requests to the backend at once (int)
+        rate -- requests a second allowed on average (float)
+        burst -- requests allowed at once after a quiet spell (int)
+        cache -- GenerationCache the mad libs are also stored in (GenerationCache)
+        max_retries -- requests made for one mad lib before the refill fails (int)
+        admit -- times a theme is asked for before it gets a pool (int)
+        '''
+        self.depth = depth
+        self.workers = workers
+        self.themes = themes
+        self.admit = admit
+        self.cache = cache
+        self.max_retries = max_retries
+        self.bucket = TokenBucket(rate, burst)
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="prefetch")
+        self.closed = threading.Event()
+        self.lock = threading.Lock()
+        self.pools = OrderedDict()  # key -> _Pool, least recently used first
+        self.asked = OrderedDict()  # key -> times asked for, for keys without a pool
+        self.refill_latencies = deque(maxlen=1000)  # seconds from asking to ready
+        self.hits = 0
+        self.misses = 0
+        self.requests = 0  # made to the backend
+        self.failures = 0  # refills which didn't produce a mad lib
+        self.error = None  # last unexpected exception of a refill
+
+    @staticmethod
+    def key(provider, theme, number_of_blanks):
+        '''Function to get the pool key, themes are compared without case or surrounding spaces'''
+        return provider.name, theme.strip().lower(), int(number_of_blanks)
+
+    def pop(self, provider, theme, number_of_blanks):
+        '''
+        Function to take a ready mad lib, starting a pool for the theme
+        once it has been asked for admit times. Returns the paragraph or
+        None, and tops the pool up in the background either way.
+
+        Keyword arguments:
+        provider -- providers.Provider to generate with
+        theme -- theme of the mad lib (str)
+        number_of_blanks -- number of fill-in-the-blanks (int)
+        '''
+        key = self.key(provider, theme, number_of_blanks)
+        with self.lock:
+            pool = self.pools.get(key)
+            if pool is None:
+                asked = self.asked.pop(key, 0) + 1
+                if asked < self.admit:
+                    self.asked[key] = asked
+                    if len(self.asked) > REMEMBERED:
+                        self.asked.popitem(last=False)
+                    self.misses += 1
+                    return None
+                pool = self.pools[key] = _Pool(provider, theme, int(number_of_blanks))
+                while len(self.pools) > self.themes:
+                    self.pools.popitem(last=False)
+            else:
+                self.pools.move_to_end(key)
+            if pool.ready:
+                paragraph = pool.ready.popleft()
+                pool.hits += 1
+                self.hits += 1
+            else:
+                paragraph = None
+                pool.misses += 1
+                self.misses += 1
+            refills = self._refills(pool)
+        for _ in range(refills):
+            self.executor.submit(self._refill, pool, time.monotonic())
+        return paragraph
+
+    def _refills(self, pool):
+        '''Count refills to start for a pool and mark them pending, called with the lock held'''
+        if self.closed.is_set() or (pool.failed_at is not None
+                                    and time.monotonic() - pool.failed_at < FAILURE_DELAY):
+            return 0
+        refills = max(0, self.depth - len(pool.ready) - pool.pending)
+        pool.pending += refills
+        return refills
+
+    def _refill(self, pool, asked):
+        '''Generate one mad lib for a pool, on a worker'''
+        def take_token(attempt, attempts_allowed):
+            # called before every request to the backend
+            if not self.bucket.acquire(self.closed):
+                raise GenerationCancelled()
+            with self.lock:
+                self.requests += 1
+
+        try:
+            paragraph = pool.provider.generate(pool.theme, pool.number_of_blanks,
+                                               max_retries=self.max_retries,
+                                               cancel_event=self.closed, progress=take_token)
+            latency = time.monotonic() - asked
+            profiling.observe("prefetch.refill", latency)
+            if self.cache is not None:
+                self.cache.put(cache_key(pool.theme, pool.number_of_blanks, pool.provider.model),
+                               paragraph)
+        except GenerationCancelled:
+            pass
+        except Exception as e:  # GenerationFailed, or a bug in the provider or the cache
+            with self.lock:
+                pool.failed_at = time.monotonic()
+                self.failures += 1
+                if not isinstance(e, GenerationFailed):
+                    self.error = e
+        else:
+            with self.lock:
+                pool.failed_at = None
+                pool.ready.append(paragraph)
+                self.refill_latencies.append(latency)
+        finally:
+            with self.lock:
+                pool.pending -= 1
+
+    def wait(self, timeout=None):
+        '''Function to wait until no refills are pending. Returns False on a timeout.'''
+        end = None if timeout is None else time.monotonic() + timeout
+        while True:
+            with self.lock:
+                if not any(pool.pending for pool in self.pools.values()):
+                    return True
+            if end is not None and time.monotonic() > end:
+                return False
+            time.sleep(0.01)
+
+    def stats(self):
+        '''
+        Return the hit rate, requests made, refill latencies (median and
+        95th percentile in seconds) and the depth of every pool (dict)
+        '''
+        with self.lock:
+            latencies = sorted(self.refill_latencies)
+            pools = [{"theme": pool.theme, "blanks": pool.number_of_blanks,
+                      "provider": pool.provider.name, "depth": len(pool.ready),
+                      "pending": pool.pending, "hits": pool.hits, "misses": pool.misses}
+                     for pool in self.pools.values()]
+            pops = self.hits + self.misses
+            stats = {"hits": self.hits, "misses": self.misses,
+                     "hit_rate": self.hits / pops if pops else 0.0,
+                     "requests": self.requests, "failures": self.failures,
+                     "error": None if self.error is None else repr(self.error),
+                     "rate_waited": self.bucket.waited, "pools": pools}
+        stats["refill_p50"] = latencies[len(latencies) // 2] if latencies else None
+        stats["refill_p95"] = latencies[min(len(latencies) - 1, int(0.95 * len(latencies)))] \
+            if latencies else None
+        return stats
+
+    def close(self, wait=True):
+        '''
+        Function to stop refilling. Requests already sent can't be
+        stopped, the workers stop after them.
+
+        Keyword arguments:
+        wait -- wait for the requests already sent to finish (bool)
+        '''
+        self.closed.set()
+        self.executor.shutdown(wait=wait, cancel_futures=True)
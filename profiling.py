@@ -0,0 +1,229 @@
+'''
+Optional timing instrumentation. Turn it on with the MADLIBS_PROFILE
+environment variable or the --profile flag:
+
+    MADLIBS_PROFILE=1 python mad_libs.py              # madlibs-profile-<time>.json
+    python mad_libs.py --profile=profile.prom         # Prometheus text format
+    python mad_libs.py --profile --cprofile=run.pstats
+
+Code being measured uses timer() as a context manager and count() for
+events such as regex scans. When profiling is off both do next to
+nothing. Latencies are kept as histograms with Prometheus style buckets
+and everything is written out when the program exits.
+'''
+import os
+import sys
+import time
+import json
+import atexit
+import threading
+from bisect import bisect_left
+from contextlib import contextmanager, nullcontext
+
+# upper bounds in seconds, the last bucket catches everything slower
+BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+           0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+enabled = False
+_lock = threading.Lock()
+_histograms = {}  # name -> [bucket counts..., total seconds, count, max]
+_counters = {}
+_null_timer = nullcontext()
+
+
+class _Timer:
+    __slots__ = ("name", "start", "excluded")
+
+    def __init__(self, name):
+        self.name = name
+        self.excluded = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        observe(self.name, time.perf_counter() - self.start - self.excluded)
+
+    @contextmanager
+    def paused(self):
+        '''Leave time spent in e.g. a modal dialog out of the measurement'''
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.excluded += time.perf_counter() - start
+
+
+class _NullTimer:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def paused(self):
+        return _null_timer
+
+
+_NULL = _NullTimer()
+
+
+def timer(name):
+    '''
+    Context manager which adds the time taken to the histogram called name.
+    Inside it, "with t.paused():" leaves out time spent waiting for the user.
+
+    Keyword arguments:
+    name -- what is being timed, e.g. slot.add_a_prompt (str)
+    '''
+    return _Timer(name) if enabled else _NULL
+
+
+def observe(name, seconds):
+    '''
+    Function to add one measurement to a histogram
+
+    Keyword arguments:
+    name -- histogram name (str)
+    seconds -- measured value (float)
+    '''
+    if not enabled:
+        return
+    with _lock:
+        histogram = _histograms.get(name)
+        if histogram is None:
+            histogram = _histograms[name] = [0] * (len(BUCKETS) + 1) + [0.0, 0, 0.0]
+        histogram[bisect_left(BUCKETS, seconds)] += 1
+        histogram[-3] += seconds
+        histogram[-2] += 1
+        histogram[-1] = max(histogram[-1], seconds)
+
+
+def count(name, amount=1):
+    '''
+    Function to add to a counter, e.g. count("regex_scans")
+
+    Keyword arguments:
+    name -- counter name (str)
+    amount -- how much to add (int or float)
+    '''
+    if not enabled:
+        return
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + amount
+
+
+def snapshot():
+    '''Return the histograms and counters as a JSON-ready dict'''
+    with _lock:
+        histograms = {}
+        for name, histogram in sorted(_histograms.items()):
+            total, calls, slowest = histogram[-3:]
+            histograms[name] = {
+                "count": calls, "sum": total, "max": slowest,
+                "mean": total / calls if calls else 0.0,
+                "buckets": {str(bound): n for bound, n in
+                            zip(BUCKETS + ("+Inf",), histogram[:len(BUCKETS) + 1])}}
+        return {"time": time.time(), "histograms": histograms, "counters": dict(sorted(_counters.items()))}
+
+
+def to_prometheus():
+    '''Return the histograms and counters in the Prometheus text format'''
+    data = snapshot()
+    lines = ["# HELP madlibs_latency_seconds Time taken by instrumented code.",
+             "# TYPE madlibs_latency_seconds histogram"]
+    for name, histogram in data["histograms"].items():
+        label = name.replace("\\", "\\\\").replace('"', '\\"')
+        cumulative = 0
+        for bound, n in histogram["buckets"].items():
+            cumulative += n
+            lines.append(f'madlibs_latency_seconds_bucket{{name="{label}",le="{bound}"}} {cumulative}')
+        lines.append(f'madlibs_latency_seconds_sum{{name="{label}"}} {histogram["sum"]}')
+        lines.append(f'madlibs_latency_seconds_count{{name="{label}"}} {histogram["count"]}')
+    for name, value in data["counters"].items():
+        metric = "madlibs_" + "".join(c if c.isalnum() else "_" for c in name) + "_total"
+        lines.append(f"# TYPE {metric} counter")
+        lines.append(f"{metric} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write(path):
+    '''
+    Function to save the measurements, as Prometheus text if the path ends
+    in .prom or .txt and as JSON otherwise
+
+    Keyword arguments:
+    path -- file to write (str)
+    '''
+    if path.endswith((".prom", ".txt")):
+        text = to_prometheus()
+    else:
+        text = json.dumps(snapshot(), indent=1)
+    with open(path, "w", encoding="utf-8") as file:
+        file.write(text)
+
+
+def reset():
+    with _lock:
+        _histograms.clear()
+        _counters.clear()
+
+
+def enable(output=None, cprofile_output=None):
+    '''
+    Function to turn profiling on and write everything out at exit
+
+    Keyword arguments:
+    output -- measurements file, see write (str)
+    cprofile_output -- also run cProfile and dump its stats here (str)
+    '''
+    global enabled
+    enabled = True
+    stamp = time.strftime("%Y%m%d-%H%M%S")
+    output = output or f"madlibs-profile-{stamp}.json"
+    profiler = None
+    if cprofile_output is not None:
+        import cProfile
+        profiler = cProfile.Profile()
+        profiler.enable()
+
+    def save():
+        if profiler is not None:
+            profiler.disable()
+            profiler.dump_stats(cprofile_output or f"madlibs-profile-{stamp}.pstats")
+        write(output)
+        print("profile written to " + output, file=sys.stderr)
+    atexit.register(save)
+
+
+def configure(argv=None):
+    '''
+    Function to turn profiling on from --profile[=FILE] and --cprofile[=FILE]
+    in argv or the MADLIBS_PROFILE and MADLIBS_CPROFILE environment
+    variables. The flags are removed from argv. Returns argv.
+
+    Keyword arguments:
+    argv -- command line arguments, defaults to sys.argv (list)
+    '''
+    if argv is None:
+        argv = sys.argv
+    options = {"--profile": os.environ.get("MADLIBS_PROFILE"),
+               "--cprofile": os.environ.get("MADLIBS_CPROFILE")}
+    remaining = []
+    for argument in argv:
+        flag, equals, value = argument.partition("=")
+        if flag in options:
+            options[flag] = value if equals else "1"
+        else:
+            remaining.append(argument)
+    argv[:] = remaining
+    output, cprofile_output = (None if value in (None, "", "0") else value
+                               for value in (options["--profile"], options["--cprofile"]))
+    if output is None and cprofile_output is None:
+        return argv
+    enable(None if output == "1" else output,
+           None if cprofile_output is None else ("" if cprofile_output == "1" else cprofile_output))
+    return argv
@@ -0,0 +1,500 @@
+'''
+Mad lib generators behind one interface, so the app isn't tied to one
+model or to being online:
+
+    ChatProvider      ChatGPT through the openai package (the default)
+    EndpointProvider  any OpenAI compatible server, e.g. a local llama.cpp,
+                      Ollama, vLLM or LM Studio at http://localhost:8080/v1
+    LocalProvider     offline generator which recombines sentences of
+                      stored templates, with exactly the number of blanks
+                      asked for by construction
+    Router            tries the cheapest provider expected to finish
+                      within a deadline and falls back to the others
+
+Every provider keeps its own latency statistics, which the Router uses to
+decide. The local server is set with the MADLIBS_ENDPOINT environment
+variable (plus MADLIBS_ENDPOINT_MODEL and MADLIBS_ENDPOINT_KEY).
+'''
+import os
+import re
+import json
+import math
+import time
+import random
+import threading
+import generation
+from generation import Attempt, GenerationCancelled, GenerationFailed
+from tokenizer import substitute, count_tokens
+import profiling
+
+DEADLINE = 10.0  # seconds the Router aims to finish within
+COOLDOWN = 30.0  # seconds a provider which just failed is tried last
+SMOOTHING = 0.2  # weight of the newest latency in the moving averages
+
+# built in corpus for the local generator; {theme} is replaced by the theme
+OPENERS = [
+    "Nothing says {theme} quite like a [Adjective] [Noun].",
+    "Every year the [Noun Plural] of [Place] get ready for {theme}.",
+    "It was the most [Adjective] {theme} anyone could remember.",
+    "My [Person in Room] has always said that {theme} is all about [Noun Plural].",
+    "This {theme} started when [Celebrity] [Verb Past Tense] into the kitchen.",
+    "Welcome to {theme}, where everything smells like [Type of Food].",
+    "Nobody was ready for {theme}, least of all [Person in Room].",
+    "The first rule of {theme} is to never [Verb] without a [Noun].",
+]
+SENTENCES = [
+    "Then a [Noun] fell from the sky.",
+    "Everyone shouted \"[Exclamation]!\"",
+    "It was [Number] degrees outside.",
+    "The walls were painted [Colour].",
+    "Suddenly [Celebrity] walked in.",
+    "I could not stop [Verb ing].",
+    "We drank a glass of [Type of Liquid].",
+    "The whole thing took place in [Place].",
+    "My [Part of the Body] started to itch.",
+    "Somebody said the magic word: [Silly Word].",
+    "We had to [Verb] [Adverb] to keep up.",
+    "The [Adjective] [Noun] [Verb Past Tense] across the room.",
+    "Luckily [Person in Room] had brought [Number] [Noun Plural].",
+    "Dinner was [Type of Food] with a side of [Type of Food].",
+    "My [Part of the Body Plural] were covered in [Type of Liquid].",
+    "A [Colour] [Noun] was [Verb ing] on the roof.",
+    "I [Verb Past Tense] [Adverb] and hoped for the best.",
+    "\"[Exclamation]!\" cried [Celebrity], waving a [Adjective] [Noun].",
+    "Nobody expected [Number] [Adjective] [Noun Plural] to show up in [Place].",
+    "We spent the afternoon [Verb ing] with [Person in Room] and a very [Adjective] [Noun].",
+    "By then my [Part of the Body] was [Colour] and my [Part of the Body Plural] were [Adjective].",
+    "It was the best day ever.",
+    "Then everyone went home.",
+]
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+
+
+class LatencyStats:
+    '''
+    Moving average and variance of a provider's latency with a prior used
+    until it has been measured, plus when it last failed
+    '''
+
+    def __init__(self, prior):
+        '''
+        Keyword arguments:
+        prior -- expected latency in seconds before any measurement (float)
+        '''
+        self.prior = prior
+        self.count = 0
+        self.failures = 0
+        self.mean = 0.0
+        self.variance = 0.0
+        self.failed_at = None  # time.monotonic() of the last failure since a success
+        self.lock = threading.Lock()
+
+    def add(self, seconds):
+        with self.lock:
+            if self.count == 0:
+                self.mean = seconds
+            else:
+                difference = seconds - self.mean
+                self.mean += SMOOTHING * difference
+                self.variance = (1 - SMOOTHING) * (self.variance + SMOOTHING * difference ** 2)
+            self.count += 1
+            self.failed_at = None
+
+    def add_failure(self):
+        with self.lock:
+            self.failures += 1
+            self.failed_at = time.monotonic()
+
+    def estimate(self):
+        '''Pessimistic latency estimate: the mean plus two standard deviations'''
+        with self.lock:
+            if self.count == 0:
+                return self.prior
+            return self.mean + 2 * math.sqrt(self.variance)
+
+    def cooling_down(self):
+        '''True for COOLDOWN seconds after a failure'''
+        with self.lock:
+            return self.failed_at is not None and time.monotonic() - self.failed_at < COOLDOWN
+
+
+class Provider:
+    '''
+    A way of generating mad libs. Subclasses implement _generate and set
+    name, model (part of the cache key), cost (relative price of one mad
+    lib, used to rank providers) and the latency to expect before any has
+    been measured.
+    '''
+    name = "provider"
+    model = None
+    cost = 1.0
+    expected_latency = 5.0
+
+    def __init__(self):
+        self.latency = LatencyStats(self.expected_latency)
+
+    def generate(self, theme, number_of_blanks, max_retries=3, parallel=1,
+                 cancel_event=None, progress=None, attempts=None, on_text=None):
+        '''
+        Function to generate a mad lib with exactly number_of_blanks
+        prompts, recording how long it took. Returns the paragraph and
+        raises GenerationFailed or GenerationCancelled.
+
+        Keyword arguments:
+        theme -- theme of the mad lib (str)
+        number_of_blanks -- number of fill-in-the-blanks (int)
+        max_retries -- most requests to make one after the other (int)
+        parallel -- number of requests to race when above 1 (int)
+        cancel_event -- set to stop (threading.Event)
+        progress -- called with (attempt, attempts allowed) as it goes
+        attempts -- list to record every Attempt in (list)
+        on_text -- called with pieces of the paragraph as they are generated
+        '''
+        if attempts is None:
+            attempts = []
+        first = len(attempts)
+        start = time.perf_counter()
+        try:
+            paragraph = self._generate(theme, number_of_blanks, max_retries, parallel,
+                                       cancel_event, progress, attempts, on_text)
+        except GenerationFailed:
+            self.latency.add_failure()
+            raise
+        finally:
+            for attempt in attempts[first:]:
+                if attempt.provider is None:
+                    attempt.provider = self.name
+        elapsed = time.perf_counter() - start
+        self.latency.add(elapsed)
+        profiling.observe("provider." + self.name, elapsed)
+        return paragraph
+
+    def _generate(self, theme, number_of_blanks, max_retries, parallel,
+                  cancel_event, progress, attempts, on_text):
+        raise NotImplementedError
+
+    def stats(self):
+        '''Return the provider's latency statistics as a dict'''
+        return {"name": self.name, "cost": self.cost, "count": self.latency.count,
+                "failures": self.latency.failures, "mean": self.latency.mean,
+                "estimate": self.latency.estimate()}
+
+
+class ChatProvider(Provider):
+    '''ChatGPT, or any other OpenAI style client with chat.completions.create'''
+    name = "openai"
+    model = generation.MODEL
+    cost = 10.0
+    expected_latency = 8.0
+
+    def __init__(self, client=None, model=None):
+        '''
+        Keyword arguments:
+        client -- OpenAI style client, None for generation.get_client() (object)
+        model -- model name, defaults to generation.MODEL (str)
+        '''
+        super().__init__()
+        self.client = client
+        if model is not None:
+            self.model = model
+
+    def get_client(self):
+        return self.client if self.client is not None else generation.get_client()
+
+    def _generate(self, theme, number_of_blanks, max_retries, parallel,
+                  cancel_event, progress, attempts, on_text):
+        try:
+            client = self.get_client()
+        except Exception as e:
+            # e.g. openai isn't installed or there is no API key
+            raise GenerationFailed(str(e), e)
+        if parallel > 1:
+            return generation.generate_speculative(
+                client, theme, number_of_blanks, parallel=parallel,
+                cancel_event=cancel_event, progress=progress, attempts=attempts,
+                model=self.model)
+        return generation.generate_mad_lib(
+            client, theme, number_of_blanks, max_retries=max_retries,
+            cancel_event=cancel_event, progress=progress, attempts=attempts,
+            on_text=on_text, model=self.model)
+
+
+class _Reply(dict):
+    '''JSON object read like the openai reply types: missing fields are None'''
+
+    def __getattr__(self, name):
+        return self.get(name)
+
+
+class HTTPClient:
+    '''
+    Minimal OpenAI compatible client over urllib with just the
+    chat.completions.create call, streamed or not, that generation uses
+    '''
+
+    def __init__(self, base_url, api_key=None, timeout=60.0):
+        '''
+        Keyword arguments:
+        base_url -- API root, e.g. http://localhost:8080/v1 (str)
+        api_key -- sent as a bearer token when given (str)
+        timeout -- seconds to wait for the server (float)
+        '''
+        self.base_url = base_url.rstrip("/")
+        self.api_key = api_key
+        self.timeout = timeout
+        self.chat = _Reply(completions=self)
+
+    def create(self, messages, model, stream=False, **parameters):
+        '''
+        Function to post a chat completion request. Returns the reply, or
+        an iterator of reply chunks when stream is set. HTTP and connection
+        errors are raised as urllib errors.
+        '''
+        import urllib.request  # only loaded when a server is used
+        body = dict(parameters, model=model, messages=messages)
+        if stream:
+            body["stream"] = True
+        headers = {"Content-Type": "application/json"}
+        if self.api_key:
+            headers["Authorization"] = "Bearer " + self.api_key
+        request = urllib.request.Request(self.base_url + "/chat/completions",
+                                         data=json.dumps(body).encode("utf-8"),
+                                         headers=headers, method="POST")
+        response = urllib.request.urlopen(request, timeout=self.timeout)
+        if stream:
+            return self._stream(response)
+        with response:
+            return json.loads(response.read(), object_hook=_Reply)
+
+    @staticmethod
+    def _stream(response):
+        '''Read server-sent events until [DONE]; closing it closes the connection'''
+        try:
+            for line in response:
+                line = line.strip()
+                if not line.startswith(b"data:"):
+                    continue
+                data = line[5:].strip()
+                if data == b"[DONE]":
+                    break
+                yield json.loads(data, object_hook=_Reply)
+        finally:
+            response.close()
+
+
+class EndpointProvider(ChatProvider):
+    '''A local or self-hosted OpenAI compatible server'''
+    name = "endpoint"
+    cost = 1.0
+    expected_latency = 4.0
+
+    def __init__(self, url, model="default", api_key=None, timeout=60.0):
+        '''
+        Keyword arguments:
+        url -- API root, e.g. http://localhost:8080/v1 (str)
+        model -- model name the server knows (str)
+        api_key -- key, if the server wants one (str)
+        timeout -- seconds to wait for the server (float)
+        '''
+        super().__init__(HTTPClient(url, api_key, timeout), model)
+        self.url = url
+
+    @classmethod
+    def from_environment(cls):
+        '''Return the server set in MADLIBS_ENDPOINT, or None if there is none'''
+        url = os.environ.get("MADLIBS_ENDPOINT")
+        if not url:
+            return None
+        return cls(url, os.environ.get("MADLIBS_ENDPOINT_MODEL") or "default",
+                   os.environ.get("MADLIBS_ENDPOINT_KEY"))
+
+
+class _Sentence:
+    '''A corpus sentence with its prompts left unnumbered'''
+    __slots__ = ("text", "count")
+
+    def __init__(self, text):
+        self.count = 0
+
+        def unnumber(token):
+            self.count += 1
+            return "[" + token.type + "]"
+        self.text = substitute(text, unnumber)
+
+
+def split_sentences(text):
+    '''Return the sentences of a template as _Sentence objects'''
+    return [_Sentence(sentence) for sentence in SENTENCE_END.split(text.strip()) if sentence]
+
+
+class LocalProvider(Provider):
+    '''
+    Offline generator. A paragraph opens with a sentence naming the theme
+    and goes on with sentences taken from library templates on the same
+    theme, then from the whole corpus, only ever taking a sentence whose
+    prompts still fit. Sentences with one prompt are always available, so
+    the count comes out exact without any retries. Prompts are numbered
+    again at the end like the prompt buttons do.
+    '''
+    name = "local"
+    model = "local"
+    cost = 0.0
+    expected_latency = 0.01
+
+    def __init__(self, templates=(), library=None, seed=None):
+        '''
+        Keyword arguments:
+        templates -- extra mad lib texts to take sentences from (iterable of str)
+        library -- template library searched by theme for each mad lib (Library)
+        seed -- random seed for repeatable mad libs (int)
+        '''
+        super().__init__()
+        self.library = library
+        self.rng = random.Random(seed)
+        self.openers = [_Sentence(text) for text in OPENERS]
+        self.sentences = [_Sentence(text) for text in SENTENCES]
+        for text in templates:
+            self.sentences += split_sentences(text)
+        self.sentences = [sentence for sentence in self.sentences if sentence.count]
+
+    def themed_sentences(self, theme):
+        '''Sentences of library templates whose theme matches, best first'''
+        if self.library is None or not theme.strip():
+            return []
+        try:
+            entries = self.library.search(theme=theme, limit=20)
+        except Exception:
+            return []  # an unreadable library just means no themed sentences
+        sentences = []
+        for entry in entries:
+            sentences += [sentence for sentence in split_sentences(entry.text) if sentence.count]
+        return sentences
+
+    def compose(self, theme, number_of_blanks, rng=None):
+        '''
+        Function to build a paragraph with exactly number_of_blanks prompts,
+        or fewer when no sentence in the corpus has few enough prompts left
+
+        Keyword arguments:
+        theme -- theme of the mad lib (str)
+        number_of_blanks -- number of fill-in-the-blanks (int)
+        rng -- random number generator (random.Random)
+        '''
+        rng = rng or self.rng
+        theme = theme.strip().replace("[", "(").replace("]", ")") or "the holidays"
+        remaining = number_of_blanks
+        chosen = []
+        openers = [sentence for sentence in self.openers if sentence.count <= remaining]
+        if openers:
+            opener = rng.choice(openers)
+            chosen.append(opener.text.replace("{theme}", theme))
+            remaining -= opener.count
+        else:
+            chosen.append("This is a story about " + theme + ".")
+        themed = self.themed_sentences(theme)
+        rng.shuffle(themed)
+        pools = [themed]
+        while remaining > 0:
+            corpus = not pools
+            pool = pools.pop() if pools else rng.sample(self.sentences, len(self.sentences))
+            before = remaining
+            for sentence in pool:
+                if sentence.count <= remaining:
+                    chosen.append(sentence.text)
+                    remaining -= sentence.count
+                    if remaining == 0:
+                        break
+            if corpus and remaining == before:
+                break  # nothing in the corpus fits, e.g. no sentences with one prompt
+        numbers = iter(range(1, number_of_blanks + 2))
+        return substitute(" ".join(chosen),
+                          lambda token: "[" + token.type + str(next(numbers)) + "]")
+
+    def _generate(self, theme, number_of_blanks, max_retries, parallel,
+                  cancel_event, progress, attempts, on_text):
+        if cancel_event is not None and cancel_event.is_set():
+            raise GenerationCancelled()
+        if progress is not None:
+            progress(1, 1)
+        attempt = Attempt(1)
+        start = time.perf_counter()
+        attempt.paragraph = self.compose(theme, number_of_blanks)
+        attempt.valid = count_tokens(attempt.paragraph) == number_of_blanks
+        attempt.latency = time.perf_counter() - start
+        attempts.append(attempt)
+        if not attempt.valid:
+            raise GenerationFailed("The local generator has no sentences with one prompt.")
+        if on_text is not None:
+            on_text(attempt.paragraph)
+        return attempt.paragraph
+
+
+class Router(Provider):
+    '''
+    Picks a provider for each mad lib: the cheapest one whose latency
+    estimate is within the deadline, then the rest by estimate. Providers
+    which failed in the last COOLDOWN seconds go last, and a failure moves
+    on to the next provider.
+    '''
+    name = "auto"
+    model = "auto"
+    cost = 0.0
+    expected_latency = 0.0
+
+    def __init__(self, providers, deadline=DEADLINE):
+        '''
+        Keyword arguments:
+        providers -- providers to choose from (list of Provider)
+        deadline -- seconds a mad lib should take at most (float)
+        '''
+        super().__init__()
+        self.providers = list(providers)
+        self.deadline = deadline
+
+    def candidates(self, deadline=None):
+        '''Return the providers in the order they would be tried'''
+        if deadline is None:
+            deadline = self.deadline
+
+        def rank(provider):
+            estimate = provider.latency.estimate()
+            if provider.latency.cooling_down():
+                return (2, estimate, provider.cost)
+            if estimate <= deadline:
+                return (0, provider.cost, estimate)
+            return (1, estimate, provider.cost)
+        return sorted(self.providers, key=rank)
+
+    def _generate(self, theme, number_of_blanks, max_retries, parallel,
+                  cancel_event, progress, attempts, on_text):
+        failure = None
+        for provider in self.candidates():
+            try:
+                return provider.generate(theme, number_of_blanks, max_retries, parallel,
+                                         cancel_event, progress, attempts, on_text)
+            except GenerationFailed as e:
+                failure = e
+                profiling.count("provider_fallbacks")
+        raise failure or GenerationFailed("There are no providers to generate with.")
+
+    def stats(self):
+        '''Return the statistics of every provider, in the order they would be tried'''
+        return [provider.stats() for provider in self.candidates()]
+
+
+def default_providers(client=None, library=None):
+    '''
+    Function to set up the providers the app offers, by name: openai,
+    endpoint (only when MADLIBS_ENDPOINT is set), local and auto
+
+    Keyword arguments:
+    client -- OpenAI style client for the openai provider, None for the real one
+    library -- template library the local generator takes themed sentences from
+    '''
+    providers = {"openai": ChatProvider(client)}
+    endpoint = EndpointProvider.from_environment()
+    if endpoint is not None:
+        providers["endpoint"] = endpoint
+    providers["local"] = LocalProvider(library=library)
+    providers["auto"] = Router(list(providers.values()))
+    return providers
@@ -0,0 +1,228 @@
+'''
+Local repair of generated mad libs whose number of prompts is a little
+off, so a near miss doesn't cost another request to the model.
+
+Prompt types are renamed to the ones in inputs_file.inputs ("plural noun"
+becomes "Noun Plural"), blanks are added or merged only where the
+sentence still reads the same, and every prompt is numbered again in
+order, which also splits names the model used twice:
+
+    too few   "the dog" -> "the [Adjective] dog", "a [Noun]" -> "an [Adjective] [Noun]"
+    too many  "an [Adjective] [Noun]" -> "a [Noun]", "[Adverb]" dropped next to a verb,
+              "[Number] [Noun Plural]" -> "some [Noun Plural]"
+'''
+import re
+import inputs_file
+from fill_session import article
+from tokenizer import iter_tokens
+
+TYPES = {value.lower(): value for value in inputs_file.inputs.values() if value != "Custom"}
+# other names models give the types in inputs_file.inputs
+SYNONYMS = {
+    "plural noun": "Noun Plural", "nouns": "Noun Plural",
+    "verb ending in ing": "Verb ing", "ing verb": "Verb ing", "verb ending with ing": "Verb ing",
+    "past tense verb": "Verb Past Tense", "verb past": "Verb Past Tense",
+    "color": "Colour", "liquid": "Type of Liquid", "drink": "Type of Liquid",
+    "food": "Type of Food", "location": "Place", "famous person": "Celebrity",
+    "interjection": "Exclamation", "person": "Person in Room", "name": "Person in Room",
+    "body part": "Part of the Body", "body parts": "Part of the Body Plural",
+    "plural body part": "Part of the Body Plural", "plural part of the body": "Part of the Body Plural",
+}
+# prompt types an adjective can be put in front of
+NOUN_TYPES = {"Noun", "Noun Plural", "Part of the Body", "Part of the Body Plural",
+              "Type of Food", "Type of Liquid"}
+# a determiner and then a plain word, where an adjective fits in between
+DETERMINER = re.compile(r'\b(?:[Tt]he|[Aa]n?|[Mm]y|[Yy]our|[Hh]is|[Hh]er|[Ii]ts|[Oo]ur|[Tt]heir|'
+                        r'[Tt]his|[Tt]hat|[Ss]ome)\s+(?=([a-z]+)\b)')
+NOT_NOUNS = {"very", "most", "more", "same", "other", "only", "first", "last", "next",
+             "best", "worst", "own", "one", "two", "three", "few", "many", "much", "and", "of"}
+ARTICLE = re.compile(r'\b([Aa]n?)(\s+)$')
+PUNCTUATION = ".,!?;:"
+# words which mean the adjective after them is the sentence's point, e.g. "was [Adjective]"
+LINKING = {"is", "was", "are", "were", "be", "been", "am", "looked", "looks", "seemed", "seems",
+           "felt", "feels", "became", "so", "very", "too", "quite", "really", "more", "most"}
+INTENSIFIERS = {"so", "very", "too", "quite", "really", "more", "most"}
+# words after an adjective which mean it isn't describing them
+JOINING = {"and", "or", "but", "to", "as", "than", "for", "with", "in", "on", "at", "of",
+           "from", "because", "that"}
+
+
+def normalize_type(type_name):
+    '''
+    Function to rename a prompt type to the one used in inputs_file.inputs.
+    Types it doesn't know are kept, like the app's own custom prompts.
+
+    Keyword arguments:
+    type_name -- prompt type without its number, e.g. plural noun (str)
+    '''
+    key = " ".join(type_name.lower().split())
+    found = TYPES.get(key) or SYNONYMS.get(key)
+    if found is None and key.endswith("s"):
+        found = TYPES.get(key[:-1])  # e.g. adjectives
+    return found or " ".join(type_name.split())
+
+
+def max_changes(number_of_blanks):
+    '''Most blanks added or merged before a reply counts as too far off'''
+    return max(2, number_of_blanks // 4)
+
+
+class Repair:
+    '''A repaired mad lib and what was changed'''
+    __slots__ = ("text", "added", "removed", "renamed")
+
+    def __init__(self, text, added, removed, renamed):
+        self.text = text
+        self.added = added
+        self.removed = removed
+        self.renamed = renamed  # prompts whose type or number changed
+
+    @property
+    def changed(self):
+        '''True when blanks had to be added or merged'''
+        return bool(self.added or self.removed)
+
+    def __repr__(self):
+        return f"Repair(added={self.added}, removed={self.removed}, renamed={self.renamed})"
+
+
+def _fix_article(text, following):
+    '''Make an "a" or "an" at the end of text agree with the word or prompt type after it'''
+    match = ARTICLE.search(text)
+    if not match:
+        return text
+    if following in TYPES.values():
+        wanted = article(following)
+    else:
+        wanted = "an" if following[:1].lower() in "aeiou" else "a"
+    if match.group(1)[0] == "A":
+        wanted = wanted.capitalize()
+    return text[:match.start(1)] + wanted + match.group(2)
+
+
+def _spread(candidates, count):
+    '''Pick count candidates spread evenly through the list'''
+    if count <= 0:
+        return []
+    if count >= len(candidates):
+        return list(candidates)
+    step = len(candidates) / count
+    return [candidates[int(step * i + step / 2)] for i in range(count)]
+
+
+def _previous_word(literal):
+    words = literal.split()
+    return words[-1].lower() if words else ""
+
+
+def _attributive(literals, types, i):
+    '''True when the adjective prompt i comes before the word or prompt it describes'''
+    right = literals[i + 1]
+    if not right[:1].isspace() or _previous_word(literals[i]) in LINKING:
+        return False
+    following = right.split(None, 1)
+    if not following:
+        return i + 1 < len(types)
+    return following[0][:1].isalpha() and following[0].lower() not in JOINING
+
+
+def _loose(literals, i):
+    '''True when the adverb prompt i stands on its own between words'''
+    left, right = literals[i], literals[i + 1]
+    return ((not left.strip() or left[-1:].isspace()) and _previous_word(left) not in INTENSIFIERS
+            and (not right or right[0].isspace() or right[0] in PUNCTUATION))
+
+
+def _remove(literals, types, i):
+    '''Take prompt i out of the text, tidying the spaces and the article before it'''
+    left, right = literals[i], literals[i + 1]
+    if left[-1:].isspace() and (not right or right[0].isspace() or right[0] in PUNCTUATION):
+        left = left[:-1]
+    elif not left.strip() and right[:1].isspace():
+        right = right[1:]
+    rest = right.lstrip()
+    space = right[:len(right) - len(rest)]
+    if rest:
+        following = re.match(r"[A-Za-z]*", rest).group()
+        if not left.strip() or left.rstrip()[-1:] in ".!?":
+            rest = rest[:1].upper() + rest[1:]  # now starts the sentence
+    else:
+        following = types[i + 1] if i + 1 < len(types) else ""
+    if space and following:
+        left = _fix_article(left + space, following)
+        space = ""
+    literals[i:i + 2] = [left + space + rest]
+    del types[i]
+
+
+def repair_mad_lib(text, number_of_blanks, limit=None):
+    '''
+    Function to give a generated mad lib exactly number_of_blanks prompts
+    with normalized types and fresh numbers. Returns a Repair, or None when
+    the count is more than limit away or there aren't enough safe spots.
+
+    Keyword arguments:
+    text -- generated paragraph (str)
+    number_of_blanks -- number of prompts wanted (int)
+    limit -- most blanks to add or merge, defaults to max_changes (int)
+    '''
+    literals = []
+    types = []
+    names = []
+    last = 0
+    for token in iter_tokens(text):
+        literals.append(text[last:token.span[0]])
+        names.append(token.name)
+        types.append(normalize_type(token.type))
+        last = token.span[1]
+    literals.append(text[last:])
+    difference = number_of_blanks - len(types)
+    if abs(difference) > (max_changes(number_of_blanks) if limit is None else limit):
+        return None
+
+    added = removed = 0
+    if difference > 0:
+        # an adjective in front of a noun prompt, or else of a plain word after a determiner
+        before_prompts = [(i, len(literals[i])) for i, type_name in enumerate(types)
+                          if type_name in NOUN_TYPES and not (
+                              i > 0 and types[i - 1] == "Adjective" and not literals[i].strip())]
+        before_words = [(i, match.start(1)) for i, literal in enumerate(literals)
+                        for match in DETERMINER.finditer(literal)
+                        if match.group(1) not in NOT_NOUNS]
+        if len(before_prompts) + len(before_words) < difference:
+            return None
+        spots = _spread(before_prompts, difference)
+        spots += _spread(before_words, difference - len(spots))
+        for i, offset in sorted(spots, reverse=True):
+            left, right = literals[i][:offset], literals[i][offset:]
+            literals[i:i + 1] = [_fix_article(left, "Adjective"), " " + right]
+            types.insert(i, "Adjective")
+            names.insert(i, None)
+            added += 1
+    elif difference < 0:
+        # adjectives and colours in front of another word and adverbs can
+        # go without the sentence falling apart, numbers become "some"
+        optional = [i for i, type_name in enumerate(types)
+                    if (type_name in ("Adjective", "Colour", "Number")
+                        and _attributive(literals, types, i))
+                    or (type_name == "Adverb" and _loose(literals, i))]
+        if len(optional) < -difference:
+            return None
+        for i in sorted(_spread(optional, -difference), reverse=True):
+            if types[i] == "Number":
+                literals[i:i + 2] = [literals[i] + "some" + literals[i + 1]]
+                del types[i]
+            else:
+                _remove(literals, types, i)
+            del names[i]
+            removed += 1
+
+    parts = [literals[0]]
+    renamed = 0
+    for number, (type_name, name, literal) in enumerate(zip(types, names, literals[1:]), 1):
+        new_name = type_name + str(number)
+        if name is not None and name != new_name:
+            renamed += 1
+        parts.append("[" + new_name + "]")
+        parts.append(literal)
+    return Repair("".join(parts), added, removed, renamed)
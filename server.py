@@ -0,0 +1,408 @@
+'''
+Local server for group mad lib games, where everyone in the room gets
+blanks to fill on their phone or laptop and sees the finished story.
+Plain HTTP with JSON bodies on asyncio, so it needs nothing installed:
+
+    python madlibs.py serve --port 8765
+
+    POST   /games                          {"theme": "space", "text": "..."} or
+                                           {"theme": "space", "blanks": 12}
+    GET    /games/<game>                   progress of a game
+    POST   /games/<game>/players           {"name": "Sam"} -> {"player": ...}
+    POST   /games/<game>/players/<player>/blank
+                                           hands out the next blank to fill
+    POST   /games/<game>/answers           {"player": ..., "name": "Noun3", "answer": "..."}
+    GET    /games/<game>/story?wait=30     the story once every blank is filled,
+                                           waiting up to wait seconds for it
+    DELETE /games/<game>
+    GET    /stats
+
+Every game has fixed limits on its text, blanks, players and answer
+lengths so its memory is bounded, games nobody has touched for GAME_TTL
+seconds are dropped and the server holds at most max_games at a time.
+'''
+import re
+import json
+import time
+import asyncio
+import secrets
+from collections import OrderedDict, deque
+from urllib.parse import urlsplit, parse_qs
+from fill_session import FillSession, label
+
+MAX_GAMES = 10000
+GAME_TTL = 3600  # seconds a game is kept after its last request
+MAX_TEXT = 20000  # characters in a mad lib
+MAX_BLANKS = 200
+MAX_PLAYERS = 200
+MAX_ANSWER = 100  # characters in an answer or a player name
+REASSIGN_AFTER = 120  # seconds before a blank handed out but not filled goes to someone else
+MAX_WAIT = 60  # seconds a story request can wait for the game to finish
+MAX_BODY = 64 * 1024
+MAX_LINE = 8 * 1024
+IDLE_TIMEOUT = 30  # seconds a kept-alive connection may sit between requests
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found",
+           405: "Method Not Allowed", 409: "Conflict", 413: "Payload Too Large",
+           500: "Internal Server Error", 503: "Service Unavailable"}
+
+
+class HTTPError(Exception):
+    '''An error sent back to the client as {"error": message}'''
+
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+
+class Player:
+    __slots__ = ("name", "blank", "given", "answered")
+
+    def __init__(self, name):
+        self.name = name
+        self.blank = None  # prompt name handed out and not filled yet
+        self.given = 0.0  # time.monotonic() when it was handed out
+        self.answered = 0
+
+
+class Game:
+    '''
+    One story being filled by a group. Blanks are handed out one per
+    player at a time, in story order, from a queue of the unfilled ones.
+    '''
+    __slots__ = ("id", "theme", "session", "players", "queue", "finished", "touched")
+
+    def __init__(self, game_id, theme, text):
+        '''
+        Keyword arguments:
+        game_id -- id used in URLs (str)
+        theme -- theme of the mad lib (str)
+        text -- mad lib text with [Type N] prompts (str)
+        '''
+        self.id = game_id
+        self.theme = theme
+        self.session = FillSession(text)
+        self.players = {}
+        self.queue = deque(self.session.names)  # unfilled blanks nobody has
+        self.finished = asyncio.Event()
+        self.touched = time.monotonic()
+        if self.session.is_complete():
+            self.finished.set()
+
+    def join(self, name):
+        '''Function to add a player. Returns the player id.'''
+        if len(self.players) >= MAX_PLAYERS:
+            raise HTTPError(409, "the game is full")
+        player_id = secrets.token_urlsafe(8)
+        self.players[player_id] = Player(name[:MAX_ANSWER])
+        return player_id
+
+    def player(self, player_id):
+        player = self.players.get(player_id)
+        if player is None:
+            raise HTTPError(404, "no such player")
+        return player
+
+    def next_blank(self, player_id):
+        '''
+        Function to hand a player a blank to fill. Asking again before
+        answering gives the same blank. Returns the prompt name or None
+        when every blank is filled or handed out.
+        '''
+        player = self.player(player_id)
+        if player.blank is not None:
+            return player.blank
+        if not self.queue:
+            self._reclaim()
+        while self.queue:
+            name = self.queue.popleft()
+            if name not in self.session.answers:
+                player.blank = name
+                player.given = time.monotonic()
+                return name
+        return None
+
+    def _reclaim(self):
+        '''Put blanks handed out more than REASSIGN_AFTER seconds ago back in the queue'''
+        now = time.monotonic()
+        for player in self.players.values():
+            if player.blank is not None and now - player.given > REASSIGN_AFTER:
+                self.queue.append(player.blank)
+                player.blank = None
+
+    def answer(self, player_id, name, answer):
+        '''Function to fill in the blank a player was given. Returns the number left.'''
+        player = self.player(player_id)
+        answer = " ".join(str(answer).split())[:MAX_ANSWER]
+        if not answer:
+            raise HTTPError(400, "the answer is empty")
+        if player.blank != name:
+            raise HTTPError(409, "that blank was not handed to this player")
+        self.session.set_answer(name, answer)
+        player.blank = None
+        player.answered += 1
+        remaining = len(self.session) - len(self.session.answers)
+        if remaining == 0:
+            self.finished.set()
+        return remaining
+
+    def status(self):
+        return {"game": self.id, "theme": self.theme, "blanks": len(self.session),
+                "filled": len(self.session.answers), "players": len(self.players),
+                "complete": self.finished.is_set()}
+
+    def story(self):
+        status = self.status()
+        if self.finished.is_set():
+            status["story"] = self.session.render()
+            status["players"] = [{"name": player.name, "answered": player.answered}
+                                 for player in self.players.values()]
+        return status
+
+
+class GameServer:
+    '''The games of one process and the HTTP handling for them'''
+
+    def __init__(self, max_games=MAX_GAMES, ttl=GAME_TTL):
+        '''
+        Keyword arguments:
+        max_games -- most games kept at once (int)
+        ttl -- seconds a game is kept after its last request (float)
+        '''
+        self.games = OrderedDict()  # least recently used first
+        self.max_games = max_games
+        self.ttl = ttl
+        self.requests = 0
+        self.connections = 0
+        self.started = time.monotonic()
+        self.generator = None
+        self.routes = [
+            ("POST", re.compile(r"/games$"), self.create_game),
+            ("GET", re.compile(r"/games/([\w-]+)$"), self.game_status),
+            ("DELETE", re.compile(r"/games/([\w-]+)$"), self.delete_game),
+            ("POST", re.compile(r"/games/([\w-]+)/players$"), self.join),
+            ("POST", re.compile(r"/games/([\w-]+)/players/([\w-]+)/blank$"), self.next_blank),
+            ("POST", re.compile(r"/games/([\w-]+)/answers$"), self.answer),
+            ("GET", re.compile(r"/games/([\w-]+)/story$"), self.story),
+            ("GET", re.compile(r"/stats$"), self.stats),
+        ]
+
+    def game(self, game_id):
+        game = self.games.get(game_id)
+        if game is None:
+            raise HTTPError(404, "no such game")
+        game.touched = time.monotonic()
+        self.games.move_to_end(game_id)
+        return game
+
+    def expire(self):
+        '''Function to drop the games nobody has used within the ttl'''
+        limit = time.monotonic() - self.ttl
+        while self.games:
+            game = next(iter(self.games.values()))
+            if game.touched > limit:
+                break
+            del self.games[game.id]
+            game.finished.set()  # wake anyone waiting for the story
+
+    async def create_game(self, body, query):
+        theme = str(body.get("theme") or "")[:MAX_ANSWER]
+        text = body.get("text")
+        if text is None:
+            blanks = body.get("blanks", 10)
+            if not isinstance(blanks, int) or not 0 < blanks <= MAX_BLANKS:
+                raise HTTPError(400, f"blanks must be from 1 to {MAX_BLANKS}")
+            if self.generator is None:
+                from providers import LocalProvider
+                self.generator = LocalProvider()
+            text = self.generator.compose(theme, blanks)
+        if not isinstance(text, str) or len(text) > MAX_TEXT:
+            raise HTTPError(400, f"text must be a string of at most {MAX_TEXT} characters")
+        self.expire()
+        if len(self.games) >= self.max_games:
+            raise HTTPError(503, "too many games, try again later")
+        game = Game(secrets.token_urlsafe(8), theme, text)
+        if len(game.session) > MAX_BLANKS:
+            raise HTTPError(400, f"a game can have at most {MAX_BLANKS} blanks")
+        self.games[game.id] = game
+        return 201, game.status()
+
+    async def game_status(self, body, query, game_id):
+        return 200, self.game(game_id).status()
+
+    async def delete_game(self, body, query, game_id):
+        game = self.game(game_id)
+        del self.games[game_id]
+        game.finished.set()
+        return 200, {"deleted": game_id}
+
+    async def join(self, body, query, game_id):
+        game = self.game(game_id)
+        return 201, {"player": game.join(str(body.get("name") or "Player"))}
+
+    async def next_blank(self, body, query, game_id, player_id):
+        game = self.game(game_id)
+        name = game.next_blank(player_id)
+        if name is None:
+            return 200, {"name": None, "complete": game.finished.is_set()}
+        return 200, {"name": name, "label": label(name)}
+
+    async def answer(self, body, query, game_id):
+        game = self.game(game_id)
+        remaining = game.answer(str(body.get("player")), str(body.get("name")),
+                                body.get("answer", ""))
+        return 200, {"remaining": remaining, "complete": remaining == 0}
+
+    async def story(self, body, query, game_id):
+        game = self.game(game_id)
+        try:
+            wait = min(float(query.get("wait", ["0"])[0] or 0), MAX_WAIT)
+        except ValueError:
+            raise HTTPError(400, "wait must be a number of seconds")
+        if wait > 0 and not game.finished.is_set():
+            try:
+                await asyncio.wait_for(game.finished.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+        if self.games.get(game_id) is not game:
+            raise HTTPError(404, "the game was deleted")
+        return 200, game.story()
+
+    async def stats(self, body, query):
+        stats = {"games": len(self.games), "connections": self.connections,
+                 "requests": self.requests, "uptime": time.monotonic() - self.started,
+                 "players": sum(len(game.players) for game in self.games.values())}
+        try:
+            import resource
+            stats["max_rss_kb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        except ImportError:
+            pass  # not on Windows
+        return 200, stats
+
+    async def dispatch(self, method, target, body):
+        '''Function to route one request. Returns (status, JSON-ready payload).'''
+        url = urlsplit(target)
+        allowed = False
+        for route_method, pattern, handler in self.routes:
+            match = pattern.match(url.path)
+            if match is None:
+                continue
+            if route_method != method:
+                allowed = True
+                continue
+            try:
+                data = json.loads(body) if body else {}
+            except ValueError:
+                raise HTTPError(400, "the body is not JSON")
+            if not isinstance(data, dict):
+                raise HTTPError(400, "the body must be a JSON object")
+            return await handler(data, parse_qs(url.query), *match.groups())
+        if allowed:
+            raise HTTPError(405, "method not allowed")
+        raise HTTPError(404, "not found")
+
+    async def handle(self, reader, writer):
+        '''Function to serve the requests of one connection, kept alive between them'''
+        self.connections += 1
+        try:
+            while True:
+                try:
+                    request_line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                    if not request_line:
+                        break
+                    method, target, version = request_line.decode("latin-1").split()
+                    headers = {}
+                    while True:
+                        line = await asyncio.wait_for(reader.readline(), IDLE_TIMEOUT)
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                        if len(headers) > 64:
+                            raise HTTPError(400, "too many headers")
+                    length = int(headers.get("content-length") or 0)
+                    if length > MAX_BODY:
+                        raise HTTPError(413, "the body is too large")
+                    body = await reader.readexactly(length) if length else b""
+                except HTTPError as e:
+                    await self.respond(writer, e.status, {"error": str(e)}, False)
+                    break
+                except (ValueError, asyncio.LimitOverrunError):
+                    await self.respond(writer, 400, {"error": "bad request"}, False)
+                    break
+                self.requests += 1
+                keep_alive = (version == "HTTP/1.1"
+                              and headers.get("connection", "").lower() != "close")
+                try:
+                    status, payload = await self.dispatch(method, target, body)
+                except HTTPError as e:
+                    status, payload = e.status, {"error": str(e)}
+                except Exception as e:  # keep serving the other games
+                    status, payload = 500, {"error": repr(e)}
+                await self.respond(writer, status, payload, keep_alive)
+                if not keep_alive:
+                    break
+        except (asyncio.TimeoutError, asyncio.IncompleteReadError, ConnectionError):
+            pass
+        finally:
+            self.connections -= 1
+            writer.close()
+
+    @staticmethod
+    async def respond(writer, status, payload, keep_alive):
+        body = json.dumps(payload).encode("utf-8")
+        writer.write(f"HTTP/1.1 {status} {REASONS.get(status, '')}\r\n"
+                     f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+                     f"Connection: {'keep-alive' if keep_alive else 'close'}\r\n\r\n"
+                     .encode("latin-1") + body)
+        await writer.drain()
+
+    async def serve(self, host="127.0.0.1", port=8765, ready=None):
+        '''
+        Function to serve until cancelled
+
+        Keyword arguments:
+        host -- address to listen on (str)
+        port -- port to listen on, 0 for any free one (int)
+        ready -- called with the port once listening
+        '''
+        server = await asyncio.start_server(self.handle, host, port, limit=MAX_LINE,
+                                            backlog=4096)
+        if ready is not None:
+            ready(server.sockets[0].getsockname()[1])
+        async with server:
+            while True:
+                await asyncio.sleep(min(self.ttl, 60))
+                self.expire()
+
+
+def raise_file_limit():
+    '''Function to allow as many open connections as the system lets a process have'''
+    try:
+        import resource
+    except ImportError:
+        return
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if hard == resource.RLIM_INFINITY or soft < hard:
+        try:
+            resource.setrlimit(resource.RLIMIT_NOFILE, (hard if hard != resource.RLIM_INFINITY
+                                                        else 65536, hard))
+        except (ValueError, OSError):
+            pass
+
+
+def run(host="127.0.0.1", port=8765, max_games=MAX_GAMES, ttl=GAME_TTL, ready=None):
+    '''
+    Function to run a game server until interrupted
+
+    Keyword arguments:
+    host -- address to listen on (str)
+    port -- port to listen on (int)
+    max_games -- most games kept at once (int)
+    ttl -- seconds a game is kept after its last request (float)
+    ready -- called with the port once listening
+    '''
+    raise_file_limit()
+    try:
+        asyncio.run(GameServer(max_games, ttl).serve(host, port, ready))
+    except KeyboardInterrupt:
+        pass
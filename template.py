@@ -0,0 +1,224 @@
+import re
+from bisect import bisect_left, bisect_right
+from functools import lru_cache
+from tokenizer import scan
+
+# "a" or "an" written just before a placeholder, e.g. "an [Adjective1]"
+ARTICLE_PATTERN = re.compile(r'\b([Aa]n?)(\s+\[\s*)$')
+ARTICLE_WINDOW = 64  # characters at the end of a segment searched for an article
+
+
+def article_for(word):
+    '''Return "an" for words starting with a vowel, else "a"'''
+    return "an" if word[:1].lower() in "aeiou" else "a"
+
+
+def with_article(segment, start, answer):
+    '''
+    Function to make the article starting at start in segment agree with
+    answer, keeping its capital letter
+
+    Keyword arguments:
+    segment -- literal text ending just before a placeholder name (str)
+    start -- position of the "a" or "an" in segment (int)
+    answer -- answer the placeholder is filled with (str)
+    '''
+    end = start + (2 if segment[start + 1] in "nN" else 1)
+    wanted = article_for(answer)
+    if segment[start] == "A":
+        wanted = wanted.capitalize()
+    return segment[:start] + wanted + segment[end:]
+
+
+class Template:
+    '''
+    A mad lib compiled once into literal text segments and placeholder slots.
+    Rendering joins the precomputed segments with the answers in a single
+    pass, so filling the same template again only pays for the join.
+    '''
+
+    def __init__(self, text):
+        '''
+        Keyword arguments:
+        text -- mad lib text containing [Type N] placeholders (str)
+        '''
+        spans = []
+        for match in scan(text):
+            start, end = match.span(1)
+            spans.append((start, end, match.group(1)))
+        self._build(text, spans)
+
+    @classmethod
+    def from_spans(cls, text, spans):
+        '''
+        Function to rebuild a template from spans saved earlier, which skips
+        scanning the text again
+
+        Keyword arguments:
+        text -- mad lib text (str)
+        spans -- (start, end, name) of each placeholder name (list)
+        '''
+        template = cls.__new__(cls)
+        template._build(text, [(start, end, name) for start, end, name in spans])
+        return template
+
+    def _build(self, text, spans):
+        self.text = text
+        self.spans = spans  # (start, end, name) of each placeholder name
+        self.segments = []  # literal text around the placeholder names
+        last = 0
+        for start, end, _ in spans:
+            self.segments.append(text[last:start])
+            last = end
+        self.segments.append(text[last:])
+        self.names = [name for _, _, name in spans]
+        self.articles = []  # (placeholder number, position in its segment) of each "a" or "an"
+        for i, segment in enumerate(self.segments[:-1]):
+            match = ARTICLE_PATTERN.search(segment, max(0, len(segment) - ARTICLE_WINDOW))
+            if match:
+                self.articles.append((i, match.start(1)))
+
+    def __len__(self):
+        return len(self.spans)
+
+    def filled_segments(self, answers):
+        '''
+        Function to get the literal segments with the "a" or "an" before each
+        answered placeholder agreeing with its answer, e.g. "an apple"
+
+        Keyword arguments:
+        answers -- map of placeholder name to answer (dict)
+        '''
+        if not self.articles:
+            return self.segments
+        segments = list(self.segments)
+        for i, start in self.articles:
+            answer = answers.get(self.names[i])
+            if answer:
+                segments[i] = with_article(segments[i], start, answer)
+        return segments
+
+    def render(self, answers):
+        '''
+        Function to fill in every placeholder in one pass. Placeholders
+        without an answer are left as they are.
+
+        Keyword arguments:
+        answers -- map of placeholder name to answer (dict)
+        '''
+        parts = [None] * (2 * len(self.segments) - 1)
+        parts[::2] = self.filled_segments(answers)
+        parts[1::2] = [answers.get(name, name) for name in self.names]
+        return "".join(parts)
+
+
+def _find_all(text, char, offset=0):
+    '''Function to get the positions of char in text, plus offset'''
+    positions = []
+    i = text.find(char)
+    while i >= 0:
+        positions.append(i + offset)
+        i = text.find(char, i + 1)
+    return positions
+
+
+class PlaceholderIndex:
+    '''
+    Position-sorted index of the placeholders in a document which is kept
+    up to date from edit deltas (QTextDocument.contentsChange) so only the
+    edited region is re-scanned. The positions of every bracket are kept
+    too, so the region to re-scan is found without reading the document.
+    '''
+
+    def __init__(self, text=""):
+        self.reset(text)
+
+    def reset(self, text):
+        '''
+        Function to rebuild the index from scratch
+
+        Keyword arguments:
+        text -- full document text (str)
+        '''
+        self.starts = []  # position of the opening bracket
+        self.ends = []  # position after the closing bracket
+        self.names = []
+        self.opens = _find_all(text, "[")  # position of every "[", placeholder or not
+        self.closes = _find_all(text, "]")
+        for match in scan(text):
+            self.starts.append(match.start())
+            self.ends.append(match.end())
+            self.names.append(match.group(1))
+
+    def __len__(self):
+        return len(self.names)
+
+    def apply_change(self, read, position, removed, added):
+        '''
+        Function to update the index after an edit. Placeholders cannot
+        contain brackets, so a placeholder touching the edit must start at
+        the last "[" before it and end at the first "]" after it, and only
+        the text between those is read.
+
+        Keyword arguments:
+        read -- function returning the document text from start to end, after the edit (function)
+        position -- position where the edit happened (int)
+        removed -- number of characters removed (int)
+        added -- number of characters added (int)
+        '''
+        delta = added - removed
+        added_text = read(position, position + added)
+        for brackets, char in ((self.opens, "["), (self.closes, "]")):
+            first = bisect_left(brackets, position)
+            last = bisect_left(brackets, position + removed, lo=first)
+            brackets[first:] = (_find_all(added_text, char, position)
+                                + [bracket + delta for bracket in brackets[last:]])
+
+        # placeholders overlapping the removed range are dropped
+        first = bisect_right(self.ends, position)
+        last = bisect_left(self.starts, position + removed, lo=first)
+        tail_starts = [start + delta for start in self.starts[last:]]
+        tail_ends = [end + delta for end in self.ends[last:]]
+        tail_names = self.names[last:]
+        del self.starts[first:], self.ends[first:], self.names[first:]
+
+        # re-scan between the surrounding untouched placeholders, from a "["
+        # before the edit with no "]" after it to a "]" after the edit with no "[" before it
+        prev_end = self.ends[-1] if self.ends else 0
+        next_start = tail_starts[0] if tail_starts else None
+        low = high = None
+        i = bisect_left(self.opens, position) - 1
+        if i >= 0 and self.opens[i] >= prev_end:
+            j = bisect_left(self.closes, position) - 1
+            if j < 0 or self.closes[j] < self.opens[i]:
+                low = self.opens[i]
+        j = bisect_left(self.closes, position + added)
+        if j < len(self.closes) and (next_start is None or self.closes[j] < next_start):
+            i = bisect_left(self.opens, position + added)
+            if i == len(self.opens) or self.opens[i] > self.closes[j]:
+                high = self.closes[j] + 1
+        if low is None and high is None:
+            low, high, text = position, position + added, added_text
+        else:
+            low = position if low is None else low
+            high = position + added if high is None else high
+            text = read(low, high)
+        for match in scan(text):
+            self.starts.append(match.start() + low)
+            self.ends.append(match.end() + low)
+            self.names.append(match.group(1))
+        self.starts += tail_starts
+        self.ends += tail_ends
+        self.names += tail_names
+
+
+@lru_cache(maxsize=32)
+def compile_template(text):
+    '''
+    Function to compile a template, reusing the compiled form when the same
+    text is filled in again (e.g. re-doing a saved mad lib)
+
+    Keyword arguments:
+    text -- mad lib text containing [Type N] placeholders (str)
+    '''
+    return Template(text)
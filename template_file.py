@@ -0,0 +1,141 @@
+'''
+Native .madlib template format. A file is a JSON header line followed by
+one JSON line per template holding the theme, the text, the placeholder
+spans found when it was saved and any answers:
+
+    {"format": "madlib", "version": 1}
+    {"theme": "Winter", "text": "...", "spans": [[5, 10, "Noun1"]], "answers": {}}
+
+Files are read through mmap and a record is only parsed when it is used.
+'''
+import os
+import mmap
+import json
+from template import Template
+
+FORMAT_NAME = "madlib"
+FORMAT_VERSION = 1
+EXTENSION = ".madlib"
+
+
+class TemplateRecord:
+    '''A saved mad lib: theme, text with prompts, placeholder spans and answers'''
+
+    def __init__(self, theme, text, answers=None, spans=None):
+        self.theme = theme
+        self.text = text
+        self.answers = answers or {}
+        self._spans = spans
+        self._template = None
+
+    @property
+    def template(self):
+        '''Compiled template, built from the saved spans when there are some'''
+        if self._template is None:
+            if self._spans is None:
+                self._template = Template(self.text)
+            else:
+                self._template = Template.from_spans(self.text, self._spans)
+        return self._template
+
+    def to_json(self):
+        return json.dumps({"theme": self.theme, "text": self.text,
+                           "spans": self.template.spans, "answers": self.answers},
+                          ensure_ascii=False, separators=(",", ":"))
+
+    @classmethod
+    def from_json(cls, line):
+        '''
+        Function to parse one record line. Raises ValueError if the saved
+        spans don't match the text.
+
+        Keyword arguments:
+        line -- JSON record (str or bytes)
+        '''
+        record = json.loads(line)
+        text = record["text"]
+        spans = record.get("spans")
+        if spans is not None:
+            for start, end, name in spans:
+                if text[start:end] != name:
+                    raise ValueError("placeholder spans don't match the text")
+        return cls(record.get("theme", ""), text, record.get("answers"), spans)
+
+
+def save_templates(path, records):
+    '''
+    Function to write templates to a .madlib file
+
+    Keyword arguments:
+    path -- file to write (str)
+    records -- iterable of TemplateRecord
+    '''
+    header = json.dumps({"format": FORMAT_NAME, "version": FORMAT_VERSION})
+    with open(path, "w", encoding="utf-8", newline="\n") as file:
+        file.write(header + "\n")
+        for record in records:
+            file.write(record.to_json() + "\n")
+
+
+class TemplateFile:
+    '''
+    Memory-mapped reader for a .madlib file. Supports len(), indexing and
+    iteration; records are parsed on access.
+    '''
+
+    def __init__(self, path):
+        '''
+        Raises ValueError if the file is not a .madlib file this version
+        can read.
+
+        Keyword arguments:
+        path -- file to read (str)
+        '''
+        self.path = path
+        self._file = open(path, "rb")
+        if os.fstat(self._file.fileno()).st_size == 0:
+            self._file.close()
+            raise ValueError(path + " is empty")
+        self._map = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            header = json.loads(self._map.readline())
+        except ValueError:
+            header = {}
+        if not isinstance(header, dict) or header.get("format") != FORMAT_NAME:
+            self.close()
+            raise ValueError(path + " is not a mad lib template file")
+        if header.get("version", 0) > FORMAT_VERSION:
+            self.close()
+            raise ValueError(path + " was saved by a newer version")
+        # offsets of each record line, found without decoding anything
+        self._offsets = []
+        position = self._map.tell()
+        size = len(self._map)
+        while position < size:
+            end = self._map.find(b"\n", position)
+            if end < 0:
+                end = size
+            if end > position:
+                self._offsets.append((position, end))
+            position = end + 1
+
+    def __len__(self):
+        return len(self._offsets)
+
+    def __getitem__(self, i):
+        start, end = self._offsets[i]
+        return TemplateRecord.from_json(self._map[start:end])
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        self._map.close()
+        self._file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
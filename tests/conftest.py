@@ -0,0 +1,18 @@
+'''
+Set up shared by the tests: the repository root on sys.path, Qt on the
+offscreen platform and one QApplication for the tests which need Qt.
+The stub clients and the stub server are the ones in benchmarks.py.
+'''
+import os
+import sys
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+
+
+@pytest.fixture(scope="session")
+def qapp():
+    '''The QApplication, made on first use'''
+    from PyQt6.QtWidgets import QApplication
+    return QApplication.instance() or QApplication([])
@@ -0,0 +1,93 @@
+'''
+Edits to the text box: the placeholder index and the text mirror are
+updated from the edit alone and agree with reading the whole text again,
+and undo gives back exactly what was there.
+'''
+import random
+from history import TextMirror
+from template import PlaceholderIndex
+
+PARAGRAPH = "\u2029"  # how Qt separates paragraphs
+PIECES = ["[", "]", "Noun", "1", " ", "x", "\n", "[Noun1]", "[ Verb 2 ]", "[Adj"]
+
+
+def random_edits(rng, text, steps):
+    '''Yield (position, removed, added) edits to a text and the text after each'''
+    for _ in range(steps):
+        position = rng.randint(0, len(text))
+        removed = rng.randint(0, min(4, len(text) - position))
+        added = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 3)))
+        text = text[:position] + added + text[position + removed:]
+        yield position, removed, added, text
+
+
+def test_index_matches_a_full_scan():
+    rng = random.Random(0)
+    for _ in range(500):
+        text = "".join(rng.choice(PIECES) for _ in range(rng.randint(0, 12)))
+        index = PlaceholderIndex(text)
+        for position, removed, added, text in random_edits(rng, text, 10):
+            index.apply_change(lambda start, end: text[start:end], position, removed, len(added))
+            full = PlaceholderIndex(text)
+            assert (index.starts, index.ends, index.names) == (full.starts, full.ends, full.names)
+            assert (index.opens, index.closes) == (full.opens, full.closes)
+
+
+def test_index_reads_only_near_the_edit():
+    text = "x" * 100000 + " [Noun1] " + "y" * 100000
+    index = PlaceholderIndex(text)
+    read = []
+
+    def reader(start, end):
+        read.append(end - start)
+        return text[start:end]
+    text = text[:500] + "z" + text[500:]
+    index.apply_change(reader, 500, 0, 1)
+    assert sum(read) == 1
+    assert index.names == ["Noun1"] and index.starts == [100002]
+
+
+def test_mirror_gives_back_the_removed_text():
+    rng = random.Random(1)
+    for _ in range(500):
+        text = "".join(rng.choice(["a", "b", PARAGRAPH, "\xa0"]) for _ in range(rng.randint(0, 10)))
+        mirror = TextMirror(text)
+        for position, removed, added, after in random_edits(rng, text, 8):
+            added = added.replace("\n", PARAGRAPH)
+            after = text[:position] + added + text[position + removed:]
+            paragraph = text.count(PARAGRAPH, 0, position)
+            column = position - (text.rfind(PARAGRAPH, 0, position) + 1)
+            assert mirror.replace(paragraph, column, removed, added) == \
+                text[position:position + removed]
+            text = after
+            assert mirror.paragraphs == text.split(PARAGRAPH) and mirror.length == len(text)
+        assert mirror.text() == text.replace(PARAGRAPH, "\n").replace("\xa0", " ")
+
+
+def test_window_keeps_up_with_edits_and_undo(qapp):
+    from PyQt6.QtGui import QTextCursor
+    from mad_libs import MainWindow
+    window = MainWindow()
+    window.full_text.setPlainText("Once [Noun1] a\nday [Verb2] x")
+    window.history_clear()
+    document = window.full_text.document()
+    start = document.toPlainText()
+    rng = random.Random(2)
+    for _ in range(300):
+        cursor = QTextCursor(document)
+        length = document.characterCount() - 1
+        position = rng.randint(0, length)
+        cursor.setPosition(position)
+        cursor.setPosition(min(length, position + rng.randint(0, 4)),
+                           QTextCursor.MoveMode.KeepAnchor)
+        cursor.insertText("".join(rng.choice(PIECES + ["é"]) for _ in range(rng.randint(0, 3))))
+        text = document.toPlainText()
+        assert window.text_mirror.text() == text
+        assert window.placeholders.names == PlaceholderIndex(text).names
+    end = document.toPlainText()
+    while window.history.can_undo():
+        window.undo_edit()
+    assert document.toPlainText() == start
+    while window.history.can_redo():
+        window.redo_edit()
+    assert document.toPlainText() == end
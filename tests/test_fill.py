@@ -0,0 +1,98 @@
+'''
+The fill-in form driven headlessly: FillSession paste, update and labels,
+AnswerModel sending the story edits, FillDialog's preview following the
+answers, and a render time budget for a story with thousands of blanks.
+'''
+import time
+from fill_session import FillSession
+from benchmarks import synthetic_template
+
+TEXT = "I saw an [Adjective1] [Noun2] eat a [Noun2] with [Number3] friends."
+BLANKS = 5000
+UPDATE_BUDGET = 0.002  # seconds to apply one changed answer to the preview
+FILL_BUDGET = 1.0  # seconds to answer every blank of BLANKS one at a time
+
+
+def apply(story, edits):
+    '''Function to make the session's (offset, old length, new text) edits to story'''
+    for offset, old_length, text in edits:
+        story = story[:offset] + text + story[offset + old_length:]
+    return story
+
+
+def test_labels():
+    session = FillSession(TEXT)
+    assert session.names == ["Adjective1", "Noun2", "Number3"]
+    assert [session.label(row) for row in range(len(session))] == \
+        ["Enter an Adjective:", "Enter a Noun:", "Enter a Number:"]
+
+
+def test_paste():
+    session = FillSession(TEXT)
+    story = apply(TEXT, session.paste(["  dog \n", "3", "extra"], start_row=1))
+    assert session.answers == {"Noun2": "dog", "Number3": "3"}
+    assert story == session.render() == \
+        "I saw an [Adjective1] [dog] eat a [dog] with [3] friends."
+    story = apply(story, session.paste(["odd"]))
+    assert story == session.render() == "I saw an [odd] [dog] eat a [dog] with [3] friends."
+    assert session.is_complete()
+
+
+def test_update_and_clear():
+    session = FillSession(TEXT)
+    story = apply(TEXT, session.update({"Adjective1": "big", "Noun2": "owl"}))
+    assert story == session.render() == "I saw a [big] [owl] eat an [owl] with [Number3] friends."
+    # an empty answer shows the prompt and the article as written again
+    story = apply(story, session.update({"Adjective1": "", "Noun2": ""}))
+    assert story == TEXT and session.answers == {}
+
+
+def test_model_sends_the_story_edits(qapp):
+    from PyQt6.QtCore import Qt
+    from mad_libs import AnswerModel
+    session = FillSession(TEXT)
+    model = AnswerModel(session)
+    story, changed = [TEXT], []
+    model.storyEdited.connect(lambda edits: story.append(apply(story[-1], edits)))
+    model.dataChanged.connect(lambda first, last: changed.append((first.row(), last.row())))
+    assert (model.rowCount(), model.columnCount()) == (3, 2)
+    assert model.data(model.index(1, 0)) == "Enter a Noun:"
+    assert model.flags(model.index(1, 1)) & Qt.ItemFlag.ItemIsEditable
+    assert not model.flags(model.index(1, 0)) & Qt.ItemFlag.ItemIsEditable
+
+    assert model.setData(model.index(1, 1), " cat ")
+    assert model.data(model.index(1, 1)) == "cat"
+    model.paste(["odd", "cat", "2"])
+    model.update({"Number3": "9"})
+    assert changed == [(1, 1), (0, 2), (0, 2)]
+    assert story[-1] == session.render() == "I saw an [odd] [cat] eat a [cat] with [9] friends."
+
+
+def test_dialog_preview_follows_the_answers(qapp):
+    from mad_libs import FillDialog
+    session = FillSession(TEXT)
+    dialog = FillDialog(session)
+    qapp.clipboard().setText("odd\tcat\n2")
+    dialog.paste_answers()
+    assert session.answers == {"Adjective1": "odd", "Noun2": "cat", "Number3": "2"}
+    assert dialog.preview.toPlainText() == session.render()
+    dialog.model.update({"Adjective1": "", "Noun2": "apple"})
+    assert dialog.preview.toPlainText() == session.render() == \
+        "I saw an [Adjective1] [apple] eat an [apple] with [2] friends."
+
+
+def test_render_time(qapp):
+    from mad_libs import FillDialog
+    text = synthetic_template(BLANKS)
+    session = FillSession(text)
+    dialog = FillDialog(session)
+    start = time.perf_counter()
+    for row, name in enumerate(session.names):
+        dialog.model.setData(dialog.model.index(row, 1), "word")
+    fill = time.perf_counter() - start
+    start = time.perf_counter()
+    dialog.model.setData(dialog.model.index(BLANKS // 2, 1), "changed")
+    update = time.perf_counter() - start
+    assert dialog.preview.toPlainText() == session.render()
+    assert fill < FILL_BUDGET, f"filling {BLANKS} blanks took {fill:.3f}s"
+    assert update < UPDATE_BUDGET, f"one answer took {update * 1e3:.2f}ms"
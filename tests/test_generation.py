@@ -0,0 +1,126 @@
+'''
+Generation off the GUI thread: the event loop keeps running during a slow
+completion, Cancel stops the worker without a result, and wrong prompt
+counts and client errors are retried.
+'''
+import pytest
+import generation
+import providers
+from tokenizer import count_tokens
+from benchmarks import SlowClient
+
+
+class ErrorClient(SlowClient):
+    '''SlowClient whose every request fails'''
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+        raise ConnectionError("no route to host")
+
+
+def run_worker(qapp, worker, timeout=5000):
+    '''
+    Function to run a GenerationWorker on the thread pool and the event loop
+    until it reports back. Returns (finished, failed, timer ticks seen).
+    '''
+    from PyQt6.QtCore import QEventLoop, QThreadPool, QTimer
+    finished, failed, ticks = [], [], []
+    loop = QEventLoop()
+    worker.signals.finished.connect(finished.append)
+    worker.signals.failed.connect(failed.append)
+    worker.signals.finished.connect(loop.quit)
+    worker.signals.failed.connect(loop.quit)
+    timer = QTimer()
+    timer.timeout.connect(lambda: ticks.append(1))
+    timer.start(10)
+    QTimer.singleShot(timeout, loop.quit)
+    QThreadPool.globalInstance().start(worker)
+    loop.exec()
+    timer.stop()
+    QThreadPool.globalInstance().waitForDone(timeout)
+    return finished, failed, len(ticks)
+
+
+def test_event_loop_runs_during_slow_completion(qapp):
+    from mad_libs import GenerationWorker
+    provider = providers.ChatProvider(SlowClient(delay=0.5, blanks=4, valid_every=1))
+    worker = GenerationWorker(provider, "Winter", 4, max_retries=3)
+    finished, failed, ticks = run_worker(qapp, worker)
+    assert not failed
+    assert len(finished) == 1 and count_tokens(finished[0]) == 4
+    # a 10ms timer kept firing while the 0.5s request was out
+    assert ticks >= 10
+
+
+def test_streamed_text_arrives_before_the_result(qapp):
+    from mad_libs import GenerationWorker
+    provider = providers.ChatProvider(SlowClient(delay=0.2, blanks=3, valid_every=1))
+    worker = GenerationWorker(provider, "Winter", 3, max_retries=1, stream=True)
+    pieces = []
+    worker.signals.text.connect(pieces.append)
+    finished, failed, _ = run_worker(qapp, worker)
+    assert len(finished) == 1 and len(pieces) > 1
+    assert finished[0] in "".join(pieces)
+
+
+def test_cache_error_keeps_the_mad_lib(qapp):
+    import sqlite3
+    from mad_libs import GenerationWorker
+
+    class LockedCache:
+        def put(self, key, paragraph):
+            raise sqlite3.OperationalError("database is locked")
+    provider = providers.ChatProvider(SlowClient(delay=0.01, blanks=2, valid_every=1))
+    worker = GenerationWorker(provider, "Winter", 2, max_retries=1, cache=LockedCache())
+    cache_errors = []
+    worker.signals.cache_failed.connect(cache_errors.append)
+    finished, failed, _ = run_worker(qapp, worker)
+    qapp.processEvents()
+    assert len(finished) == 1 and not failed
+    assert cache_errors == ["database is locked"]
+
+
+def test_cancel_sends_nothing_back(qapp):
+    from PyQt6.QtCore import QThreadPool
+    from mad_libs import GenerationWorker
+    client = SlowClient(delay=0.2, blanks=4, valid_every=3)
+    worker = GenerationWorker(providers.ChatProvider(client), "Winter", 4, max_retries=3)
+    finished, failed = [], []
+    worker.signals.finished.connect(finished.append)
+    worker.signals.failed.connect(failed.append)
+    QThreadPool.globalInstance().start(worker)
+    worker.cancel()
+    assert QThreadPool.globalInstance().waitForDone(5000)
+    qapp.processEvents()
+    assert finished == [] and failed == []
+    assert client.calls <= 1
+
+
+def test_wrong_counts_are_asked_again(monkeypatch):
+    monkeypatch.setattr(generation, "REPAIR", False)
+    attempts = []
+    paragraph = generation.generate_mad_lib(SlowClient(delay=0, blanks=4, valid_every=3),
+                                            "Winter", 4, attempts=attempts)
+    assert count_tokens(paragraph) == 4
+    assert [attempt.valid for attempt in attempts] == [False, False, True]
+
+
+def test_gives_up_after_max_retries(monkeypatch):
+    monkeypatch.setattr(generation, "REPAIR", False)
+    attempts = []
+    with pytest.raises(generation.GenerationFailed):
+        generation.generate_mad_lib(SlowClient(delay=0, blanks=4, valid_every=1000),
+                                    "Winter", 4, max_retries=2, attempts=attempts)
+    assert len(attempts) == 2
+
+
+def test_client_errors_are_retried_and_reported():
+    client = ErrorClient(delay=0)
+    attempts = []
+    with pytest.raises(generation.GenerationFailed) as failure:
+        generation.generate_mad_lib(client, "Winter", 4, max_retries=3, backoff=0.01,
+                                    attempts=attempts)
+    assert client.calls == 3
+    assert isinstance(failure.value.error, ConnectionError)
+    assert all(isinstance(attempt.error, ConnectionError) for attempt in attempts)
@@ -0,0 +1,96 @@
+'''
+The autosave journal: edits and prompt state written by the worker are
+read back as the same text and state, also after compaction or a crash
+part way through a line, and the window journals what it shows.
+'''
+import os
+import random
+import pytest
+from journal import Journal, read_journal, merge_edit, apply_edit
+
+
+@pytest.fixture
+def path(tmp_path):
+    return str(tmp_path / "autosave.journal")
+
+
+def test_merge_edit():
+    assert merge_edit((3, 0, "ab"), (5, 0, "c")) == (3, 0, "abc")  # typing
+    assert merge_edit((5, 1, ""), (4, 1, "")) == (4, 2, "")  # backspace
+    assert merge_edit((3, 0, "ab"), (9, 0, "c")) is None  # somewhere else
+
+
+def test_no_journal(path):
+    assert read_journal(path) == ("", {})
+
+
+def test_round_trip(path):
+    rng = random.Random(0)
+    journal = Journal(path, interval=0.01)
+    text = ""
+    for i in range(500):
+        position = rng.randint(0, len(text))
+        removed = rng.randint(0, min(3, len(text) - position)) if rng.random() < 0.3 else 0
+        added = rng.choice(["", "a", "b", " ", "\n", "[Noun1]"])
+        journal.record(position, removed, added)
+        text = apply_edit(text, (position, removed, added))
+        if i % 50 == 0:
+            journal.set_state(theme="Winter " + str(i), answers={"Noun1": str(i)})
+    journal.set_state(template="A [Noun1].")
+    journal.flush()
+    assert read_journal(path) == (text, {"theme": "Winter 450", "answers": {"Noun1": "450"},
+                                         "template": "A [Noun1]."})
+    journal.close()
+    again = Journal(path)
+    assert (again.text, again.state["template"]) == (text, "A [Noun1].")
+    again.close()
+
+
+def test_compaction_keeps_the_text(path):
+    journal = Journal(path, interval=0.01, compact_bytes=1024)
+    text = ""
+    for i in range(2000):
+        journal.record(len(text), 0, "x")
+        text += "x"
+        if journal.wants_snapshot:
+            journal.snapshot(text)
+        if i % 100 == 0:
+            journal.flush()
+    journal.close()
+    assert journal.compactions > 1
+    assert os.path.getsize(path) < 4096
+    assert read_journal(path) == (text, {})
+
+
+def test_cut_off_line_is_ignored(path):
+    journal = Journal(path, interval=0.01)
+    journal.record(0, 0, "hello")
+    journal.close()
+    with open(path, "a", encoding="utf-8") as file:
+        file.write('["e",5,0,"wor')  # the crash came part way through
+    assert read_journal(path) == ("hello", {})
+
+
+def test_one_window_per_journal(path):
+    journal = Journal(path)
+    with pytest.raises(OSError):
+        Journal(path)
+    journal.close()
+
+
+def test_window_journals_typing_and_clear(qapp, path):
+    from PyQt6.QtGui import QTextCursor
+    from mad_libs import MainWindow
+    window = MainWindow()
+    window.start_autosave(Journal(path, interval=0.01))
+    window.theme_text.setText("Pirates")
+    QTextCursor(window.full_text.document()).insertText("Ahoy [Noun1]\nmatey")
+    window.journal.flush()
+    text, state = read_journal(path)
+    assert (text, state["theme"]) == ("Ahoy [Noun1]\nmatey", "Pirates")
+
+    window.final_pre_text = "Ahoy [Noun1]"
+    window.clear_all()
+    window.journal.flush()
+    assert read_journal(path) == ("", {"theme": "", "template": "", "answers": {}, "filled": False})
+    window.journal.close()
@@ -0,0 +1,120 @@
+'''
+The template library: FTS searches by theme and text words, blank counts
+and prompt types, and bulk imports of saved .madlib and .docx files,
+including from a thread as the Open dialog does.
+'''
+import threading
+import pytest
+import core
+from library import Library
+from template_file import TemplateRecord, save_templates
+
+
+@pytest.fixture
+def library():
+    library = Library(":memory:")
+    library.add("Space pirates", "The [Celebrity1] flew a [Noun2] to [Place3].")
+    library.add("Spaceships", " ".join(f"[Noun{i}]" for i in range(1, 11)) + " [Celebrity11]")
+    library.add("Winter", "Snow fell on the [Noun1] and my [Part of the Body2] froze.")
+    library.add("Outer space", "Stars are [Adjective1].")
+    yield library
+    library.close()
+
+
+def themes(entries):
+    return sorted(entry.theme for entry in entries)
+
+
+def test_search_by_theme(library):
+    assert themes(library.search(theme="spac")) == ["Outer space", "Space pirates", "Spaceships"]
+    assert themes(library.search(theme="space pirates")) == ["Space pirates"]
+    assert library.search(theme="desert") == []
+
+
+def test_search_by_text(library):
+    assert themes(library.search(text="snow")) == ["Winter"]
+    assert themes(library.search(theme="space", text="stars")) == ["Outer space"]
+
+
+def test_search_by_blanks_and_types(library):
+    assert themes(library.search(theme="space", min_blanks=8, max_blanks=12,
+                                 types=["Celebrity"])) == ["Spaceships"]
+    assert themes(library.search(types=["celebrity"])) == ["Space pirates", "Spaceships"]
+    assert themes(library.search(types=["Part of the Body"])) == ["Winter"]
+    assert themes(library.search(types=["Noun", "Place"])) == ["Space pirates"]
+    assert themes(library.search(max_blanks=1)) == ["Outer space"]
+    entry = library.search(theme="spaceships")[0]
+    assert entry.blank_count == 11
+
+
+def test_search_quotes_and_limit(library):
+    # quotes in the words can't break the FTS query
+    assert themes(library.search(theme='"space')) == themes(library.search(theme="space"))
+    assert len(library.search(limit=2)) == 2
+    assert len(library) == 4
+
+
+def test_add_replaces_the_same_source(library):
+    library.add("Winter", "Old [Noun1]", source="/saves/winter.madlib#0")
+    library.add("Winter", "New [Noun1] and [Verb2]", source="/saves/winter.madlib#0")
+    assert [entry.text for entry in library.search(text="new")] == ["New [Noun1] and [Verb2]"]
+    assert library.search(text="old") == []
+    assert library.search(theme="winter", types=["Verb"])[0].blank_count == 2
+
+
+@pytest.fixture
+def saves(tmp_path):
+    '''A folder of saved mad libs: two .madlib files, a .docx and files to skip'''
+    save_templates(str(tmp_path / "space.madlib"),
+                   [TemplateRecord("Space", "A [Noun1] in orbit"),
+                    TemplateRecord("Moon", "The [Adjective1] moon")])
+    (tmp_path / "more").mkdir()
+    save_templates(str(tmp_path / "more" / "sea.madlib"), [TemplateRecord("Sea", "Waves [Verb1]")])
+    core.write_docx(str(tmp_path / "more" / "desert.docx"), "Desert", "Sand [x]",
+                    "Sand [Noun1]", {0: "Noun1"})
+    (tmp_path / "broken.madlib").write_text("not a template")
+    (tmp_path / "~$desert.docx").write_text("Word's lock file")
+    (tmp_path / "notes.txt").write_text("[Noun1]")
+    return tmp_path
+
+
+def test_import_directory(saves):
+    library = Library(":memory:")
+    progress = []
+    assert library.import_directory(str(saves), workers=2,
+                                    progress=lambda *done: progress.append(done)) == 4
+    assert progress == [(1, 4), (2, 4), (3, 4), (4, 4)]
+    assert themes(library.search()) == ["Desert", "Moon", "Sea", "Space"]
+    assert library.search(theme="desert")[0].text == "Sand [Noun1]"
+    assert library.search(theme="moon")[0].source == str(saves / "space.madlib") + "#1"
+    # importing again replaces the templates from the same files
+    assert library.import_directory(str(saves), workers=2) == 4
+    assert len(library) == 4
+    library.close()
+
+
+def test_import_from_a_thread(saves):
+    library = Library(":memory:")
+    added = []
+    paths = [str(saves / "space.madlib"), str(saves / "more" / "sea.madlib")]
+    thread = threading.Thread(target=lambda: added.append(library.import_files(paths, workers=2)))
+    thread.start()
+    thread.join(60)
+    assert added == [3]
+    assert themes(library.search()) == ["Moon", "Sea", "Space"]
+    library.close()
+
+
+def test_open_dialog_imports_on_the_thread_pool(qapp, saves):
+    import time
+    from mad_libs import LibraryDialog
+    library = Library(":memory:")
+    dialog = LibraryDialog(library)
+    dialog.run_import(library.import_directory, str(saves))
+    end = time.monotonic() + 60
+    while "import" not in dialog.count_label.text() and time.monotonic() < end:
+        qapp.processEvents()
+        time.sleep(0.01)
+    assert "(4 imported)" in dialog.count_label.text()
+    assert dialog.results.count() == 4
+    library.close()
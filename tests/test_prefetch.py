@@ -0,0 +1,147 @@
+'''
+The prefetch pools against a local stub backend: a theme gets a pool on
+its second ask, pops are then served from it and it is topped up again,
+all within the request rate and concurrency budgets. Refills which fail
+back off and never leave a pool waiting.
+'''
+import sqlite3
+import threading
+import pytest
+import providers
+from generation import GenerationFailed
+from prefetch import PrefetchPool, TokenBucket
+from tokenizer import count_tokens
+from benchmarks import CountingClient, stub_endpoint
+
+
+class Clock:
+    '''Clock for TokenBucket which only moves when told to'''
+
+    def __init__(self):
+        self.now = 100.0
+
+    def __call__(self):
+        return self.now
+
+
+class BrokenProvider(providers.LocalProvider):
+    '''A provider with a bug, raising something other than GenerationFailed'''
+    name = "broken"
+
+    def _generate(self, *args):
+        raise RuntimeError("bug")
+
+
+class FailingProvider(providers.LocalProvider):
+    name = "failing"
+
+    def _generate(self, *args):
+        raise GenerationFailed("down")
+
+
+class BrokenCache:
+    '''GenerationCache whose database has gone away'''
+
+    def put(self, key, paragraph):
+        raise sqlite3.OperationalError("disk I/O error")
+
+
+@pytest.fixture
+def pool():
+    pool = PrefetchPool(depth=2, rate=1000.0, burst=1000)
+    yield pool
+    pool.close()
+
+
+def test_token_bucket():
+    clock = Clock()
+    bucket = TokenBucket(rate=2.0, burst=3, clock=clock)
+    assert [bucket.take() for _ in range(3)] == [0.0, 0.0, 0.0]
+    assert bucket.take() == pytest.approx(0.5)
+    clock.now += 0.5
+    assert bucket.take() == 0.0
+    clock.now += 100  # saves up no more than burst
+    assert [bucket.take() for _ in range(4)] == [0.0, 0.0, 0.0, pytest.approx(0.5)]
+
+
+def test_token_bucket_cancel():
+    bucket = TokenBucket(rate=0.001, burst=1, clock=Clock())
+    cancel_event = threading.Event()
+    assert bucket.acquire(cancel_event)
+    cancel_event.set()
+    assert not bucket.acquire(cancel_event)
+
+
+def test_pool_on_second_ask_then_hits(pool):
+    local = providers.LocalProvider(seed=0)
+    assert pool.pop(local, "Winter", 5) is None
+    assert pool.stats()["pools"] == []  # one ask isn't enough for a pool
+    assert pool.pop(local, " winter ", 5) is None
+    assert pool.wait(5)
+    assert [entry["depth"] for entry in pool.stats()["pools"]] == [2]
+    paragraph = pool.pop(local, "Winter", 5)
+    assert count_tokens(paragraph) == 5
+    assert pool.wait(5)
+    stats = pool.stats()
+    assert (stats["hits"], stats["misses"], stats["requests"]) == (1, 2, 3)
+    assert stats["pools"][0]["depth"] == 2  # topped up again
+
+
+def test_least_recently_used_pool_dropped():
+    pool = PrefetchPool(depth=1, themes=2, rate=1000.0, burst=1000, admit=1)
+    local = providers.LocalProvider(seed=0)
+    for theme in ("Winter", "Pirates", "Space"):
+        pool.pop(local, theme, 3)
+    pool.wait(5)
+    pool.close()
+    assert [entry["theme"] for entry in pool.stats()["pools"]] == ["Pirates", "Space"]
+
+
+def test_stub_backend_within_budgets():
+    client = CountingClient(delay=0.1, blanks=5, valid_every=1)
+    server = stub_endpoint(client)
+    endpoint = providers.EndpointProvider(f"http://127.0.0.1:{server.server_port}/v1")
+    pool = PrefetchPool(depth=3, themes=4, workers=2, rate=1000.0, burst=1000, admit=1)
+    try:
+        for theme in ("Winter", "Pirates", "Space"):
+            pool.pop(endpoint, theme, 5)
+        assert pool.wait(10)
+        assert client.most_in_flight <= 2
+        assert all(entry["depth"] == 3 for entry in pool.stats()["pools"])
+        assert count_tokens(pool.pop(endpoint, "Pirates", 5)) == 5
+    finally:
+        pool.close()
+        server.shutdown()
+
+
+def test_rate_budget():
+    pool = PrefetchPool(depth=5, rate=0.001, burst=2, admit=1)
+    pool.pop(providers.LocalProvider(seed=0), "Winter", 3)
+    assert not pool.wait(0.3)  # the rest wait for tokens
+    pool.close()
+    assert pool.stats()["requests"] == 2
+
+
+def test_failed_refill_backs_off(pool):
+    failing = FailingProvider()
+    pool.pop(failing, "Winter", 3)
+    pool.pop(failing, "Winter", 3)
+    assert pool.wait(5)
+    assert pool.stats()["failures"] == 2
+    pool.pop(failing, "Winter", 3)  # within FAILURE_DELAY, nothing new is started
+    assert pool.wait(5)
+    assert pool.stats()["failures"] == 2
+
+
+@pytest.mark.parametrize("provider, cache", [
+    (BrokenProvider(), None),
+    (providers.LocalProvider(seed=0), BrokenCache()),
+])
+def test_unexpected_errors_release_the_pool(provider, cache):
+    pool = PrefetchPool(depth=2, rate=1000.0, burst=1000, admit=1, cache=cache)
+    pool.pop(provider, "Winter", 3)
+    assert pool.wait(5)
+    pool.close()
+    stats = pool.stats()
+    assert stats["failures"] == 2 and stats["error"] is not None
+    assert stats["pools"][0]["pending"] == 0
@@ -0,0 +1,80 @@
+'''
+Token budgets of generation requests: the completion budget grows with
+the number of blanks up to MAX_TOKENS, JSON mode is asked for where the
+model has it, and replies cut off by the budget are noticed.
+'''
+import pytest
+import generation
+from tokenizer import count_tokens
+from benchmarks import JSONClient
+
+
+def test_max_tokens_for():
+    assert generation.max_tokens_for(0) == generation.BASE_TOKENS
+    assert generation.max_tokens_for(10) == generation.BASE_TOKENS + 10 * generation.TOKENS_PER_BLANK
+    assert generation.max_tokens_for(10) < generation.max_tokens_for(11)
+    assert generation.max_tokens_for(100000) == generation.MAX_TOKENS
+
+
+def test_request_options_json_model():
+    options = generation.request_options("gpt-4o", 5)
+    assert options == {"model": "gpt-4o", "temperature": generation.TEMPERATURE,
+                       "max_tokens": generation.max_tokens_for(5),
+                       "response_format": {"type": "json_object"}}
+
+
+def test_request_options_plain_text_model():
+    options = generation.request_options("gpt-4", 5)
+    assert "response_format" not in options
+    assert options["max_tokens"] == generation.max_tokens_for(5)
+
+
+def test_request_options_stream():
+    options = generation.request_options("gpt-4o", 5, stream=True)
+    assert options["stream"] is True
+    assert options["stream_options"] == {"include_usage": True}
+
+
+def test_prompt_types_match_the_buttons():
+    import inputs_file
+    assert generation.PROMPT_TYPES == [value for value in inputs_file.inputs.values()
+                                       if value != "Custom"]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+@pytest.mark.parametrize("blanks", [5, 20, 100])
+def test_requests_ask_for_the_budget(stream, blanks):
+    client = JSONClient()
+    attempts = []
+    paragraph = generation.generate_mad_lib(client, "Winter", blanks, attempts=attempts,
+                                            model="gpt-4o",
+                                            on_text=(lambda text: None) if stream else None)
+    assert count_tokens(paragraph) == blanks
+    budget = generation.max_tokens_for(blanks)
+    assert [request["max_tokens"] for request in client.requests] == [budget] * len(attempts)
+    assert all(request["response_format"] == {"type": "json_object"}
+               for request in client.requests)
+    assert all(attempt.max_tokens == budget and not attempt.tokens_estimated
+               and attempt.prompt_tokens and attempt.completion_tokens
+               for attempt in attempts)
+
+
+def test_cut_off_reply_is_noticed():
+    # so wordy that the reply runs out of tokens every time
+    client = JSONClient(words_per_blank=60)
+    attempts = []
+    with pytest.raises(generation.GenerationFailed):
+        generation.generate_mad_lib(client, "Winter", 10, max_retries=2, attempts=attempts,
+                                    model="gpt-4o")
+    assert [attempt.truncated for attempt in attempts] == [True, True]
+
+
+@pytest.mark.parametrize("reply, paragraph", [
+    ('{"mad_lib": "A [Noun1] sat."}', "A [Noun1] sat."),
+    ('```json\n{"mad_lib": "A [Noun1] sat."}\n```', "A [Noun1] sat."),
+    ("A [Noun1] sat.\n\nPlaceholders: [Noun1]", "A [Noun1] sat."),
+    ('{"mad_lib": "A [Noun1] s', ""),  # cut off
+    ('{"story": "A [Noun1] sat."}', ""),
+])
+def test_parse_reply(reply, paragraph):
+    assert generation.parse_reply(reply) == paragraph
@@ -0,0 +1,129 @@
+'''
+Providers, fully offline: the local generator, an OpenAI compatible
+server stubbed on localhost, and the order the Router tries them in.
+'''
+import pytest
+import providers
+from generation import GenerationFailed
+from library import Library
+from tokenizer import count_tokens
+from benchmarks import SlowClient, stub_endpoint
+
+
+class FailingProvider(providers.Provider):
+    '''A provider which is fast and free but never works'''
+    name = "failing"
+    cost = 0.0
+    expected_latency = 0.001
+
+    def _generate(self, theme, number_of_blanks, max_retries, parallel,
+                  cancel_event, progress, attempts, on_text):
+        raise GenerationFailed("down")
+
+
+@pytest.fixture
+def server():
+    server = stub_endpoint(SlowClient(delay=0.01, blanks=5, valid_every=1))
+    yield server
+    server.shutdown()
+
+
+@pytest.mark.parametrize("blanks", [1, 2, 5, 20, 60])
+def test_local_exact_blank_count(blanks):
+    local = providers.LocalProvider(seed=0)
+    for _ in range(20):
+        assert count_tokens(local.generate("Winter", blanks)) == blanks
+
+
+def test_local_seed_repeats():
+    first = [providers.LocalProvider(seed=3).generate("Winter", 8) for _ in range(3)]
+    again = [providers.LocalProvider(seed=3).generate("Winter", 8) for _ in range(3)]
+    assert first == again
+    assert providers.LocalProvider(seed=4).generate("Winter", 8) != first[0]
+
+
+def test_local_uses_library_themes():
+    library = Library(":memory:")
+    library.add("Pirates", "The parrot ate my [Noun1]. We sailed to [Place2].")
+    local = providers.LocalProvider(library=library, seed=0)
+    paragraph = local.generate("Pirates", 3)
+    assert "Pirates" in paragraph
+    assert "The parrot ate my [Noun" in paragraph
+    assert count_tokens(paragraph) == 3
+
+
+@pytest.mark.parametrize("keep", [2, None])
+def test_local_without_one_prompt_sentences(keep):
+    local = providers.LocalProvider(seed=0)
+    local.openers = []
+    local.sentences = [sentence for sentence in local.sentences if sentence.count == keep]
+    assert count_tokens(local.compose("Winter", 3)) == (2 if keep else 0)
+    attempts = []
+    with pytest.raises(GenerationFailed, match="no sentences with one prompt"):
+        local.generate("Winter", 3, attempts=attempts)
+    assert [attempt.valid for attempt in attempts] == [False]
+
+
+@pytest.mark.parametrize("stream", [False, True])
+def test_endpoint_over_http(server, stream):
+    endpoint = providers.EndpointProvider(f"http://127.0.0.1:{server.server_port}/v1")
+    pieces = []
+    paragraph = endpoint.generate("Winter", 5, on_text=pieces.append if stream else None)
+    assert count_tokens(paragraph) == 5
+    assert bool(pieces) == stream
+
+
+def test_router_order_by_deadline():
+    chat = providers.ChatProvider(SlowClient())
+    chat.cost = 0.5
+    endpoint = providers.EndpointProvider("http://127.0.0.1:9/v1")
+    local = providers.LocalProvider(seed=0)
+    chat.latency.add(0.2)
+    endpoint.latency.add(0.05)
+    local.latency.add(0.0001)
+    router = providers.Router([chat, endpoint, local])
+
+    def order(deadline):
+        return [provider.name for provider in router.candidates(deadline)]
+    # cheapest within the deadline first, then the rest by latency
+    assert order(0.001) == ["local", "endpoint", "openai"]
+    assert order(0.1) == ["local", "endpoint", "openai"]
+    router.providers.remove(local)
+    assert order(0.1) == ["endpoint", "openai"]
+    assert order(1.0) == ["openai", "endpoint"]
+
+
+def test_router_falls_back_and_moves_failures_last():
+    failing = FailingProvider()
+    local = providers.LocalProvider(seed=0)
+    router = providers.Router([failing, local])
+    assert [provider.name for provider in router.candidates()] == ["failing", "local"]
+    attempts = []
+    paragraph = router.generate("Winter", 4, attempts=attempts)
+    assert count_tokens(paragraph) == 4
+    assert [attempt.provider for attempt in attempts] == ["local"]
+    assert failing.latency.failures == 1
+    assert [provider.name for provider in router.candidates()] == ["local", "failing"]
+
+
+def test_router_offline_server_falls_back_to_local():
+    fallback = providers.LocalProvider(seed=0)
+    fallback.cost = 100.0  # only used when the server fails
+    router = providers.Router([providers.EndpointProvider("http://127.0.0.1:9/v1", timeout=1),
+                               fallback])
+    assert count_tokens(router.generate("Winter", 5, max_retries=1)) == 5
+    assert [(stats["name"], stats["failures"]) for stats in router.stats()] == \
+        [("local", 0), ("endpoint", 1)]
+
+
+def test_router_without_providers():
+    with pytest.raises(GenerationFailed):
+        providers.Router([]).generate("Winter", 3)
+
+
+def test_default_providers(monkeypatch):
+    monkeypatch.delenv("MADLIBS_ENDPOINT", raising=False)
+    assert list(providers.default_providers(SlowClient())) == ["openai", "local", "auto"]
+    monkeypatch.setenv("MADLIBS_ENDPOINT", "http://127.0.0.1:9/v1")
+    assert list(providers.default_providers(SlowClient())) == ["openai", "endpoint", "local",
+                                                                "auto"]
@@ -0,0 +1,90 @@
+'''
+Local repair of replies with nearly the right number of prompts: blanks
+added in front of nouns, optional ones merged away, types normalized and
+everything numbered again.
+'''
+import types
+import pytest
+import generation
+from repair import repair_mad_lib, normalize_type, max_changes
+from tokenizer import count_tokens
+from benchmarks import SlowClient
+
+
+@pytest.mark.parametrize("text, blanks, repaired, added, removed", [
+    # right count, types renamed and renumbered
+    ("I saw the [plural noun] and [adjectives 7].", 2,
+     "I saw the [Noun Plural1] and [Adjective2].", 0, 0),
+    # one short: an adjective in front of a noun prompt
+    ("The [Noun1] ran to the [Noun2].", 3,
+     "The [Noun1] ran to the [Adjective2] [Noun3].", 1, 0),
+    # the article before the new adjective is fixed up
+    ("I saw a [Noun1] today.", 2,
+     "I saw an [Adjective1] [Noun2] today.", 1, 0),
+    # one over: an adverb which can go
+    ("The [Adjective1] [Noun2] was [Adverb3] happy with [Number4] cats.", 3,
+     "The [Adjective1] [Noun2] was happy with [Number3] cats.", 0, 1),
+    # two over: numbers become "some"
+    ("The [Adjective1] [Noun2] was [Adverb3] happy with [Number4] cats.", 2,
+     "The [Noun1] was [Adverb2] happy with some cats.", 0, 2),
+    # the article after a removed adjective agrees with the noun
+    ("A [Adjective1] owl and a [Adjective2] eagle.", 1,
+     "A [Adjective1] owl and an eagle.", 0, 1),
+])
+def test_repair(text, blanks, repaired, added, removed):
+    repair = repair_mad_lib(text, blanks)
+    assert repair.text == repaired
+    assert (repair.added, repair.removed) == (added, removed)
+    assert repair.changed == bool(added or removed)
+    assert count_tokens(repair.text) == blanks
+
+
+def test_too_far_off():
+    assert repair_mad_lib("Hello [Noun1].", 5) is None
+    assert repair_mad_lib("Hello [Noun1].", 2, limit=0) is None
+
+
+def test_no_safe_spot():
+    # nothing to put an adjective in front of
+    assert repair_mad_lib("[Verb1] quickly!", 2) is None
+
+
+def test_limits():
+    assert max_changes(4) == 2
+    assert max_changes(20) == 5
+
+
+@pytest.mark.parametrize("type_name, normalized", [
+    ("plural noun", "Noun Plural"), ("Verbs", "Verb"), ("adjective", "Adjective"),
+    ("Friend  Name", "Friend Name"),
+])
+def test_normalize_type(type_name, normalized):
+    assert normalize_type(type_name) == normalized
+
+
+class NearMissClient(SlowClient):
+    '''SlowClient which always replies with a paragraph one prompt short of three'''
+
+    def create(self, **kwargs):
+        with self.lock:
+            self.calls += 1
+        message = types.SimpleNamespace(content="The [Noun1] ran to the [Noun2].")
+        return types.SimpleNamespace(choices=[types.SimpleNamespace(message=message)])
+
+
+def test_near_miss_saves_a_request(monkeypatch):
+    monkeypatch.setattr(generation, "REPAIR", True)
+    client = NearMissClient()
+    attempts = []
+    paragraph = generation.generate_mad_lib(client, "Winter", 3, attempts=attempts)
+    assert paragraph == "The [Noun1] ran to the [Adjective2] [Noun3]."
+    assert len(attempts) == 1 and attempts[0].repair is not None
+    assert client.calls == 1
+
+
+def test_near_miss_asked_again_without_repair(monkeypatch):
+    monkeypatch.setattr(generation, "REPAIR", False)
+    client = NearMissClient()
+    with pytest.raises(generation.GenerationFailed):
+        generation.generate_mad_lib(client, "Winter", 3, max_retries=2)
+    assert client.calls == 2
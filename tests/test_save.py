@@ -0,0 +1,76 @@
+'''
+Saving from the window: once the answers are filled in, the template the
+story came from is saved, not the story, and editing the story makes it
+a template being written again.
+'''
+import pytest
+from library import Library
+from template_file import TemplateFile
+
+TEMPLATE = "The [Noun1] is [Adjective2]."
+ANSWERS = {"Noun1": "cat", "Adjective2": "big"}
+
+
+@pytest.fixture
+def window(qapp, monkeypatch, tmp_path):
+    '''A window with its library in tmp_path and a fill-in form answered with ANSWERS'''
+    from PyQt6.QtWidgets import QDialog
+    import mad_libs
+
+    def answer(dialog):
+        dialog.model.update(ANSWERS)
+        return QDialog.DialogCode.Accepted
+    monkeypatch.setattr(mad_libs.FillDialog, "exec", answer)
+    window = mad_libs.MainWindow()
+    window.library = Library(":memory:")
+    window.theme_text.setText("Pets")
+    window.full_text.setPlainText(TEMPLATE)
+    yield window
+    window.library.close()
+
+
+def save(monkeypatch, window, path, kind="Mad lib (*.madlib)"):
+    '''Save from the window as if path and kind were picked in the save dialog'''
+    import mad_libs
+    monkeypatch.setattr(mad_libs.QFileDialog, "getSaveFileName",
+                        lambda *args, **kwargs: (str(path), kind))
+    window.file_save()
+
+
+def test_filled_story_saves_the_template(monkeypatch, tmp_path, window):
+    window.start_fill_in_the_blank()
+    assert window.full_text.toPlainText() == "The [cat] is [big]."
+    assert window.showing_story()
+    assert window.prompt_counter_label.text() == "Number of Prompts: 0"
+    save(monkeypatch, window, tmp_path / "pets.madlib")
+    with TemplateFile(str(tmp_path / "pets.madlib")) as templates:
+        record = templates[0]
+        assert (record.theme, record.text, record.answers) == ("Pets", TEMPLATE, ANSWERS)
+    assert [entry.text for entry in window.library.search()] == [TEMPLATE]
+
+
+@pytest.mark.parametrize("change", ["edit", "undo", "clear"])
+def test_changed_story_is_a_template_again(window, change):
+    from PyQt6.QtGui import QTextCursor
+    window.start_fill_in_the_blank()
+    if change == "edit":
+        QTextCursor(window.full_text.document()).insertText("Oh! ")
+    elif change == "undo":
+        window.undo_edit()
+        assert window.full_text.toPlainText() == TEMPLATE
+    else:
+        window.clear_all()
+    assert not window.showing_story()
+    prompts = len(window.placeholders)
+    assert window.prompt_counter_label.text() == "Number of Prompts: " + str(prompts)
+
+
+def test_word_export_has_the_answers_in_bold(monkeypatch, tmp_path, window):
+    from docx import Document
+    window.start_fill_in_the_blank()
+    save(monkeypatch, window, tmp_path / "pets.docx", "Word document (*.docx)")
+    paragraphs = Document(str(tmp_path / "pets.docx")).paragraphs
+    story = [(run.text, run.bold) for run in paragraphs[1].runs]
+    assert story == [("The [", None), ("cat", True), ("] is [", None), ("big", True), ("].", None)]
+    texts = [paragraph.text for paragraph in paragraphs]
+    assert texts[texts.index("Do it again!") + 1:] == [TEMPLATE, "{0: 'Noun1', 1: 'Adjective2'}"]
@@ -0,0 +1,202 @@
+'''
+The game server through GameServer.dispatch: blanks are handed out in
+story order and taken back after REASSIGN_AFTER, answers only count from
+the player holding the blank, idle games expire, and the routes answer
+with the right errors. One round trip goes over a real socket.
+'''
+import json
+import asyncio
+import types
+import pytest
+import server
+from server import GameServer, HTTPError
+
+TEXT = "The [Adjective1] [Noun2] met [Celebrity3] and a [Noun2]."
+
+
+class Clock:
+    '''time.monotonic for the server which only moves when told to'''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(server, "time", types.SimpleNamespace(monotonic=clock))
+    return clock
+
+
+def call(games, method, target, body=None):
+    '''Function to dispatch one request. Returns (status, payload) like the HTTP handler.'''
+    data = json.dumps(body).encode() if body is not None else b""
+    try:
+        return asyncio.run(games.dispatch(method, target, data))
+    except HTTPError as e:
+        return e.status, {"error": str(e)}
+
+
+def new_game(games, players=2):
+    '''Function to create a game of TEXT. Returns the game id and the player ids.'''
+    status, game = call(games, "POST", "/games", {"theme": "Stars", "text": TEXT})
+    assert status == 201 and game["blanks"] == 3 and not game["complete"]
+    ids = [call(games, "POST", f"/games/{game['game']}/players", {"name": f"P{i}"})[1]["player"]
+           for i in range(players)]
+    return game["game"], ids
+
+
+def blank(games, game, player):
+    return call(games, "POST", f"/games/{game}/players/{player}/blank")
+
+
+def answer(games, game, player, name, text):
+    return call(games, "POST", f"/games/{game}/answers",
+                {"player": player, "name": name, "answer": text})
+
+
+def test_blanks_are_handed_out_in_story_order(clock):
+    games = GameServer()
+    game, (first, second) = new_game(games)
+    assert blank(games, game, first) == (200, {"name": "Adjective1", "label": "Enter an Adjective:"})
+    assert blank(games, game, first)[1]["name"] == "Adjective1"  # asking again gives the same one
+    assert blank(games, game, second)[1] == {"name": "Noun2", "label": "Enter a Noun:"}
+    assert answer(games, game, first, "Adjective1", "  old  ") == \
+        (200, {"remaining": 2, "complete": False})
+    assert blank(games, game, first)[1]["name"] == "Celebrity3"
+    third = call(games, "POST", f"/games/{game}/players", {})[1]["player"]
+    assert blank(games, game, third) == (200, {"name": None, "complete": False})
+
+
+def test_whole_game(clock):
+    games = GameServer()
+    game, (player,) = new_game(games, players=1)
+    assert call(games, "GET", f"/games/{game}/story")[1].get("story") is None
+    for text in ["old", "owl", "Ada"]:
+        name = blank(games, game, player)[1]["name"]
+        remaining = answer(games, game, player, name, text)[1]["remaining"]
+    assert remaining == 0
+    assert blank(games, game, player)[1] == {"name": None, "complete": True}
+    status, story = call(games, "GET", f"/games/{game}/story")
+    assert status == 200 and story["complete"]
+    assert story["story"] == "The [old] [owl] met [Ada] and an [owl]."
+    assert story["players"] == [{"name": "P0", "answered": 3}]
+
+
+def test_expired_lease_goes_to_someone_else(clock):
+    games = GameServer()
+    game, (slow, fast) = new_game(games)
+    assert blank(games, game, slow)[1]["name"] == "Adjective1"
+    for name, text in [("Noun2", "owl"), ("Celebrity3", "Ada")]:
+        assert blank(games, game, fast)[1]["name"] == name
+        answer(games, game, fast, name, text)
+    assert blank(games, game, fast)[1]["name"] is None  # still held by slow
+    clock.now += server.REASSIGN_AFTER + 1
+    assert blank(games, game, fast)[1]["name"] == "Adjective1"
+    assert answer(games, game, slow, "Adjective1", "late") == \
+        (409, {"error": "that blank was not handed to this player"})
+    assert answer(games, game, fast, "Adjective1", "odd")[1] == {"remaining": 0, "complete": True}
+
+
+def test_answers_are_checked(clock):
+    games = GameServer()
+    game, (first, second) = new_game(games)
+    name = blank(games, game, first)[1]["name"]
+    assert answer(games, game, second, name, "cat")[0] == 409  # not second's blank
+    assert answer(games, game, first, name, "   ")[0] == 400
+    assert answer(games, game, "nobody", name, "cat")[0] == 404
+    assert answer(games, game, first, name, "x" * 500)[0] == 200
+    assert answer(games, game, first, name, "again")[0] == 409  # already answered
+    status = call(games, "GET", f"/games/{game}")[1]
+    assert (status["filled"], status["players"]) == (1, 2)
+    assert games.games[game].session.answers[name] == "x" * server.MAX_ANSWER
+
+
+def test_story_waits_for_the_last_answer(clock):
+    games = GameServer()
+    game, (player,) = new_game(games, players=1)
+    for text in ["old", "owl"]:
+        answer(games, game, player, blank(games, game, player)[1]["name"], text)
+    last = blank(games, game, player)[1]["name"]
+
+    async def wait_and_answer():
+        waiting = asyncio.create_task(games.dispatch("GET", f"/games/{game}/story?wait=5", b""))
+        await asyncio.sleep(0.01)
+        assert not waiting.done()
+        await games.dispatch("POST", f"/games/{game}/answers", json.dumps(
+            {"player": player, "name": last, "answer": "Ada"}).encode())
+        return await asyncio.wait_for(waiting, 1)
+    status, story = asyncio.run(wait_and_answer())
+    assert status == 200 and story["story"] == "The [old] [owl] met [Ada] and an [owl]."
+
+
+def test_idle_games_expire(clock):
+    games = GameServer(max_games=2, ttl=60)
+    old, _ = new_game(games, players=0)
+    clock.now += 30
+    kept, _ = new_game(games, players=0)
+    assert call(games, "POST", "/games", {"text": TEXT}) == \
+        (503, {"error": "too many games, try again later"})
+    clock.now += 31  # old is past the ttl, kept is not
+    assert call(games, "POST", "/games", {"text": TEXT})[0] == 201
+    assert call(games, "GET", f"/games/{old}") == (404, {"error": "no such game"})
+    assert call(games, "GET", f"/games/{kept}")[0] == 200
+    assert call(games, "DELETE", f"/games/{kept}") == (200, {"deleted": kept})
+    assert call(games, "GET", f"/games/{kept}")[0] == 404
+
+
+@pytest.mark.parametrize("method, target, body, status", [
+    ("GET", "/nowhere", None, 404),
+    ("PUT", "/games", None, 405),
+    ("POST", "/games", [1, 2], 400),
+    ("POST", "/games", {"blanks": 0}, 400),
+    ("POST", "/games", {"blanks": server.MAX_BLANKS + 1}, 400),
+    ("POST", "/games", {"text": "x" * (server.MAX_TEXT + 1)}, 400),
+    ("POST", "/games", {"text": "".join(f"[Noun{i}] " for i in range(server.MAX_BLANKS + 1))}, 400),
+    ("GET", "/games/missing", None, 404),
+    ("GET", "/stats", None, 200),
+])
+def test_routes(clock, method, target, body, status):
+    assert call(GameServer(), method, target, body)[0] == status
+
+
+def test_bad_json_body():
+    with pytest.raises(HTTPError) as error:
+        asyncio.run(GameServer().dispatch("POST", "/games", b"{nope"))
+    assert error.value.status == 400
+
+
+def test_generated_game_has_the_blanks():
+    status, game = call(GameServer(), "POST", "/games", {"theme": "Winter", "blanks": 7})
+    assert status == 201 and game["blanks"] == 7 and game["theme"] == "Winter"
+
+
+def test_over_http():
+    async def round_trip():
+        games = GameServer()
+        ports = []
+        serving = asyncio.create_task(games.serve(port=0, ready=ports.append))
+        while not ports:
+            await asyncio.sleep(0.01)
+        reader, writer = await asyncio.open_connection("127.0.0.1", ports[0])
+        replies = []
+        for method, target, body in [("POST", "/games", {"text": TEXT}), ("GET", "/nowhere", None)]:
+            data = json.dumps(body).encode() if body is not None else b""
+            writer.write(f"{method} {target} HTTP/1.1\r\nContent-Length: {len(data)}\r\n\r\n"
+                         .encode() + data)
+            status = int((await reader.readline()).split()[1])
+            headers = {}
+            while (line := await reader.readline()) != b"\r\n":
+                name, _, value = line.decode().partition(":")
+                headers[name.lower()] = value.strip()
+            replies.append((status, json.loads(await reader.readexactly(
+                int(headers["content-length"]))), headers["connection"]))
+        writer.close()
+        serving.cancel()
+        return replies
+    (created, game, kept), (missing, error, _) = asyncio.run(round_trip())
+    assert (created, game["blanks"], kept) == (201, 3, "keep-alive")
+    assert (missing, error) == (404, {"error": "not found"})
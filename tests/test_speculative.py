@@ -0,0 +1,61 @@
+'''
+Speculative generation: racing several requests returns as soon as one
+has the right number of prompts, instead of waiting for them in turn.
+'''
+import time
+import threading
+import pytest
+import generation
+from tokenizer import count_tokens
+from benchmarks import SlowClient
+
+DELAY = 0.3  # seconds each stub request takes
+
+
+@pytest.fixture(autouse=True)
+def no_repair(monkeypatch):
+    # only every third stub reply has the right count, don't fix the others up
+    monkeypatch.setattr(generation, "REPAIR", False)
+
+
+def test_racing_beats_retrying():
+    start = time.perf_counter()
+    paragraph = generation.generate_mad_lib(SlowClient(DELAY, blanks=5, valid_every=3),
+                                            "Winter", 5, max_retries=3)
+    sequential = time.perf_counter() - start
+    assert count_tokens(paragraph) == 5
+
+    attempts = []
+    start = time.perf_counter()
+    paragraph = generation.generate_speculative(SlowClient(DELAY, blanks=5, valid_every=3),
+                                                "Winter", 5, parallel=3, attempts=attempts)
+    speculative = time.perf_counter() - start
+    assert count_tokens(paragraph) == 5
+    assert any(attempt.valid for attempt in attempts)
+    assert sequential >= 3 * DELAY
+    assert speculative < 2 * DELAY
+
+
+@pytest.mark.parametrize("blanks", [1, 5, 12])
+def test_exact_blank_count(blanks):
+    paragraph = generation.generate_speculative(SlowClient(0.01, blanks=blanks, valid_every=3),
+                                                "Winter", blanks, parallel=3)
+    assert count_tokens(paragraph) == blanks
+
+
+def test_fails_when_no_reply_is_right():
+    attempts = []
+    with pytest.raises(generation.GenerationFailed):
+        generation.generate_speculative(SlowClient(0.01, blanks=5, valid_every=1000),
+                                        "Winter", 5, parallel=3, attempts=attempts)
+    assert len(attempts) == 3
+
+
+def test_cancel_stops_waiting():
+    cancel_event = threading.Event()
+    threading.Timer(0.05, cancel_event.set).start()
+    start = time.perf_counter()
+    with pytest.raises(generation.GenerationCancelled):
+        generation.generate_speculative(SlowClient(1.0, blanks=5, valid_every=1),
+                                        "Winter", 5, parallel=3, cancel_event=cancel_event)
+    assert time.perf_counter() - start < 0.5
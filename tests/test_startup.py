@@ -0,0 +1,30 @@
+'''
+Start up of the GUI: showing the window stays within STARTUP_BUDGET and
+leaves the slow optional modules (LAZY_MODULES) unimported until used.
+'''
+import os
+import sys
+import time
+import subprocess
+from benchmarks import LAZY_MODULES, STARTUP_BUDGET, STARTUP_SCRIPT
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+def start_window():
+    '''Function to start the GUI in a fresh interpreter. Returns (seconds, lazy modules loaded).'''
+    env = dict(os.environ, QT_QPA_PLATFORM="offscreen")
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-c", STARTUP_SCRIPT.format(lazy=LAZY_MODULES)],
+                            cwd=ROOT, env=env, capture_output=True, text=True, check=True)
+    return time.perf_counter() - start, result.stdout.strip()
+
+
+def test_slow_modules_stay_unloaded():
+    _, loaded = start_window()
+    assert loaded == ""
+
+
+def test_startup_budget():
+    # best of three, the first start also warms the disk cache
+    assert min(start_window()[0] for _ in range(3)) <= STARTUP_BUDGET
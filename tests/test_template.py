@@ -0,0 +1,36 @@
+'''
+Filling in templates: every way a mad lib is filled in (Template.render,
+the fill-in form's FillSession and the bold parts of a Word export) gives
+the same story, with "a" or "an" agreeing with each answer.
+'''
+import random
+import pytest
+import core
+from template import Template
+from fill_session import FillSession
+
+TEXT = "Once a [Adjective1] cat met An [Noun1] and a [Noun1]. an [Verb1] end"
+
+
+@pytest.mark.parametrize("answers, story", [
+    ({"Adjective1": "apple", "Noun1": "owl"},
+     "Once an [apple] cat met An [owl] and an [owl]. an [Verb1] end"),
+    ({"Adjective1": "big", "Noun1": "Dog", "Verb1": "ran"},
+     "Once a [big] cat met A [Dog] and a [Dog]. a [ran] end"),
+    ({}, TEXT),  # unanswered prompts keep the article as written
+])
+def test_render_articles(answers, story):
+    assert Template(TEXT).render(answers) == story
+
+
+def test_every_fill_path_agrees():
+    session = FillSession(TEXT)
+    story = TEXT
+    rng = random.Random(0)
+    for _ in range(300):
+        name = rng.choice(session.names)
+        for position, length, text in session.set_answer(name, rng.choice(["", "apple", "big", "x"])):
+            story = story[:position] + text + story[position + length:]
+        assert story == session.render() == Template(TEXT).render(session.answers)
+        parts = core.filled_parts(Template(TEXT), session.answers)
+        assert "".join(text for text, _ in parts) == story
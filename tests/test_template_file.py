@@ -0,0 +1,73 @@
+'''
+The .madlib format: templates come back as saved, spans which don't match
+the text and files this version can't read are refused, and core reads
+and writes the format the window saves in.
+'''
+import json
+import pytest
+import core
+from template_file import TemplateFile, TemplateRecord, save_templates, FORMAT_VERSION
+
+RECORDS = [
+    TemplateRecord("Winter", "Snow on the [Noun1], a [Adjective2] day.", {"Noun1": "roof"}),
+    TemplateRecord("Émoji ☃", "No prompts here\nat all"),
+    TemplateRecord("", "[Verb1] [Verb1] [Number2]"),
+]
+
+
+def test_round_trip(tmp_path):
+    path = str(tmp_path / "winter.madlib")
+    save_templates(path, RECORDS)
+    with TemplateFile(path) as templates:
+        assert len(templates) == len(RECORDS)
+        for saved, record in zip(RECORDS, templates):
+            assert (record.theme, record.text, record.answers) == \
+                (saved.theme, saved.text, saved.answers)
+            assert record.template.spans == saved.template.spans
+            assert record.template.render({}) == saved.text
+        assert [record.theme for record in templates] == ["Winter", "Émoji ☃", ""]
+        assert templates[-1].template.names == ["Verb1", "Verb1", "Number2"]
+
+
+def test_core_round_trip(tmp_path):
+    path = str(tmp_path / "winter.madlib")
+    core.write_template(path, "Winter", RECORDS[0].text, {})
+    assert core.read_mad_lib(path) == ("Winter", RECORDS[0].text)
+
+
+def test_span_mismatch(tmp_path):
+    path = tmp_path / "edited.madlib"
+    save_templates(str(path), RECORDS[:1])
+    path.write_text(path.read_text(encoding="utf-8").replace("Snow", "Ice"), encoding="utf-8")
+    with TemplateFile(str(path)) as templates:
+        assert len(templates) == 1
+        with pytest.raises(ValueError, match="spans"):
+            templates[0]
+
+
+def test_newer_version(tmp_path):
+    path = tmp_path / "future.madlib"
+    path.write_text(json.dumps({"format": "madlib", "version": FORMAT_VERSION + 1}) + "\n")
+    with pytest.raises(ValueError, match="newer version"):
+        TemplateFile(str(path))
+
+
+@pytest.mark.parametrize("content, message", [
+    ("", "empty"),
+    ("hello\n", "not a mad lib"),
+    ('{"format": "docx"}\n', "not a mad lib"),
+])
+def test_not_readable(tmp_path, content, message):
+    path = tmp_path / "bad.madlib"
+    path.write_text(content)
+    with pytest.raises(ValueError, match=message):
+        TemplateFile(str(path))
+
+
+def test_header_only(tmp_path):
+    path = str(tmp_path / "none.madlib")
+    save_templates(path, [])
+    with TemplateFile(path) as templates:
+        assert len(templates) == 0 and list(templates) == []
+    with pytest.raises(ValueError, match="no mad libs"):
+        core.read_mad_lib(path)
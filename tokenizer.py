@@ -0,0 +1,123 @@
+'''
+The fill-in-the-blank grammar, kept in one place. A placeholder is a type
+in square brackets with an optional number after it: [Noun12], [Verb Past
+Tense 3], or a custom one such as [Friend's Name1] or [Mr. Anything2].
+A type starts with a letter and goes on with letters, spaces and
+' . & - ; digits are only ever the number at the end, so blanks numbered
+10 and up split the same way as the rest.
+
+Text is lexed once into Tokens with one precompiled pattern and every
+path (filling in, counting replies, the edit index, repair, the library)
+works from those instead of slicing names itself. Template and
+PlaceholderIndex, which only need names and positions, take the matches
+from scan to skip making Tokens.
+'''
+import re
+import profiling
+
+LETTERS = "A-Za-zÀ-ÖØ-öø-ɏͰ-ϿЀ-ӿ"  # Latin, Greek and Cyrillic
+SEPARATORS = r"\s'’.&-"
+TYPE = "[" + LETTERS + "][" + LETTERS + SEPARATORS + "]*"
+# [ type number ]: group 1 is the name answers are keyed by, e.g. Noun12
+PLACEHOLDER_PATTERN = re.compile(r"\[\s*(" + TYPE + r"[0-9]*)\s*\]")
+TYPE_PATTERN = re.compile(TYPE)
+
+
+class Token:
+    '''A placeholder found in a template'''
+    __slots__ = ("name", "type", "ordinal", "span", "name_span")
+
+    def __init__(self, name, type_name, ordinal, span, name_span):
+        self.name = name  # what the answer is keyed by, e.g. Noun12
+        self.type = type_name  # e.g. Noun
+        self.ordinal = ordinal  # e.g. 12, None when there is no number
+        self.span = span  # (start, end) of the placeholder, brackets included
+        self.name_span = name_span  # (start, end) of the name
+
+    def __repr__(self):
+        return f"Token({self.type!r}, {self.ordinal!r}, {self.span!r})"
+
+
+def _token(match):
+    name = match.group(1)
+    type_name, ordinal = split_name(name)
+    return Token(name, type_name, ordinal, match.span(), match.span(1))
+
+
+def scan(text, start=0, end=None):
+    '''
+    Function to find the placeholders of text, or of the part from start
+    to end, as regular expression matches whose group 1 is the name
+
+    Keyword arguments:
+    text -- mad lib text (str)
+    start -- position to start at (int)
+    end -- position to stop at, the end of the text if None (int)
+    '''
+    end = len(text) if end is None else end
+    if profiling.enabled:
+        profiling.count("regex_scans")
+        profiling.count("regex_scanned_chars", end - start)
+    return PLACEHOLDER_PATTERN.finditer(text, start, end)
+
+
+def iter_tokens(text, start=0, end=None):
+    '''Function to lex the placeholders of text into Tokens, see scan'''
+    return map(_token, scan(text, start, end))
+
+
+def tokenize(text, start=0, end=None):
+    '''Function to get the list of Tokens in text, see iter_tokens'''
+    return list(iter_tokens(text, start, end))
+
+
+def count_tokens(text):
+    '''Function to count the placeholders in text without making Tokens'''
+    return sum(1 for _ in scan(text))
+
+
+def substitute(text, replace):
+    '''
+    Function to replace every placeholder, brackets included
+
+    Keyword arguments:
+    text -- mad lib text (str)
+    replace -- called with each Token, returns the text to put in its place
+    '''
+    return PLACEHOLDER_PATTERN.sub(lambda match: replace(_token(match)), text)
+
+
+def prompt_type(name):
+    '''
+    Function to get the type of a placeholder name, e.g. Noun for Noun12
+
+    Keyword arguments:
+    name -- placeholder name without brackets (str)
+    '''
+    return name.rstrip("0123456789").strip()
+
+
+def split_name(name):
+    '''
+    Function to split a placeholder name into its type and number, e.g.
+    ("Noun", 12) for Noun12 or ("Noun", None) for Noun
+
+    Keyword arguments:
+    name -- placeholder name without brackets (str)
+    '''
+    type_name = name.rstrip("0123456789")
+    digits = name[len(type_name):]
+    return type_name.strip(), int(digits) if digits else None
+
+
+def clean_type(text):
+    '''
+    Function to turn what was typed in for a custom prompt into a type the
+    grammar reads back the same, e.g. "Top 10 song!" becomes "Top song".
+    Returns "" when nothing usable is left.
+
+    Keyword arguments:
+    text -- custom prompt (str)
+    '''
+    text = " ".join(text.replace("[", " ").replace("]", " ").split())
+    return " ".join(" ".join(TYPE_PATTERN.findall(text)).split()).rstrip(" '’&-")
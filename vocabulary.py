@@ -0,0 +1,276 @@
+'''
+Word lists for filling in mad libs automatically. Each prompt type has a
+list of words read from "<Type>.txt" in a vocabulary folder, one word per
+line, optionally followed by a tab and a weight:
+
+    Noun.txt            Colour.txt
+    banana              red<TAB>3
+    trampoline          mauve<TAB>0.5
+
+Words are interned and held in one tuple per type together with a running
+total of the weights, so millions of answers share the same few string
+objects. Sampling is seeded; NumPy is used for bulk sampling when it is
+installed and the same seed gives the same answers with the same backend.
+'''
+import os
+import sys
+import heapq
+import random
+import itertools
+from array import array
+from template import compile_template
+from tokenizer import prompt_type
+
+DEFAULT_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "WordLists")
+EXTENSION = ".txt"
+
+
+class WordList:
+    '''The words for one prompt type with optional weights'''
+    __slots__ = ("type", "words", "cumulative", "_numpy")
+
+    def __init__(self, type_name, words, weights=None):
+        '''
+        Keyword arguments:
+        type_name -- prompt type, e.g. Noun (str)
+        words -- the words (iterable of str)
+        weights -- relative weight of each word, all equal if None (iterable)
+        '''
+        self.type = type_name
+        self.words = tuple(sys.intern(word) for word in words)
+        self.cumulative = None
+        if weights is not None:
+            self.cumulative = array("d", itertools.accumulate(weights))
+            if len(self.cumulative) != len(self.words):
+                raise ValueError(type_name + " has a different number of words and weights")
+            if self.words and self.cumulative[-1] <= 0:
+                raise ValueError(type_name + " weights must add up to more than 0")
+        self._numpy = None
+
+    def __len__(self):
+        return len(self.words)
+
+    def sample(self, rng, k, unique=True):
+        '''
+        Function to pick k words. With unique set a word is only used twice
+        once every word has been used.
+
+        Keyword arguments:
+        rng -- random number generator (random.Random)
+        k -- number of words (int)
+        unique -- avoid repeating words (bool)
+        '''
+        if not unique:
+            return rng.choices(self.words, cum_weights=self.cumulative, k=k)
+        n = len(self.words)
+        picked = []
+        while k > 0:
+            take = min(k, n)
+            if self.cumulative is None:
+                picked += rng.sample(self.words, take)
+            else:
+                picked += self._weighted_unique(rng, take)
+            k -= take
+        return picked
+
+    def _weighted_unique(self, rng, k):
+        # a few rounds of drawing with replacement is enough when k is much
+        # smaller than the list, the rest uses Efraimidis-Spirakis keys
+        seen = {}
+        for _ in range(4):
+            for word in rng.choices(self.words, cum_weights=self.cumulative, k=k - len(seen)):
+                seen[word] = None
+            if len(seen) == k:
+                return list(seen)
+        previous = 0.0
+        keys = []
+        for word, total in zip(self.words, self.cumulative):
+            weight = total - previous
+            previous = total
+            if weight > 0:
+                keys.append((rng.random() ** (1.0 / weight), word))
+        return [word for _, word in heapq.nlargest(k, keys)]
+
+    def numpy_arrays(self, numpy):
+        '''Word objects and normalised cumulative weights as NumPy arrays, built once'''
+        if self._numpy is None:
+            words = numpy.empty(len(self.words), dtype=object)
+            words[:] = self.words
+            cumulative = None
+            if self.cumulative is not None:
+                cumulative = numpy.frombuffer(self.cumulative, dtype=numpy.float64)
+                cumulative = cumulative / cumulative[-1]
+            self._numpy = (words, cumulative)
+        return self._numpy
+
+
+def _numpy():
+    try:
+        import numpy  # optional, only used for bulk sampling
+    except ImportError:
+        return None
+    return numpy
+
+
+class Vocabulary:
+    '''
+    Word lists by prompt type. Types are matched without regard to case
+    and prompts of a type with no words (e.g. Custom) are left unanswered.
+    '''
+
+    def __init__(self):
+        self.lists = {}  # lower case type -> WordList
+
+    @classmethod
+    def load(cls, directory=None):
+        '''
+        Function to read every word list in a folder
+
+        Keyword arguments:
+        directory -- folder of <Type>.txt files, defaults to $MADLIBS_VOCABULARY or WordLists (str)
+        '''
+        if directory is None:
+            directory = os.environ.get("MADLIBS_VOCABULARY", DEFAULT_PATH)
+        vocabulary = cls()
+        for file in sorted(os.listdir(directory)):
+            if file.endswith(EXTENSION):
+                vocabulary.load_file(os.path.join(directory, file))
+        return vocabulary
+
+    def load_file(self, path, type_name=None):
+        '''
+        Function to read one word list, replacing any list of the same type
+
+        Keyword arguments:
+        path -- word list file (str)
+        type_name -- prompt type, defaults to the file name (str)
+        '''
+        if type_name is None:
+            type_name = os.path.splitext(os.path.basename(path))[0]
+        with open(path, encoding="utf-8") as file:
+            lines = [line.strip() for line in file.read().splitlines()]
+        lines = [line for line in lines if line and not line.startswith("#")]
+        if any("\t" in line for line in lines):
+            words, weights = [], []
+            for line in lines:
+                word, _, weight = line.partition("\t")
+                words.append(word.strip())
+                weights.append(float(weight) if weight.strip() else 1.0)
+            return self.add(type_name, words, weights)
+        return self.add(type_name, lines)
+
+    def add(self, type_name, words, weights=None):
+        '''
+        Function to add a word list for a prompt type. Returns the WordList.
+
+        Keyword arguments:
+        type_name -- prompt type, e.g. Noun (str)
+        words -- the words (iterable of str)
+        weights -- relative weight of each word (iterable)
+        '''
+        word_list = WordList(type_name, words, weights)
+        self.lists[type_name.lower()] = word_list
+        return word_list
+
+    def get(self, type_name):
+        '''Return the WordList for a prompt type, or None if there are no words'''
+        word_list = self.lists.get(type_name.lower())
+        return word_list if word_list else None
+
+    def types(self):
+        return [word_list.type for word_list in self.lists.values()]
+
+    def _groups(self, template):
+        '''Unique prompt names of a template grouped by their word list'''
+        groups = {}
+        for name in dict.fromkeys(template.names):
+            word_list = self.get(prompt_type(name))
+            if word_list is not None:
+                groups.setdefault(word_list.type, (word_list, []))[1].append(name)
+        return list(groups.values())
+
+    def sample_answers(self, text, seed=None, unique=True, rng=None):
+        '''
+        Function to pick an answer for every prompt of a mad lib. Prompts
+        which appear more than once get one answer.
+
+        Keyword arguments:
+        text -- mad lib text with [Type N] prompts (str)
+        seed -- random seed, random if None (int)
+        unique -- don't use a word twice in the story while there are others (bool)
+        rng -- random number generator to use instead of a seed (random.Random)
+        '''
+        return self._sample(self._groups(compile_template(text)),
+                            rng or random.Random(seed), unique)
+
+    @staticmethod
+    def _sample(groups, rng, unique):
+        answers = {}
+        for word_list, names in groups:
+            answers.update(zip(names, word_list.sample(rng, len(names), unique)))
+        return answers
+
+    def sample_answer_sets(self, text, count, seed=None, unique=True, chunk_size=10000):
+        '''
+        Function to generate many answer sets for one mad lib, e.g. to load
+        test the renderer. Sets are generated chunk_size at a time so memory
+        stays flat however many are asked for. Uses NumPy when installed,
+        in which case the answers for a seed also depend on chunk_size.
+
+        Keyword arguments:
+        text -- mad lib text with [Type N] prompts (str)
+        count -- number of answer sets (int)
+        seed -- random seed, random if None (int)
+        unique -- don't use a word twice in a story while there are others (bool)
+        chunk_size -- answer sets generated at a time (int)
+        '''
+        groups = self._groups(compile_template(text))
+        numpy = _numpy()
+        if numpy is None:
+            rng = random.Random(seed)
+            for _ in range(count):
+                yield self._sample(groups, rng, unique)
+            return
+        rng = numpy.random.default_rng(seed)
+        done = 0
+        while done < count:
+            rows = min(chunk_size, count - done)
+            columns = []
+            names = []
+            for word_list, group_names in groups:
+                columns.append(self._sample_columns(numpy, rng, word_list, rows,
+                                                    len(group_names), unique))
+                names += group_names
+            if columns:
+                chosen = numpy.concatenate(columns, axis=1).tolist()
+            else:
+                chosen = [[]] * rows
+            for row in chosen:
+                yield dict(zip(names, row))
+            done += rows
+
+    @staticmethod
+    def _sample_columns(numpy, rng, word_list, rows, k, unique):
+        '''rows x k words for one prompt type, drawn all at once'''
+        words, cumulative = word_list.numpy_arrays(numpy)
+        n = len(words)
+        if unique and k > n:
+            # more prompts than words: shuffle the whole list once per lap
+            laps = -(-k // n)
+            keys = rng.random((rows, laps, n))
+            return words[keys.argsort(axis=2).reshape(rows, laps * n)[:, :k]]
+        if cumulative is None:
+            indexes = rng.integers(0, n, size=(rows, k))
+        else:
+            indexes = numpy.searchsorted(cumulative, rng.random((rows, k)), side="right")
+            numpy.minimum(indexes, n - 1, out=indexes)
+        if unique and k > 1:
+            # redraw the few rows where a word came up twice
+            ordered = numpy.sort(indexes, axis=1)
+            repeated = numpy.flatnonzero((ordered[:, 1:] == ordered[:, :-1]).any(axis=1))
+            probabilities = None if cumulative is None else numpy.diff(cumulative, prepend=0.0)
+            for row in repeated:
+                if probabilities is not None and numpy.count_nonzero(probabilities) < k:
+                    break
+                indexes[row] = rng.choice(n, size=k, replace=False, p=probabilities)
+        return words[indexes]